@@ -0,0 +1,67 @@
+"""Command line and output shared by the benchmark scripts.
+
+A benchmark writes each result as a JSON object on a line of its own, tagged
+with the commit benchmarked, the interpreter, the machine and the random seed
+its inputs were made from, so results from different checkouts and hosts can
+be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+
+def commit_id():
+	"Return the commit of this checkout being benchmarked, or None."
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def environment(seed):
+	"Return the fields every result of a run with random seed `seed` shares."
+	return {'commit': commit_id(), 'python': platform.python_version(),
+			'implementation': platform.python_implementation(),
+			'machine': platform.machine(), 'cpus': os.cpu_count(), 'seed': seed}
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+	"""Parse a benchmark's options, with the --seed and --output all of them take.
+
+	The description defaults to the first paragraph of `doc`. `seed` is the
+	default random seed, and `inputs` says what it generates.
+	"""
+
+	def __init__(self, *args, doc, seed, inputs, **kwargs):
+		kwargs.setdefault('description', doc.split('\n\n')[0])
+		super().__init__(*args, **kwargs)
+		self.add_argument('--seed', type=int, default=seed,
+				help='random seed for the ' + inputs)
+		self.add_argument('--output', default='-',
+				help="file to append JSON lines of results to (default: '-', "
+					 'standard output)')
+
+
+def write_results(results, args):
+	"""Write the dicts `results` as JSON lines to the file `args.output`.
+
+	Each gets the `environment` of `args.seed`. The file is appended to, or
+	is standard output if '-', and flushed after each line so an interrupted
+	run keeps what it measured.
+	"""
+	common = environment(args.seed)
+	out = sys.stdout if args.output == '-' else open(args.output, 'a')
+	try:
+		for result in results:
+			out.write(json.dumps(dict(result, **common), sort_keys=True) + '\n')
+			out.flush()
+	finally:
+		if out is not sys.stdout:
+			out.close()
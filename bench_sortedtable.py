@@ -0,0 +1,332 @@
+#! /usr/bin/env python3
+
+"""Microbenchmark sortedtable against dict plus sorted and bisect over lists.
+
+Each operation is timed, best of several repeats, on a table of n items with
+int, str, tuple or unhashable (list) keys, and written as a JSON line with the
+nanoseconds per operation, by `bench_common`. Tables and queries depend only
+on n, the key type and the random seed. `dict` can't hold unhashable keys, so
+the dict plus sorted baseline skips them.
+"""
+
+import itertools
+import pickle
+import random
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from operator import itemgetter
+
+import bench_common
+import sortedtable
+
+
+def int_keys(rng, n):
+	return rng.sample(range(2 ** 40), n)
+
+
+def str_keys(rng, n):
+	keys = set()
+	while len(keys) < n:
+		keys.add(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+						 for i in range(rng.randint(6, 14))))
+	return list(keys)
+
+
+def tuple_keys(rng, n):
+	return [(k % 1000, format(k, 'x')) for k in int_keys(rng, n)]
+
+
+def unhashable_keys(rng, n):
+	return [[k >> 20, k & 0xfffff] for k in int_keys(rng, n)]
+
+
+KEY_TYPES = {'int': int_keys, 'str': str_keys, 'tuple': tuple_keys,
+			 'unhashable': unhashable_keys}
+
+
+class SortedTable:
+
+	"The tables under test: `SortedMapping` and `SortedSet`."
+
+	name = 'sortedtable'
+	hashable_only = False
+
+	def build(self, items):
+		return sortedtable.SortedMapping(items)
+
+	def build_set(self, keys):
+		return sortedtable.SortedSet(keys)
+
+	def getitem(self, t, keys):
+		for k in keys:
+			t[k]
+
+	def setitem(self, t, items):
+		for k, v in items:
+			t[k] = v
+
+	def delitem(self, t, keys):
+		for k in keys:
+			del t[k]
+
+	def floor_ceiling(self, t, keys):
+		floor, ceiling = t.floor, t.ceiling
+		for k in keys:
+			floor(k)
+			ceiling(k)
+
+	def rank_select(self, t, keys, ranks):
+		for k in keys:
+			t.rank(k)
+		for i in ranks:
+			t.select(i)
+
+	def range(self, t, bounds):
+		for lo, hi in bounds:
+			for k in t.range(lo, hi):
+				pass
+
+	def popmin_popmax(self, t, count):
+		for i in range(count):
+			t.popmin()
+			t.popmax()
+
+	def set_algebra(self, a, b):
+		return a | b, a & b, a - b
+
+
+class DictSorted(SortedTable):
+
+	"""A dict, sorting its keys with `sorted` when a batch needs their order.
+
+	Sorting once per batch stands for a program that caches the sorted keys
+	between mutations, which flatters the baseline.
+	"""
+
+	name = 'dict+sorted'
+	hashable_only = True
+
+	def build(self, items):
+		return dict(items)
+
+	def build_set(self, keys):
+		return set(keys)
+
+	def floor_ceiling(self, t, keys):
+		ks = sorted(t)
+		for k in keys:
+			i = bisect_right(ks, k)
+			ks[i - 1] if i else None
+			i = bisect_left(ks, k)
+			ks[i] if i < len(ks) else None
+
+	def rank_select(self, t, keys, ranks):
+		ks = sorted(t)
+		for k in keys:
+			bisect_left(ks, k)
+		for i in ranks:
+			ks[i]
+
+	def range(self, t, bounds):
+		ks = sorted(t)
+		for lo, hi in bounds:
+			for k in ks[bisect_left(ks, lo):bisect_left(ks, hi)]:
+				pass
+
+	def popmin_popmax(self, t, count):
+		ks = sorted(t)
+		for i in range(count):
+			t.pop(ks[i])
+			t.pop(ks[-1 - i])
+
+	def set_algebra(self, a, b):
+		return sorted(a | b), sorted(a & b), sorted(a - b)
+
+
+class BisectLists(SortedTable):
+
+	"Parallel sorted lists of keys and values, searched with `bisect`."
+
+	name = 'bisect'
+
+	def build(self, items):
+		items = sorted(items, key=itemgetter(0))
+		return [k for k, v in items], [v for k, v in items]
+
+	def build_set(self, keys):
+		return sorted(keys)
+
+	def getitem(self, t, keys):
+		ks, vs = t
+		for k in keys:
+			vs[bisect_left(ks, k)]
+
+	def setitem(self, t, items):
+		ks, vs = t
+		for k, v in items:
+			i = bisect_left(ks, k)
+			if i < len(ks) and ks[i] == k:
+				vs[i] = v
+			else:
+				ks.insert(i, k)
+				vs.insert(i, v)
+
+	def delitem(self, t, keys):
+		ks, vs = t
+		for k in keys:
+			i = bisect_left(ks, k)
+			del ks[i]
+			del vs[i]
+
+	def floor_ceiling(self, t, keys):
+		ks = t[0]
+		for k in keys:
+			i = bisect_right(ks, k)
+			ks[i - 1] if i else None
+			i = bisect_left(ks, k)
+			ks[i] if i < len(ks) else None
+
+	def rank_select(self, t, keys, ranks):
+		ks = t[0]
+		for k in keys:
+			bisect_left(ks, k)
+		for i in ranks:
+			ks[i]
+
+	def range(self, t, bounds):
+		ks, vs = t
+		for lo, hi in bounds:
+			for k in ks[bisect_left(ks, lo):bisect_left(ks, hi)]:
+				pass
+
+	def popmin_popmax(self, t, count):
+		ks, vs = t
+		for i in range(count):
+			ks.pop(0), vs.pop(0)
+			ks.pop(), vs.pop()
+
+	def set_algebra(self, a, b):
+		union, both = [], []
+		for k, group in itertools.groupby(merge(a, b)):
+			union.append(k)
+			if len(list(group)) > 1:
+				both.append(k)
+		diff = [k for k in a if not _contains(b, k)]
+		return union, both, diff
+
+
+def _contains(ks, k):
+	i = bisect_left(ks, k)
+	return i < len(ks) and ks[i] == k
+
+
+IMPLEMENTATIONS = [SortedTable(), DictSorted(), BisectLists()]
+
+
+def operations(impl, n, keys, batch, rng):
+	"""Return a list of (name, count, setup, run) for timing `impl`.
+
+	`keys` are 2n distinct sorted keys: the table holds the n at even indices,
+	and those at odd indices fall between them. `setup()`, untimed, returns
+	the arguments for `run`, timed, which does `count` operations.
+	"""
+	present, absent = keys[::2], keys[1::2]
+	items = [(k, i) for i, k in enumerate(present)]
+	shuffled = items[:]
+	rng.shuffle(shuffled)
+	m = min(n, batch)
+	hits = rng.sample(present, m)
+	# All but the last absent key have a floor and a ceiling in the table
+	misses = rng.sample(absent[:-1], min(m, n - 1))
+	ranks = [rng.randrange(n) for i in range(m)]
+	width = max(1, m // 100)
+	starts = [rng.randrange(max(1, n - width)) for i in range(max(1, m // width))]
+	bounds = [(present[i], present[min(i + width, n - 1)]) for i in starts]
+	table = impl.build(items)
+	fresh = lambda: (impl.build(items),)
+	other = absent[:n // 2] + present[n // 2:] # Half overlaps the table
+	sets = impl.build_set(present), impl.build_set(other)
+	return [
+		('build_sorted', n, lambda: (items,), impl.build),
+		('build_random', n, lambda: (shuffled,), impl.build),
+		('getitem', m, lambda: (table, hits), impl.getitem),
+		('setitem', len(misses), lambda: fresh() + ([(k, 0) for k in misses],),
+		 impl.setitem),
+		('delitem', m, lambda: fresh() + (hits,), impl.delitem),
+		('floor_ceiling', 2 * len(misses), lambda: (table, misses),
+		 impl.floor_ceiling),
+		('rank_select', len(misses) + m, lambda: (table, misses, ranks),
+		 impl.rank_select),
+		('range', len(bounds) * width, lambda: (table, bounds), impl.range),
+		('popmin_popmax', 2 * (m // 2), lambda: fresh() + (m // 2,),
+		 impl.popmin_popmax),
+		('set_algebra', 3 * n, lambda: sets, impl.set_algebra),
+		('pickle', n, lambda: (table,),
+		 lambda t: pickle.loads(pickle.dumps(t, pickle.HIGHEST_PROTOCOL))),
+	]
+
+
+def best_time(setup, run, repeat):
+	"Return the least seconds `run(*setup())` took in `repeat` tries."
+	best = float('inf')
+	for i in range(repeat):
+		args = setup()
+		start = time.perf_counter()
+		run(*args)
+		best = min(best, time.perf_counter() - start)
+	return best
+
+
+class ArgumentParser(bench_common.ArgumentParser):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, doc=__doc__, seed=0xdeadbeef,
+						 inputs='keys and queries', **kwargs)
+		self.add_argument('--sizes', type=int, nargs='+',
+				default=[10 ** 3, 10 ** 4, 10 ** 5],
+				help='table sizes; up to 10**7 is sensible (default: 10**3 '
+					 '10**4 10**5)')
+		self.add_argument('--keys', nargs='+', choices=sorted(KEY_TYPES),
+				default=sorted(KEY_TYPES), help='key types (default: all)')
+		self.add_argument('--impls', nargs='+', default=None,
+				choices=[impl.name for impl in IMPLEMENTATIONS],
+				help='implementations to time (default: all)')
+		self.add_argument('--ops', nargs='+', default=None,
+				help='operations to time (default: all)')
+		self.add_argument('--batch', type=int, default=10000,
+				help='most operations timed at once for the per-item '
+					 'operations (default: 10000)')
+		self.add_argument('--repeat', type=int, default=3,
+				help='report the best of this many runs (default: 3)')
+
+
+def results(args):
+	"Iterate over the result of each operation the options `args` select."
+	for n, key in itertools.product(args.sizes, args.keys):
+		rng = random.Random('{} {} {}'.format(args.seed, n, key))
+		keys = sorted(KEY_TYPES[key](rng, 2 * n))
+		for impl in IMPLEMENTATIONS:
+			if args.impls and impl.name not in args.impls:
+				continue
+			if impl.hashable_only and key == 'unhashable':
+				continue
+			rng = random.Random('{} {} {} queries'.format(args.seed, n, key))
+			for op, count, setup, run in operations(impl, n, keys,
+													args.batch, rng):
+				# Tiny tables have no keys between others to query
+				if not count or args.ops and op not in args.ops:
+					continue
+				seconds = best_time(setup, run, args.repeat)
+				yield dict(impl=impl.name, key=key, n=n, op=op, count=count,
+						   seconds=seconds, ns_per_op=seconds * 1e9 / count)
+
+
+def main(args):
+	args = ArgumentParser().parse_args(args)
+	bench_common.write_results(results(args), args)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
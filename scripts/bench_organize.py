@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""Benchmark organize.py end to end on synthetic folder fiascos.
+
+Each scenario builds a source tree of versions of one file, using the file
+machinery of test_organize.py, and imports it into a new repository with
+`organize.main` in a forked child process. One JSON object per scenario is
+written by `bench_common` with the files per second, the peak resident set
+sizes of the child and of the git processes it ran, and how many processes it
+started. The trees depend only on the scenario and the random seed.
+"""
+
+import itertools
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+# bench_common lives beside bench_sortedtable.py, a directory up
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_common
+import organize
+import test_organize
+
+
+class FileTimes(test_organize.OrganizeScenario.SetUpFileTimes):
+
+	"Modification times a minute apart, so a million versions stay after 1970"
+
+	time_interval = 60
+
+
+class ArgumentParser(bench_common.ArgumentParser):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, doc=__doc__, seed=test_organize.RANDOM_SEED,
+						 inputs='generated trees', **kwargs)
+		self.add_argument('--versions', type=int, nargs='+', default=[100, 10000],
+				help='numbers of versions to import (default: 100 10000)')
+		self.add_argument('--size', type=int, nargs='+', default=[384],
+				help='file sizes in bytes (default: 384)')
+		self.add_argument('--depth', type=int, nargs='+', default=[0],
+				help='subdirectory depths to spread versions over; depths over '
+					 '0 import with --recurse (default: 0)')
+		self.add_argument('--duplicates', type=float, nargs='+', default=[0.0],
+				help='fractions of versions identical to the one before '
+					 '(default: 0)')
+		self.add_argument('--backend', nargs='+', default=['fast-import'],
+				choices=['fast-import', 'commit'],
+				help="organize.py backends: --fast-import or one 'git commit' "
+					 'per file (default: fast-import)')
+		self.add_argument('--args', default='',
+				help='more options for organize.py, as one string')
+
+
+# Versions are spread over subdirectories this many to a parent.
+FANOUT = 10
+
+def make_tree(root, versions, size, depth, duplicates):
+	"Write `versions` versions of 'doc.txt' under `root` and return their paths."
+	paths = []
+	content = None
+	for i, mtime in enumerate(FileTimes(versions)):
+		dirs = ['d{}'.format(i // FANOUT ** (depth - k) % FANOUT)
+				for k in range(depth)]
+		path = os.path.join(root, *dirs + ['doc v{}.txt'.format(i)])
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		if content is not None and random.random() < duplicates:
+			with open(path, 'xb') as f:
+				f.write(content)
+			os.utime(path, (mtime, mtime))
+		else:
+			test_organize.excl_touch(path, mtime, size)
+			with open(path, 'rb') as f:
+				content = f.read()
+		paths.append(path)
+	return paths
+
+
+def count_spawns():
+	"""Count the processes this process starts from now on, in a list.
+
+	`subprocess` launches programs without `os.fork`, so `subprocess.Popen` is
+	replaced with a subclass counting them, separately from the forks of
+	`multiprocessing` and `concurrent.futures`.
+	"""
+	spawns = [0]
+	class Popen(subprocess.Popen):
+		def __init__(self, *args, **kwargs):
+			spawns[0] += 1
+			super().__init__(*args, **kwargs)
+	subprocess.Popen = Popen
+	os.register_at_fork(after_in_parent=lambda: spawns.__setitem__(0, spawns[0] + 1))
+	return spawns
+
+
+def run_import(argv, conn):
+	"""Run `organize.main(argv)` and send its measurements down `conn`.
+
+	If it raises, send {'traceback': ...} with the formatted traceback instead.
+	"""
+	try:
+		conn.send(measure_import(argv))
+	except BaseException:
+		conn.send({'traceback': traceback.format_exc()})
+	finally:
+		conn.close()
+
+
+def measure_import(argv):
+	"Return the measurements of running `organize.main(argv)`."
+	spawns = count_spawns()
+	# Silence organize.py and the git commands it runs
+	os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+	start = time.perf_counter()
+	try:
+		organize.main(argv)
+	except SystemExit as e:
+		code = e.code
+	else:
+		code = 0
+	seconds = time.perf_counter() - start
+	kb = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss units
+	return {
+		'exit_code': code,
+		'seconds': seconds,
+		'spawns': spawns[0],
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * kb / 2 ** 20,
+		'children_peak_rss_mb':
+			resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * kb / 2 ** 20,
+	}
+
+
+def bench(versions, size, depth, duplicates, backend, extra=(), seed=None):
+	"Return the result of benchmarking one scenario."
+	random.seed(seed)
+	with tempfile.TemporaryDirectory() as source, \
+		 tempfile.TemporaryDirectory() as repo:
+		make_tree(source, versions, size, depth, duplicates)
+		organize.Git(repo).issue_command('init', '--quiet')
+		argv = ['--source', source, '--repo', repo, '--name', 'doc', '--force']
+		argv += ['--recurse'] * (depth > 0)
+		argv += ['--fast-import'] * (backend == 'fast-import')
+		argv += list(extra) + ['bench']
+		parent, child = multiprocessing.Pipe(duplex=False)
+		worker = multiprocessing.get_context('fork').Process(
+			target=run_import, args=(argv, child))
+		worker.start()
+		child.close()
+		result = parent.recv()
+		worker.join()
+		if 'traceback' in result:
+			raise RuntimeError('organize.py failed in the benchmark process:\n'
+							   + result['traceback'])
+		commits = int(organize.Git(repo).issue_command('rev-list', '--count',
+													   'bench'))
+	result.update(versions=versions, size=size, depth=depth,
+				  duplicates=duplicates, backend=backend, args=list(extra),
+				  commits=commits, files_per_second=versions / result['seconds'])
+	return result
+
+
+def main(args):
+	args = ArgumentParser().parse_args(args)
+	scenarios = itertools.product(args.versions, args.size, args.depth,
+								  args.duplicates, args.backend)
+	bench_common.write_results((bench(*scenario, extra=args.args.split(),
+									  seed=args.seed)
+								for scenario in scenarios), args)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
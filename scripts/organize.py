@@ -14,6 +14,21 @@ import time
 import operator
 import contextlib
 import fnmatch
+import concurrent.futures
+import hashlib
+import mmap
+import json
+import re
+import heapq
+import itertools
+import pickle
+import tempfile
+import ctypes
+import ctypes.util
+import select
+import struct
+import math
+import threading
 
 def truepath(path):
 	p = os.path
@@ -47,7 +62,7 @@ class ArgumentParser(argparse.ArgumentParser):
 		super().__init__(*args, description=description, epilog=epilog, **kwargs)
 		self.add_argument('--source', type=self._dir_name,
 				help="source directory (default: '.')", default='.')
-		self.add_argument('--filter',
+		self.add_argument('--filter', default='*',
 				help="file name pattern to search SOURCE for (default: '*')")
 		self.add_argument('--repo', type=self._dir_name,
 				help="destination repository (default: '.')", default='.')
@@ -55,72 +70,251 @@ class ArgumentParser(argparse.ArgumentParser):
 				help="name to use for file in repo (default: first version's)")
 		self.add_argument('--recurse', action='store_true',
 				help='include subdirectories of source directory in file search')
+		self.add_argument('--jobs', type=int,
+				help='number of threads scanning subdirectories with --recurse '
+					 'and of processes hashing files (default: '
+					 "Python's executors' defaults)")
+		self.add_argument('--memory', type=float, metavar='MB',
+				help='sort the files found in about MB megabytes, spilling '
+					 'sorted runs to temporary files, and commit from a merge '
+					 'of the runs (default: sort in memory)')
 		self.add_argument('--force', action='store_true',
 				help="assume answer is 'yes' to all safety prompts")
 		self.add_argument('--verbose', action='store_true',
 				help='verbose mode: say what is happening')
+		self.add_argument('--fast-import', action='store_true',
+				help='stream the commits into one git fast-import process '
+					 'instead of copying and committing each file; the '
+					 'working tree is left alone')
+		self.add_argument('--duplicates', choices=('skip', 'annotate'),
+				default='skip',
+				help='skip a version identical to the one before it or '
+					 'annotate it with an empty commit (default: skip)')
+		self.add_argument('--batch', action='store_true',
+				help='sort the files into families of versions of one file, '
+					 'like "thing v1.txt" and "thing v2.txt", and import each '
+					 'family onto its own branch BRANCH/FAMILY concurrently; '
+					 'implies --fast-import')
+		self.add_argument('--family-pattern', default=FAMILY_PATTERN,
+				help='with --batch, regular expression matching the part of '
+					 "a name's stem that differs between versions (default: "
+					 'version numbers and copy markers)')
+		self.add_argument('--watch', action='store_true',
+				help='after importing, stay running and import new versions '
+					 'as they are written to SOURCE, using Linux inotify; '
+					 'implies --fast-import')
+		self.add_argument('--settle', type=float, default=1.0, metavar='SECONDS',
+				help='with --watch, wait until SOURCE has been quiet this long '
+					 'before importing what changed (default: 1)')
+		self.add_argument('--profile', metavar='FILE',
+				help='write JSON timings of each phase and latency histograms '
+					 "of each git command to FILE, or '-' for standard output")
 		self.add_argument('branch', type=self._new_ref_name,
-				help='branch to create')
+				help='branch to create, or to add versions new since an '
+					 'earlier run to')
+
+
+class FileScanner:
+
+	"""Find the files in a directory to import, with their keys.
+
+	The key defaults to the last-modified time. Hidden files and files whose
+	names don't match the shell pattern `pattern` are skipped as the directory
+	is read. Directory entries from `os.scandir` save separate calls to check
+	whether each path exists and is a file.
+	"""
+
+	def __init__(self, key=None, pattern='*', workers=None):
+		self.key = key
+		self.pattern = pattern
+		self.workers = workers
+
+	def relevant(self, entry):
+		"Return whether a `DirEntry` is a file to keep."
+		name = entry.name
+		return (not name.startswith('.') and fnmatch.fnmatch(name, self.pattern)
+				and entry.is_file())
+
+	def scan_dir(self, path):
+		"""Return the (path, key) pairs of the relevant files in directory `path`.
+
+		Also return a list of the paths of its subdirectories, not following
+		symbolic links. Unreadable directories are skipped, as by `os.walk`.
+		An entry that can't be examined, as when it is removed while the
+		directory is read, is skipped with a warning on standard error.
+		"""
+		files, subdirs = [], []
+		try:
+			entries = os.scandir(path)
+		except OSError:
+			return files, subdirs
+		with entries:
+			for entry in entries:
+				try:
+					if self.relevant(entry):
+						key = (entry.stat().st_mtime if self.key is None
+							   else self.key(entry.path))
+						files.append((entry.path, key))
+					elif entry.is_dir(follow_symlinks=False):
+						subdirs.append(entry.path)
+				except OSError as e:
+					print('Skipping {!r}: {}'.format(entry.path, e.strerror or e),
+						  file=sys.stderr)
+		return files, subdirs
+
+	def scan(self, root):
+		"Iterate over the (path, key) pairs of the relevant files in `root`."
+		return iter(self.scan_dir(root)[0])
+
+
+class RecursiveFileScanner(FileScanner):
+
+	"""Like `FileScanner` but also searching subdirectories, except `ignore`d ones.
+
+	Subdirectories are scanned concurrently by a pool of `workers` threads,
+	hiding the latency of network file systems.
+	"""
+
+	ignore = ('.git',)
+
+	def scan(self, root):
+		with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+			pending = [pool.submit(self.scan_dir, root)]
+			while pending:
+				files, subdirs = pending.pop().result()
+				yield from files
+				pending.extend(pool.submit(self.scan_dir, d) for d in subdirs
+							   if os.path.basename(d) not in self.ignore)
 
 
 class SortedFiles(collections.OrderedDict):
 
-	def __init__(self, root, key=os.path.getmtime):
+	"""Map the paths of the files in `root` to their keys, ordered by key.
+
+	The files are found by a `scanner`, made with `key`, `pattern` and
+	`workers`.
+	"""
+
+	scanner = FileScanner
+
+	def __init__(self, root, key=None, pattern='*', workers=None):
 		self._root = root
-		self._key = key
-		filtered_files = filter(self.relevant, self.listdir(root))
-		files_gen = ((f, key(f)) for f in filtered_files)
-		super().__init__(sorted(files_gen, key=operator.itemgetter(1)))
+		files = self.scanner(key, pattern, workers).scan(root)
+		super().__init__(sorted(files, key=operator.itemgetter(1, 0)))
+
+	@classmethod
+	def stream(cls, root, budget, key=None, pattern='*', workers=None):
+		"""Iterate over the (path, key) pairs `cls(root, ...)` would hold, in order.
+
+		Rather than hold them all, sort them with `external_sort` in about
+		`budget` bytes.
+		"""
+		files = cls.scanner(key, pattern, workers).scan(root)
+		return external_sort(files, operator.itemgetter(1, 0), budget)
 
 	@property
 	def root(self):
 		return self._root
 
-	@staticmethod
-	def relevant(file):
-		p = os.path
-		return (p.exists(file) and p.isfile(file) and not p.basename(file).startswith('.'))
 
-	@staticmethod
-	def listdir(root):
-		return map(functools.partial(os.path.join, root), os.listdir(root))
+# Items are spilled and read back this many to a pickle.
+SPILL_BATCH = 1024
+
+# At most this many runs are kept before they're merged into one.
+MERGE_FANIN = 64
+
+def _spill(run):
+	"Write a sorted list to a temporary file, and return the file rewound."
+	f = tempfile.TemporaryFile()
+	for i in range(0, len(run), SPILL_BATCH):
+		pickle.dump(run[i:i + SPILL_BATCH], f, pickle.HIGHEST_PROTOCOL)
+	f.seek(0)
+	return f
+
+
+def _unspill(f):
+	"Iterate over the items `_spill`ed to `f`."
+	while True:
+		try:
+			batch = pickle.load(f)
+		except EOFError:
+			return
+		yield from batch
+
+
+def _merge_runs(runs, key):
+	"Merge `_spill`ed runs into one, closing them."
+	f = tempfile.TemporaryFile()
+	merged = heapq.merge(*map(_unspill, runs), key=key)
+	for batch in iter(lambda: list(itertools.islice(merged, SPILL_BATCH)), []):
+		pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+	for run in runs:
+		run.close()
+	f.seek(0)
+	return f
+
+
+def external_sort(items, key, budget):
+	"""Iterate over `items` sorted by `key`, holding about `budget` bytes of them.
+
+	Whenever the items read so far reach the budget, as estimated by
+	`sys.getsizeof`, sort them and spill them as a run to a temporary file.
+	Then merge the runs with a heap, reading `SPILL_BATCH` items of each at a
+	time. Like `sorted`, the sort is stable.
+	"""
+	runs, buffer, size = [], [], 0
+	try:
+		for item in items:
+			buffer.append(item)
+			size += sys.getsizeof(item) + sum(map(sys.getsizeof, item)) + 8
+			if size >= budget:
+				buffer.sort(key=key)
+				runs.append(_spill(buffer))
+				buffer, size = [], 0
+				if len(runs) >= MERGE_FANIN:
+					runs = [_merge_runs(runs, key)]
+		buffer.sort(key=key)
+		# Earlier runs go first so equal items keep their order
+		yield from heapq.merge(*[_unspill(run) for run in runs] + [buffer],
+							   key=key)
+	finally:
+		for run in runs:
+			run.close()
 
 
 class RecursiveSortedFiles(SortedFiles):
 
-	def listdir(self, start, ignore=('.git',)):
-		root, normpath, join = self.root, os.path.normpath, os.path.join
-		for parent, children, files in os.walk(join(root, start)):
-			for baddir in ignore:
-				if baddir in children:
-					children.remove(baddir)
-			for items in children, files:
-				for item in items:
-					yield normpath(join(root, start, parent, item))
+	"Like `SortedFiles` but also searching subdirectories, except `ignore`d ones."
+
+	scanner = RecursiveFileScanner
+	ignore = scanner.ignore
 
 
 class Git:
 
+	"""Run Git commands in the repository `repo`.
+
+	Commands run with the repository as their working directory rather than
+	changing the process's, so threads may share a `Git`.
+	"""
+
 	def __init__(self, repo):
 		self.repo = os.path.abspath(repo)
+		self._git_dir = None
+		self._vars = {}
+		self.profile = Profile(enabled=False)
 
-	@contextlib.contextmanager
-	def cd(self, dir=None):
-		if dir is None:
-			dir = self.repo
-		oldcwd = os.getcwd()
-		os.chdir(dir)
-		yield self.repo
-		os.chdir(oldcwd)
+	def _run(self, run, args, **kwargs):
+		"Call `subprocess` function `run` with `args` in the repository, timed."
+		with self.profile.command(os.fsdecode(args[1])):
+			return run(args, cwd=self.repo, **kwargs)
 
 	def init(self):
-		with self.cd():
-			subprocess.check_call(['git', 'init'])
+		self._run(subprocess.check_call, ['git', 'init'])
 
 	@property
 	def branches(self):
-		with self.cd():
-			stdout = subprocess.check_output(['git', 'branch', '-a'])
+		stdout = self._run(subprocess.check_output, ['git', 'branch', '-a'])
 		return stdout.decode(sys.getfilesystemencoding()).split('\n')
 
 	@classmethod
@@ -137,27 +331,73 @@ class Git:
 		return normalized
 
 	def was_modified(self, file):
-		with self.cd():
-			status = subprocess.check_output('git status --porcelain'.split())
-			return file.encode(sys.getfilesystemencoding()) in status
+		status = self._run(subprocess.check_output,
+						   'git status --porcelain'.split())
+		return file.encode(sys.getfilesystemencoding()) in status
+
+	def checkout_branch(self, branch, create=True):
+		"Check out `branch`, creating it from HEAD if `create` is true."
+		args = ['git', 'checkout'] + ['-b'] * create + [branch]
+		return self._run(subprocess.check_call, args)
 
-	def checkout_branch(self, branch):
-		with self.cd():
-			return subprocess.check_call(['git', 'checkout', '-b', branch])
+	def branch_exists(self, branch):
+		try:
+			self.issue_command('rev-parse', '--quiet', '--verify',
+							   b'refs/heads/' + os.fsencode(branch))
+		except subprocess.CalledProcessError:
+			return False
+		return True
+
+	@property
+	def git_dir(self):
+		"The absolute path of the repository's Git directory, usually .git."
+		if self._git_dir is None:
+			path = self.issue_command('rev-parse', '--git-dir').strip()
+			self._git_dir = os.path.join(self.repo, os.fsdecode(path))
+		return self._git_dir
 
-	def commit_file(self, file, message, date=None):
-		args = ['git', 'commit', '--message="' + message + '"']
+	def var(self, name):
+		"Return the value of Git logical variable `name`, asked for only once."
+		if name not in self._vars:
+			self._vars[name] = self.issue_command('var', name).strip()
+		return self._vars[name]
+
+	def manifest(self, branch):
+		"Return the `Manifest` of the versions imported onto `branch`."
+		return Manifest(os.path.join(self.git_dir, 'organize',
+									 os.fsdecode(branch)))
+
+	def commit_file(self, file, message, date=None, allow_empty=False):
+		"""Stage and commit `file`, and return whether a commit was made.
+
+		Unless `allow_empty` is true, nothing is committed when `file` is
+		unchanged since the last commit, as when that commit was made by a
+		run interrupted before it could record it.
+		"""
+		# Arguments don't pass through a shell, so they take no quotes
+		args = ['git', 'commit', '--message=' + message]
 		if date:
-			args.extend(['--date="{!s}"'.format(date)])
+			args.append('--date={!s}'.format(date))
+		if allow_empty:
+			args.append('--allow-empty')
 		# XXX Make sure nothing else is staged. Get a lock if possible?
-		with self.cd():
-			subprocess.check_call(['git', 'add', file])
-			subprocess.check_call(args)
+		self._run(subprocess.check_call, ['git', 'add', file])
+		if not allow_empty and not self._run(subprocess.call,
+				['git', 'diff', '--cached', '--quiet']):
+			return False
+		self._run(subprocess.check_call, args)
+		return True
+
+	def fast_import(self, branch, append=False):
+		"""Return a `FastImport` stream that writes commits onto `branch`.
+
+		The branch must be new unless `append` is true, when it must exist.
+		"""
+		return FastImport(self, branch, append)
 
 	def issue_command(self, *args):
 		args = list(args)
-		with self.cd():
-			return subprocess.check_output(['git'] + args)
+		return self._run(subprocess.check_output, ['git'] + args)
 
 	def datetime_from_timestamp(self, timestamp):
 		"Convert local time in seconds since epoch to a RFC-2822-compliant time stamp"
@@ -165,22 +405,774 @@ class Git:
 		return time.strftime("%a, %d %b %Y %H:%M:%S %z", time.localtime(timestamp))
 
 
+# `FastImport` copies a file's contents into its blob this many bytes at a time.
+BLOB_CHUNK = 1 << 20
+
+class FastImport:
+
+	"""Stream files as commits to a branch through `git fast-import`.
+
+	Use as a context manager. Each call to `commit_file` sends the file's
+	contents and a commit record to one long-running `git fast-import`
+	process, which writes objects straight into the repository without
+	touching the working tree or the index. Like `git checkout -b`, the new
+	branch starts from HEAD, if there is one, and must not already exist,
+	unless `append` is true, when commits go on the end of an existing branch.
+	If the `with` block raises, the branch is left as of the last `checkpoint`,
+	or not created at all.
+	"""
+
+	def __init__(self, git, branch, append=False):
+		self.git = git
+		self.ref = 'refs/heads/' + os.fsdecode(branch)
+		self.append = append
+		self.process = None
+		self.blobs = 0 # Number of blobs sent, each marked with its number
+		self.marks = {} # Blob marks by content digest
+
+	def __enter__(self):
+		git = self.git
+		branch = self.ref[11:]
+		if git.branch_exists(branch) != self.append:
+			raise ValueError('branch {!r} {}'.format(branch, 'does not exist'
+								if self.append else 'already exists'))
+		try:
+			self.parent = git.issue_command('rev-parse', '--quiet', '--verify',
+				(self.ref if self.append else 'HEAD') + '^{commit}').strip()
+		except subprocess.CalledProcessError:
+			self.parent = None # HEAD is unborn: make a root commit
+		self.author = self._ident('GIT_AUTHOR_IDENT')
+		self.committer = git.var('GIT_COMMITTER_IDENT')
+		# With --done, a stream cut short aborts rather than updating the branch
+		self.process = subprocess.Popen(
+				['git', 'fast-import', '--quiet', '--done'],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=git.repo)
+		self.stream = self.process.stdin
+		return self
+
+	def _ident(self, var):
+		"Return the name and email, without the date, of `git var`'s `var`."
+		ident = self.git.var(var)
+		return ident[:ident.rindex(b'>') + 1]
+
+	def commit_file(self, file, name, message, timestamp, digest=None):
+		"""Commit the contents of `file` as `name`, authored at `timestamp`.
+
+		`timestamp` is in seconds since the epoch and is written with the
+		local time zone's offset at that time. Contents are sent once per
+		`digest`: later files with a digest already seen reuse that blob.
+		"""
+		profile = self.git.profile
+		with profile.phase('fast-import', files=1):
+			mark = self.marks.get(digest)
+			if mark is None:
+				self.blobs += 1
+				mark = self.blobs
+				with open(file, 'rb') as f:
+					size = self.blob(f, mark)
+				profile.count('fast-import', bytes=size)
+				if digest is not None:
+					self.marks[digest] = mark
+			self.commit(message, timestamp, b'M 100644 :' + str(mark).encode() +
+						b' ' + self.quote(name) + b'\n')
+
+	def blob(self, f, mark):
+		"""Send the contents of the open file `f` as blob `mark`, and their size.
+
+		The size is known up front, so the contents are copied `BLOB_CHUNK`
+		bytes at a time rather than read whole. Raise OSError if the file
+		shrinks meanwhile.
+		"""
+		size = os.fstat(f.fileno()).st_size
+		write = self.stream.write
+		write(b'blob\nmark :' + str(mark).encode() + b'\n')
+		write(b'data ' + str(size).encode() + b'\n')
+		left = size
+		while left:
+			chunk = f.read(min(left, BLOB_CHUNK))
+			if not chunk:
+				raise OSError('{!r} shrank while being imported'.format(f.name))
+			write(chunk)
+			left -= len(chunk)
+		write(b'\n')
+		return size
+
+	def commit(self, message, timestamp, changes=b''):
+		"""Commit the fast-import file commands `changes` with `message`.
+
+		With no `changes`, the commit is empty, its tree its parent's.
+		"""
+		message = message.encode('utf-8')
+		when = '{:d} {}'.format(int(timestamp),
+								time.strftime('%z', time.localtime(timestamp)))
+		write = self.stream.write
+		write(b'commit ' + self.ref.encode() + b'\n')
+		write(b'author ' + self.author + b' ' + when.encode() + b'\n')
+		write(b'committer ' + self.committer + b'\n')
+		write(b'data ' + str(len(message)).encode() + b'\n' + message + b'\n')
+		if self.parent is not None:
+			write(b'from ' + self.parent + b'\n')
+			self.parent = None
+		write(changes)
+
+	def checkpoint(self):
+		"""Have fast-import write out everything so far and update the branch.
+
+		Block until it has, so the commits sent so far survive an interruption.
+		"""
+		with self.git.profile.command('fast-import checkpoint'):
+			self.stream.write(b'checkpoint\nprogress checkpoint\n')
+			self.stream.flush()
+			line = self.process.stdout.readline()
+		if not line:
+			raise subprocess.CalledProcessError(self.process.wait(),
+												'git fast-import')
+
+	@staticmethod
+	def quote(path):
+		"Quote `path` C-style as fast-import paths may be."
+		path = os.fsencode(path).replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+		return b'"' + path.replace(b'\n', b'\\n') + b'"'
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.stream.write(b'done\n')
+		# Time how long fast-import takes to finish once it has everything
+		with self.git.profile.command('fast-import'):
+			self.stream.close()
+			self.process.stdout.close()
+			returncode = self.process.wait()
+		if returncode and exc_type is None:
+			raise subprocess.CalledProcessError(returncode, 'git fast-import')
+
+
+class Profile:
+
+	"""Time the phases of an import and the git commands it runs, for --profile.
+
+	A phase's seconds exclude those of phases nested within it in the same
+	thread, so the phases' seconds add up to no more than the wall time. Each
+	git command is a phase named 'git COMMAND' whose latencies are also
+	counted in a histogram of powers of two milliseconds. A profile that is
+	not `enabled` records nothing, at the cost of a method call.
+	"""
+
+	_null = contextlib.nullcontext()
+
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.start = time.perf_counter()
+		self.phases = {} # [seconds, calls, files, bytes] by name
+		self.latencies = {} # Histogram, as counts by bin, by phase name
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	@contextlib.contextmanager
+	def _time(self, name, files=0, command=False):
+		stack = self._local.__dict__.setdefault('stack', [])
+		stack.append(0.0) # Seconds spent in nested phases
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - start
+			nested = stack.pop()
+			if stack:
+				stack[-1] += elapsed
+			with self._lock:
+				phase = self.phases.setdefault(name, [0.0, 0, 0, 0])
+				phase[0] += elapsed - nested
+				phase[1] += 1
+				phase[2] += files
+				if command:
+					ms = elapsed * 1000
+					bin = 2 ** math.ceil(math.log2(ms)) if ms > 1 else 1
+					histogram = self.latencies.setdefault(name, {})
+					histogram[bin] = histogram.get(bin, 0) + 1
+
+	def phase(self, name, files=0):
+		"Return a context manager timing a call of `name`, handling `files`."
+		return self._time(name, files) if self.enabled else self._null
+
+	def command(self, command):
+		"Return a context manager timing git command `command`."
+		if not self.enabled:
+			return self._null
+		return self._time('git ' + command, command=True)
+
+	def count(self, name, files=0, bytes=0):
+		"Add `files` and `bytes` to the totals of phase `name`."
+		if self.enabled:
+			with self._lock:
+				phase = self.phases.setdefault(name, [0.0, 0, 0, 0])
+				phase[2] += files
+				phase[3] += bytes
+
+	def timed(self, name, iterable):
+		"Iterate over `iterable`, timing each item produced as a file of `name`."
+		if not self.enabled:
+			return iterable
+		return self._timed(name, iter(iterable))
+
+	def _timed(self, name, it):
+		while True:
+			with self._time(name):
+				try:
+					item = next(it)
+				except StopIteration:
+					return
+			self.count(name, files=1)
+			yield item
+
+	def report(self):
+		"Return the profile so far as a dict, ready for `json.dump`."
+		phases = {}
+		with self._lock:
+			for name, (seconds, calls, files, bytes) in self.phases.items():
+				phases[name] = phase = {'seconds': seconds, 'calls': calls,
+										'files': files, 'bytes': bytes}
+				if seconds:
+					phase['files_per_second'] = files / seconds
+					phase['bytes_per_second'] = bytes / seconds
+				if name in self.latencies:
+					phase['latency_ms'] = sorted(self.latencies[name].items())
+		return {'wall_seconds': time.perf_counter() - self.start,
+				'phases': phases}
+
+	def dump(self, path):
+		"Write the `report` as JSON to the file `path`, or '-' for stdout."
+		report = json.dumps(self.report(), indent=2, sort_keys=True)
+		if path == '-':
+			print(report)
+		else:
+			with open(path, 'w') as f:
+				f.write(report + '\n')
+
+
+class Manifest:
+
+	"""The versions of source files already imported onto a branch.
+
+	The manifest lives in the repository's Git directory. Each line is a JSON
+	array of a version's path, size, modification time, and digest, appended
+	once the version is safely on the branch, so a later run can pick up
+	where an earlier one stopped. A line cut short by an interruption is
+	ignored.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.versions = {} # (size, mtime, digest) by path
+		self.last = None # Digest of the last version recorded
+		self.torn = False # Whether the last line lacks its newline
+
+	@property
+	def exists(self):
+		return os.path.exists(self.path)
+
+	def load(self):
+		"Read the manifest's versions, and return self."
+		with open(self.path, encoding='utf-8') as f:
+			for line in f:
+				self.torn = not line.endswith('\n')
+				try:
+					path, size, mtime, digest = json.loads(line)
+				except ValueError:
+					continue
+				self.versions[path] = size, mtime, digest
+				self.last = digest
+		return self
+
+	def clear(self):
+		"Forget all versions, as when their branch is gone."
+		with contextlib.suppress(FileNotFoundError):
+			os.remove(self.path)
+		self.versions.clear()
+		self.last = None
+		self.torn = False
+
+	def imported(self, path, mtime):
+		"Return whether the file at `path`, modified at `mtime`, is recorded."
+		version = self.versions.get(path)
+		return (version is not None and version[1] == mtime and
+				version[0] == os.stat(path).st_size)
+
+	def record(self, versions):
+		"Append (path, mtime, digest) triples for versions now on the branch."
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		with open(self.path, 'a', encoding='utf-8') as f:
+			if self.torn:
+				f.write('\n')
+				self.torn = False
+			for path, mtime, digest in versions:
+				size = os.stat(path).st_size
+				f.write(json.dumps([path, size, mtime, digest]) + '\n')
+				self.versions[path] = size, mtime, digest
+				self.last = digest
+
+
 def copy_ext(old, new):
 	"Give new the same file extension that old had"
 	root, ext = os.path.splitext(old)
 	return new + ext
 
 
+# Files at least this large are hashed through a memory map instead of being
+# read into a bytes object first.
+MMAP_THRESHOLD = 1 << 20
+
+def file_digest(path):
+	"Return the Git blob id, a SHA-1 hex digest, of the contents of `path`."
+	with open(path, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		h = hashlib.sha1(b'blob ' + str(size).encode() + b'\0')
+		if size >= MMAP_THRESHOLD:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+				h.update(m)
+		else:
+			h.update(f.read())
+	return h.hexdigest()
+
+
+# `iter_digests` hashes this many files at a time.
+HASH_BATCH = 1024
+
+def iter_digests(paths, workers=None):
+	"""Iterate over the `file_digest`s of `paths`, like `hash_files`.
+
+	Take the paths `HASH_BATCH` at a time, hashing the next batch while the
+	caller consumes the one before, so the paths may be an endless stream.
+	"""
+	paths = iter(paths)
+	batches = iter(lambda: list(itertools.islice(paths, HASH_BATCH)), [])
+	first = next(batches, [])
+	if workers == 1 or len(first) < 2:
+		yield from map(file_digest, first)
+		yield from map(file_digest, itertools.chain.from_iterable(batches))
+		return
+	with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+		chunksize = max(1, HASH_BATCH // (4 * (workers or os.cpu_count() or 1)))
+		pending = pool.map(file_digest, first, chunksize=chunksize)
+		for batch in batches:
+			done, pending = pending, pool.map(file_digest, batch,
+											  chunksize=chunksize)
+			yield from done
+		yield from pending
+
+
+def hash_files(paths, workers=None):
+	"Return the `file_digest`s of `paths`, hashed by a pool of `workers` processes."
+	paths = list(paths)
+	if workers == 1 or len(paths) < 2:
+		return list(map(file_digest, paths))
+	with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+		chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+		return list(pool.map(file_digest, paths, chunksize=chunksize))
+
+
+def versions(ls, workers=None, last=None, digests=None, profile=None):
+	"""Iterate over (file, timestamp, digest, original) for the (file,
+	timestamp) pairs of the iterable `ls`.
+
+	`original` is None unless `file` is byte-identical to the version before
+	it, in which case it is the first file of that run of identical versions,
+	or 'the last version' if the run began with an earlier import, which
+	left the digest `last`. Files are hashed as they stream past unless
+	`digests` maps them to their digests already, timed by `profile`.
+	"""
+	original = 'the last version'
+	ls, files = itertools.tee(ls)
+	files = map(operator.itemgetter(0), files)
+	if digests is None:
+		hashes = iter_digests(files, workers)
+		if profile is not None:
+			hashes = profile.timed('hash', hashes)
+	else:
+		hashes = map(digests.__getitem__, files)
+	for (file, timestamp), digest in zip(ls, hashes):
+		if digest == last:
+			yield file, timestamp, digest, original
+		else:
+			yield file, timestamp, digest, None
+			original, last = file, digest
+
+
+def duplicate_message(file, original):
+	"Return the message annotating that `file` is a copy of `original`."
+	return 'Note {!r} is identical to {!r}.'.format(os.path.basename(file),
+													os.path.basename(original))
+
+
+# The fast-import backend checkpoints after this many versions, recording
+# them in the manifest, so at most this many are redone after an interruption.
+CHECKPOINT_INTERVAL = 1000
+
+def import_files(ls, name, args, stream, manifest, digests=None):
+	"""Commit the (file, timestamp) pairs of `ls` as `name` to a `FastImport` stream.
+
+	Record them in `manifest` at each checkpoint. Return the number of files
+	committed and the versions sent since the last checkpoint.
+	"""
+	count = 0
+	done = []
+	family = name
+	for file, timestamp, digest, original in versions(ls, args.jobs,
+			manifest.last, digests, stream.git.profile):
+		name = copy_ext(file, family)
+		if original is not None:
+			if args.verbose:
+				print('Skipping {!r}, identical to {!r}'.format(file, original))
+			if args.duplicates == 'annotate':
+				stream.commit(duplicate_message(file, original), timestamp)
+		else:
+			if args.verbose:
+				print('Importing {!r} as {!r}'.format(file, name))
+			msg = 'Auto-add {!r} as {!r}.'.format(os.path.basename(file), name)
+			stream.commit_file(file, name, msg, timestamp, digest)
+			count += 1
+		done.append((file, timestamp, digest))
+		if len(done) >= CHECKPOINT_INTERVAL:
+			stream.checkpoint()
+			with stream.git.profile.phase('manifest', files=len(done)):
+				manifest.record(done)
+			done = []
+	return count, done
+
+
+def prepare(git, branch, ls, manifests=None):
+	"""Return the manifest of `branch`, whether it exists, and the new files.
+
+	The new files are the (file, timestamp) pairs of `ls` not yet imported
+	onto an existing branch, filtered lazily. Raise ValueError if the branch
+	exists but has no manifest. A dict `manifests` keeps the manifests by
+	branch, so each is read from its file only the first time.
+	"""
+	manifest = None if manifests is None else manifests.get(branch)
+	loaded = manifest is not None
+	if not loaded:
+		manifest = git.manifest(branch)
+		if manifests is not None:
+			manifests[branch] = manifest
+	append = git.branch_exists(branch)
+	if append:
+		if not manifest.exists:
+			raise ValueError('branch {!r} exists but has no import '
+							 'manifest'.format(os.fsdecode(branch)))
+		if not loaded:
+			manifest.load()
+		ls = ((file, timestamp) for file, timestamp in ls
+			  if not manifest.imported(file, timestamp))
+	else:
+		manifest.clear()
+	return manifest, append, ls
+
+
+def import_branch(git, branch, name, ls, args, manifest, append, digests=None):
+	"Import the files `prepare`d for `branch` as `name` through fast-import."
+	with git.fast_import(branch, append) as stream:
+		count, done = import_files(ls, name, args, stream, manifest, digests)
+	with git.profile.phase('manifest', files=len(done)):
+		manifest.record(done)
+	return count
+
+
+# Matches the end of a file name's stem that differs between versions: one or
+# more version numbers like ' v2' or '_version 1.3' and copy markers like
+# ' copy', ' (copy 2)' or '(1)'.
+FAMILY_PATTERN = (r'(?:[\s_-]+v(?:ersion)?[\s_-]*\d+(?:\.\d+)*'
+				  r'|[\s_-]*\(\s*(?:copy(?:\s*\d+)?|\d+)\s*\)'
+				  r'|[\s_-]+copy(?:[\s_-]*\d+)?)+$')
+
+def family_name(path, pattern=FAMILY_PATTERN):
+	"""Return the name the versions of the file at `path` share.
+
+	That is its file name without the match, ignoring case, of the regular
+	expression `pattern` at the end of its stem, so 'thing v1.txt' and
+	'thing (copy).txt' are both versions of 'thing.txt'.
+	"""
+	stem, ext = os.path.splitext(os.path.basename(path))
+	return (re.sub(pattern, '', stem, flags=re.IGNORECASE) or stem) + ext
+
+
+def families(ls, pattern=FAMILY_PATTERN):
+	"Group the (file, timestamp) pairs of `ls`, in order, by `family_name`."
+	groups = collections.OrderedDict()
+	for file, timestamp in ls:
+		name = family_name(file, pattern)
+		groups.setdefault(name, collections.OrderedDict())[file] = timestamp
+	return groups
+
+
+def family_branch(prefix, name):
+	"Return the branch `prefix`/`name`, replacing what Git forbids in `name`."
+	part = re.sub(r'\.{2,}', '.', re.sub(r'[^\w.+-]+', '-', name))
+	part = re.sub(r'\.lock$', '', part.strip('.-')) or 'unnamed'
+	return Git.validate_branch_name(os.fsdecode(prefix) + '/' + part)
+
+
+def import_families(git, ls, args, manifests=None):
+	"""Import each family of the files of `ls` onto its own branch.
+
+	Hash every new version in one process pool, then stream the families
+	through concurrent fast-import processes. Return the numbers of files
+	imported and of branches imported onto, and a list of error messages.
+	`manifests` is passed on to `prepare`.
+	"""
+	jobs, errors = [], []
+	for name, files in families(ls, args.family_pattern).items():
+		branch = family_branch(args.branch, name)
+		try:
+			# Versions keep their extensions, as without --batch
+			stem = os.path.splitext(name)[0]
+			manifest, append, files = prepare(git, branch, files.items(),
+											  manifests)
+			jobs.append((branch, stem, manifest, append, list(files)))
+		except ValueError as e:
+			errors.append(str(e))
+	new = [file for job in jobs for file, timestamp in job[-1]]
+	with git.profile.phase('hash', files=len(new)):
+		digests = dict(zip(new, hash_files(new, args.jobs)))
+	with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+		counts = [pool.submit(import_branch, git, branch, name, files, args,
+							  manifest, append, digests)
+				  for branch, name, manifest, append, files in jobs]
+		return sum(f.result() for f in counts), len(jobs), errors
+
+
+class Inotify:
+
+	"""Watch directories for files written or moved into them, using inotify.
+
+	Use as a context manager. Linux's inotify is called through `ctypes`, so
+	this needs nothing beyond Linux's C library.
+	"""
+
+	# From <sys/inotify.h>
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_Q_OVERFLOW = 0x4000
+	IN_IGNORED = 0x8000
+	IN_ISDIR = 0x40000000
+	MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+	_header = struct.Struct('iIII') # wd, mask, cookie, len
+
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		if not hasattr(libc, 'inotify_init1'):
+			raise OSError('inotify is not available on this system')
+		self._add_watch = libc.inotify_add_watch
+		self.fd = libc.inotify_init1(os.O_CLOEXEC)
+		if self.fd < 0:
+			self._raise('inotify_init1')
+		self.dirs = {} # Watched directories by watch descriptor
+
+	@staticmethod
+	def _raise(name):
+		errno = ctypes.get_errno()
+		raise OSError(errno, os.strerror(errno), name)
+
+	def add_watch(self, path):
+		"Watch the directory `path`."
+		wd = self._add_watch(self.fd, os.fsencode(path), self.MASK)
+		if wd < 0:
+			self._raise(path)
+		self.dirs[wd] = path
+
+	def read(self, timeout=None):
+		"""Return a list of (path, mask) events, or [] after `timeout` seconds.
+
+		The path is None when the kernel's queue overflowed and events were
+		lost.
+		"""
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		data = os.read(self.fd, 1 << 16)
+		events = []
+		i = 0
+		while i < len(data):
+			wd, mask, cookie, size = self._header.unpack_from(data, i)
+			i += self._header.size
+			name = os.fsdecode(data[i:i + size].rstrip(b'\0'))
+			i += size
+			if mask & self.IN_Q_OVERFLOW:
+				events.append((None, mask))
+			elif mask & self.IN_IGNORED:
+				self.dirs.pop(wd, None)
+			elif wd in self.dirs:
+				events.append((os.path.join(self.dirs[wd], name), mask))
+		return events
+
+	def bursts(self, settle, limit=None, stop=None):
+		"""Iterate over lists of events, each a burst coalesced from `read`.
+
+		A burst ends once `settle` seconds pass without events, or `limit`
+		seconds after it began. While idle, check every `settle` seconds
+		whether the `threading.Event` `stop` is set, and if so return.
+		"""
+		while stop is None or not stop.is_set():
+			events = self.read(settle)
+			start = time.monotonic()
+			while events:
+				more = self.read(settle)
+				events += more
+				if not more or limit and time.monotonic() - start >= limit:
+					yield events
+					break
+
+	def close(self):
+		os.close(self.fd)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+# A --watch burst is imported at most this many seconds after it began, even
+# if the source directory has not settled.
+BURST_LIMIT = 30
+
+def import_new(git, ls, args, manifests=None):
+	"""Import the (file, timestamp) pairs of `ls` for --watch.
+
+	Import onto a branch per family with --batch, otherwise onto BRANCH.
+	Return the number of files imported and a list of error messages.
+	`manifests` is passed on to `prepare`.
+	"""
+	if args.batch:
+		count, branches, errors = import_families(git, ls, args, manifests)
+		return count, errors
+	ls = list(ls)
+	if not ls:
+		return 0, []
+	if args.name is None:
+		args.name = os.path.basename(ls[0][0])
+	try:
+		manifest, append, ls = prepare(git, args.branch, ls, manifests)
+	except ValueError as e:
+		return 0, [str(e)]
+	return import_branch(git, args.branch, args.name, ls, args, manifest,
+						 append), []
+
+
+def watch(git, args, stop=None):
+	"""Import the files in `args.source`, then new versions as they appear.
+
+	Watch the source directory, and with --recurse its subdirectories, for
+	files closed after writing or moved in. Coalesce each burst of events
+	with `Inotify.bursts` and import its new versions in one fast-import run.
+	The manifests are read once and then kept up to date in memory. Run until
+	interrupted or until the `threading.Event` `stop` is set.
+	"""
+	kind = RecursiveSortedFiles if args.recurse else SortedFiles
+	manifests = {}
+	def add_watches(root):
+		inotify.add_watch(root)
+		if args.recurse:
+			for dir, subdirs, files in os.walk(root):
+				subdirs[:] = [d for d in subdirs if d not in kind.ignore]
+				for d in subdirs:
+					inotify.add_watch(os.path.join(dir, d))
+	def report(count, errors):
+		if count:
+			print('Imported', count, 'file' + 's' * (count != 1) + '.')
+		for error in errors:
+			print(error, file=sys.stderr)
+	with Inotify() as inotify:
+		# Watch before listing so nothing written meanwhile is missed
+		add_watches(args.source)
+		with git.profile.phase('scan'):
+			ls = kind(args.source, pattern=args.filter, workers=args.jobs)
+		git.profile.count('scan', files=len(ls))
+		count, errors = import_new(git, ls.items(), args, manifests)
+		if errors:
+			raise ValueError('; '.join(errors))
+		report(count, errors)
+		for events in inotify.bursts(args.settle, BURST_LIMIT, stop):
+			files = set()
+			for path, mask in events:
+				if path is None: # Events were lost: check everything
+					files.update(kind(args.source, pattern=args.filter,
+									  workers=args.jobs))
+				elif mask & Inotify.IN_ISDIR:
+					if args.recurse and os.path.basename(path) not in kind.ignore:
+						with contextlib.suppress(OSError):
+							add_watches(path)
+						files.update(kind(path, pattern=args.filter))
+				elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+					# Files just created may still be being written
+					name = os.path.basename(path)
+					if (not name.startswith('.') and
+						fnmatch.fnmatch(name, args.filter)):
+						files.add(path)
+			ls = []
+			for file in files:
+				with contextlib.suppress(OSError):
+					if os.path.isfile(file):
+						ls.append((file, os.stat(file).st_mtime))
+			ls.sort(key=operator.itemgetter(1, 0))
+			report(*import_new(git, ls, args, manifests))
+
+
 def main(args):
 	parser = ArgumentParser()
 	args = parser.parse_args(args)
 	git = Git(args.repo)
-	if args.recurse:
-		ls = RecursiveSortedFiles(args.source)
+	if args.profile is None:
+		return run(parser, args, git)
+	git.profile = Profile()
+	try:
+		run(parser, args, git)
+	finally:
+		git.profile.dump(args.profile)
+
+
+def run(parser, args, git):
+	"Do what `main` was asked to."
+	if args.watch:
+		try:
+			watch(git, args)
+		except ValueError as e:
+			parser.error(str(e))
+		except KeyboardInterrupt:
+			pass
+		parser.exit()
+	kind = RecursiveSortedFiles if args.recurse else SortedFiles
+	if args.memory is None:
+		with git.profile.phase('scan'):
+			ls = kind(args.source, pattern=args.filter, workers=args.jobs)
+		git.profile.count('scan', files=len(ls))
+		ls = ls.items()
 	else:
-		ls = SortedFiles(args.source)
+		ls = git.profile.timed('scan', kind.stream(args.source,
+			args.memory * 2 ** 20, pattern=args.filter, workers=args.jobs))
+	if args.batch:
+		count, branches, errors = import_families(git, ls, args)
+		print('Imported', count, 'file' + 's' * (count != 1), 'onto', branches,
+			  'branch' + 'es' * (branches != 1) + '.')
+		if errors:
+			parser.error('; '.join(errors))
+		parser.exit()
 	if args.name is None:
-		args.name = os.path.basename(next(iter(ls)))
+		ls = iter(ls)
+		first = next(ls, None)
+		if first is None:
+			parser.error('no files to import in ' + args.source)
+		args.name = os.path.basename(first[0])
+		ls = itertools.chain([first], ls)
+	# Continue an earlier import onto the branch, if any
+	try:
+		manifest, append, ls = prepare(git, args.branch, ls)
+	except ValueError as e:
+		parser.error(str(e))
+	if args.fast_import:
+		count = import_branch(git, args.branch, args.name, ls, args, manifest,
+							  append)
+		print('Imported', count, 'file' + 's' * (count != 1) + '.')
+		parser.exit()
 	# Find out if the file's been modified
 	if git.was_modified(args.name):
 		if not args.force:
@@ -188,20 +1180,33 @@ def main(args):
 			if resp.lower() not in ['y', 'yes', 'ok', 'okay', '1']:
 				parser.error(args.name + ' modified in working tree.')
 				assert False, 'NOTREACHED'
-	# Create the branch
-	git.checkout_branch(args.branch)
+	# Create the branch, or go back to it
+	git.checkout_branch(args.branch, create=not append)
 	count = 0
-	for file, timestamp in ls.items():
-		if not fnmatch.fnmatch(os.path.basename(file), args.filter):
-			continue
+	for file, timestamp, digest, original in versions(ls, args.jobs,
+			manifest.last, profile=git.profile):
 		name = copy_ext(file, args.name)
-		if args.verbose:
-			print('Copying {!r} to {!r}'.format(file, name))
-		shutil.copy2(file, os.path.join(args.repo, name))
-		msg = 'Auto-add {!r} as {!r}.'.format(os.path.basename(file), name)
 		date = git.datetime_from_timestamp(timestamp)
-		git.commit_file(name, msg, date)
-		count += 1
+		if original is not None:
+			if args.verbose:
+				print('Skipping {!r}, identical to {!r}'.format(file, original))
+			if args.duplicates == 'annotate':
+				git.commit_file(name, duplicate_message(file, original), date,
+								allow_empty=True)
+		else:
+			if args.verbose:
+				print('Copying {!r} to {!r}'.format(file, name))
+			with git.profile.phase('copy', files=1):
+				shutil.copy2(file, os.path.join(args.repo, name))
+			git.profile.count('copy', bytes=os.path.getsize(file))
+			msg = 'Auto-add {!r} as {!r}.'.format(os.path.basename(file), name)
+			# Unchanged if committed by a run interrupted before recording it
+			if git.commit_file(name, msg, date):
+				count += 1
+			elif args.verbose:
+				print('Recording {!r}, already committed'.format(file))
+		with git.profile.phase('manifest', files=1):
+			manifest.record([(file, timestamp, digest)])
 	print('Copied', count, 'file' + 's' * (count != 1) + '.')
 
 	parser.exit()
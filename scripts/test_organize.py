@@ -9,12 +9,36 @@ import organize
 import random
 import itertools
 import collections
+import subprocess
+import sys
+import threading
+import json
+import io
+import contextlib
 
 RANDOM_SEED = 0xdeadbeef
 
 def setUpModule():
 	random.seed(RANDOM_SEED)
 
+def excl_touch(path, time=None, size=None):
+	"""Safely write a random file, optionally setting access and modification times.
+
+	`path` must be an absolute path. `time`, if specified, is an int or
+	float in seconds. `size`, if specified, is the file's length in bytes.
+	"""
+	if not os.path.isabs(path):
+		raise ValueError('Expected absolute path but got %r' % path)
+	if size is None:
+		file_len = random.randint(0x100,  0x1ff)
+		file_content = bytes([random.randint(0, 0xff) for i in range(file_len)])
+	else:
+		file_content = random.getrandbits(8 * size).to_bytes(size, 'little')
+	with open(path, 'xb') as f:
+		f.write(file_content)
+	if time is not None:
+		os.utime(path, (time, time))
+
 class OrganizeScenario:
 
 	"Set up basic scenario for organize.py to operate on"
@@ -41,7 +65,7 @@ class OrganizeScenario:
 		for count, file, time in zip(itertools.count(), files, self.SetUpFileTimes(total)):
 			files[count] = abspath = os.path.join(dir, file)
 			if os.path.sep in file:
-				os.mkdirs(os.path.dirname(abspath), mode=0o600, exist_ok=True)
+				os.makedirs(os.path.dirname(abspath), exist_ok=True)
 			self._excl_touch(abspath, time)
 			self.assertEqual(os.path.getmtime(abspath), time)
 		return files
@@ -50,20 +74,7 @@ class OrganizeScenario:
 		"Return a list of file names"
 		return ['file' + str(i) for i in range(10)]
 
-	def _excl_touch(self, path, time=None):
-		"""Safely write a random file, optionally setting access and modification times.
-
-		`path` must be an absolute path. `time`, if specified, is an int or
-		float in seconds.
-		"""
-		if not os.path.isabs(path):
-			raise ValueError('Expected absolute path but got %r' % path)
-		file_len = random.randint(0x100,  0x1ff)
-		file_content = bytes([random.randint(0, 0xff) for i in range(file_len)])
-		with open(path, 'xb') as f:
-			f.write(file_content)
-		if time is not None:
-			os.utime(path, (time, time))
+	_excl_touch = staticmethod(excl_touch)
 
 	class SetUpFileTimes(collections.abc.Iterator):
 
@@ -106,3 +117,379 @@ class TestAssumptionsCorrect(OrganizeScenario, unittest.TestCase):
 		self.assertEqual(len(log_entries), len(self.old_files))
 
 
+
+
+class TestFastImport(OrganizeScenario, unittest.TestCase):
+
+	"Test the git fast-import backend, which leaves the working tree alone"
+
+	def setup_new_repo(self, dir):
+		repo = self.vcs(dir)
+		repo.init()
+		return repo
+
+	def runTest(self):
+		# Send each blob in several chunks
+		self.addCleanup(setattr, organize, 'BLOB_CHUNK', organize.BLOB_CHUNK)
+		organize.BLOB_CHUNK = 100
+		rc = self.run_main('--fast-import', '--source', self.old_dir.name,
+						   '--repo', self.new_dir.name, '--name', 'thing',
+						   'test-branch')
+		self.assertEqual(rc, 0)
+		log = self.new_repo.issue_command('log', '--format=%at %s',
+										  'test-branch').decode().splitlines()
+		self.assertEqual(len(log), len(self.old_files))
+		times = [int(os.path.getmtime(f)) for f in reversed(self.old_files)]
+		self.assertEqual(times, [int(entry.split()[0]) for entry in log])
+		with open(self.old_files[-1], 'rb') as f:
+			self.assertEqual(f.read(), self.new_repo.issue_command(
+				'show', 'test-branch:thing'))
+		self.assertEqual(['.git'], os.listdir(self.new_dir.name))
+		# Without its manifest, the branch can't be continued
+		os.remove(self.new_repo.manifest('test-branch').path)
+		self.assertNotEqual(0, self.run_main('--fast-import', '--source',
+			self.old_dir.name, '--repo', self.new_dir.name, 'test-branch'))
+		# An aborted stream leaves no branch behind
+		with self.assertRaises(KeyboardInterrupt):
+			with self.new_repo.fast_import('aborted') as stream:
+				stream.commit_file(self.old_files[0], 'thing', 'Aborted.',
+								   os.path.getmtime(self.old_files[0]))
+				raise KeyboardInterrupt
+		self.assertFalse(self.new_repo.branch_exists('aborted'))
+
+
+class TestSortedFiles(OrganizeScenario, unittest.TestCase):
+
+	"Test file discovery, with and without recursion"
+
+	def setup_new_repo(self, dir):
+		return None
+
+	def setup_file_names(self):
+		return ['a v1.txt', 'a v2.txt', 'b v1.doc', '.hidden.txt',
+				os.path.join('sub', 'a v3.txt'), os.path.join('.git', 'x.txt'),
+				os.path.join('sub', 'deeper', 'a v4.txt')]
+
+	def runTest(self):
+		root = self.old_dir.name
+		ls = organize.SortedFiles(root)
+		self.assertEqual(self.old_files[:3], list(ls))
+		self.assertEqual(list(map(os.path.getmtime, self.old_files[:3])),
+						 list(ls.values()))
+		ls = organize.SortedFiles(root, pattern='*.txt')
+		self.assertEqual(self.old_files[:2], list(ls))
+		scanner = organize.RecursiveFileScanner(pattern='*.txt')
+		self.assertEqual(sorted(self.old_files[:2] + self.old_files[4:7:2]),
+						 sorted(path for path, mtime in scanner.scan(root)))
+		for workers in None, 1, 4:
+			ls = organize.RecursiveSortedFiles(root, pattern='a *.txt',
+											   workers=workers)
+			self.assertEqual(self.old_files[:2] + self.old_files[4:7:2], list(ls))
+		ls = organize.SortedFiles(root, key=len)
+		self.assertEqual(sorted(self.old_files[:3], key=lambda f: (len(f), f)),
+						 list(ls))
+		# Streaming in a tiny budget spills a run per file, same order
+		for budget in 1, 2 ** 20:
+			self.assertEqual(list(organize.RecursiveSortedFiles(root).items()),
+				list(organize.RecursiveSortedFiles.stream(root, budget)))
+		# A file removed mid-scan is skipped, with a warning, but not its siblings
+		victim = self.old_files[1]
+		def key(path):
+			if path == victim:
+				os.remove(path)
+			return os.path.getmtime(path)
+		stderr = io.StringIO()
+		with contextlib.redirect_stderr(stderr):
+			ls = organize.SortedFiles(root, key=key)
+		self.assertEqual(self.old_files[:1] + self.old_files[2:3], list(ls))
+		self.assertIn(repr(victim), stderr.getvalue())
+
+
+class TestDuplicates(OrganizeScenario, unittest.TestCase):
+
+	"Test that byte-identical consecutive versions are hashed and skipped"
+
+	def setup_new_repo(self, dir):
+		repo = self.vcs(dir)
+		repo.init()
+		return repo
+
+	def setup_old_dir(self, dir):
+		files = super().setup_old_dir(dir)
+		# Versions 1 and 2 copy version 0; version 5 copies version 3.
+		for copy, original in (1, 0), (2, 0), (5, 3):
+			mtime = os.path.getmtime(files[copy])
+			with open(files[original], 'rb') as f, open(files[copy], 'wb') as g:
+				g.write(f.read())
+			os.utime(files[copy], (mtime, mtime))
+		return files
+
+	def log(self, branch):
+		return self.new_repo.issue_command('log', '--format=%s',
+										   branch).decode().splitlines()
+
+	def runTest(self):
+		for path in self.old_files:
+			self.assertEqual(organize.file_digest(path).encode(),
+				self.new_repo.issue_command('hash-object', path).strip())
+		self.assertEqual(organize.hash_files(self.old_files, 2),
+						 organize.hash_files(self.old_files, 1))
+		ls = organize.SortedFiles(self.old_dir.name)
+		originals = [v[3] for v in organize.versions(ls.items(), 1)]
+		self.assertEqual([None, self.old_files[0], self.old_files[0]] +
+						 [None] * 7, originals)
+		args = ['--source', self.old_dir.name, '--repo', self.new_dir.name,
+				'--name', 'thing', '--fast-import']
+		self.assertEqual(0, self.run_main(*args + ['skip']))
+		self.assertEqual(len(self.log('skip')), 8)
+		self.assertEqual(0, self.run_main(*args + ['--duplicates', 'annotate',
+												   'note']))
+		log = self.log('note')
+		self.assertEqual(len(log), 10)
+		self.assertEqual(log[-2], "Note 'file1' is identical to 'file0'.")
+		# Version 5 is committed, as version 4 differs, but reuses 3's blob.
+		blobs = self.new_repo.issue_command('rev-list', '--objects', '--all',
+			'--filter-print-omitted', '--filter=blob:none').decode().count('~')
+		self.assertEqual(blobs, 7)
+
+
+class TestIncremental(OrganizeScenario, unittest.TestCase):
+
+	"Test that re-running on a grown source folder appends only the new versions"
+
+	def setup_new_repo(self, dir):
+		repo = self.vcs(dir)
+		repo.init()
+		return repo
+
+	def grow(self, count):
+		"Add `count` versions newer than all the others to the source folder."
+		start = int(max(map(os.path.getmtime, self.old_files))) + 60
+		for i in range(count):
+			path = os.path.join(self.old_dir.name,
+								'new' + str(len(self.old_files)))
+			self._excl_touch(path, start + 60 * i)
+			self.old_files.append(path)
+
+	def check(self, branch, *args):
+		self.assertEqual(0, self.run_main('--source', self.old_dir.name,
+			'--repo', self.new_dir.name, '--name', 'thing', *args + (branch,)))
+		log = self.new_repo.issue_command('log', '--format=%s',
+										  branch).decode().splitlines()
+		self.assertEqual(len(log), len(self.old_files))
+		for subject in log:
+			self.assertTrue(subject.startswith('Auto-add '), subject)
+		self.assertEqual(len(self.new_repo.manifest(branch).load().versions),
+						 len(self.old_files))
+		with open(self.old_files[-1], 'rb') as f:
+			self.assertEqual(f.read(), self.new_repo.issue_command(
+				'show', branch + ':thing'))
+
+	def runTest(self):
+		# Checkpoint the fast-import backend mid-run too
+		self.addCleanup(setattr, organize, 'CHECKPOINT_INTERVAL',
+						organize.CHECKPOINT_INTERVAL)
+		organize.CHECKPOINT_INTERVAL = 4
+		# Last, as fast-import starts new branches from the checked-out one
+		for i, args in enumerate([('--fast-import',),
+								  ('--fast-import', '--memory', '0.001'),
+								  ('--force',)]):
+			branch = 'b' + str(i)
+			self.check(branch, *args)
+			self.check(branch, *args) # Nothing new
+			self.grow(3)
+			self.check(branch, *args)
+			# Lose the last three versions, as if interrupted mid-write
+			self.new_repo.issue_command('update-ref', 'refs/heads/' + branch,
+										branch + '~3')
+			manifest = self.new_repo.manifest(branch)
+			with open(manifest.path) as f:
+				lines = f.readlines()
+			with open(manifest.path, 'w') as f:
+				f.writelines(lines[:-3] + [lines[-3][:10]])
+			self.check(branch, *args)
+
+
+class TestInterrupted(TestIncremental):
+
+	"Test that re-running after an interrupted fast-import commits nothing twice"
+
+	def runTest(self):
+		self.addCleanup(setattr, organize, 'CHECKPOINT_INTERVAL',
+						organize.CHECKPOINT_INTERVAL)
+		organize.CHECKPOINT_INTERVAL = 3
+		commit_file = organize.FastImport.commit_file
+		self.addCleanup(setattr, organize.FastImport, 'commit_file', commit_file)
+		calls = itertools.count(1)
+		def interrupt(*args, **kwargs):
+			if next(calls) == 8:
+				raise KeyboardInterrupt
+			return commit_file(*args, **kwargs)
+		organize.FastImport.commit_file = interrupt
+		with self.assertRaises(KeyboardInterrupt):
+			self.run_main('--fast-import', '--source', self.old_dir.name,
+						  '--repo', self.new_dir.name, '--name', 'thing', 'b')
+		# The branch and manifest agree on the last checkpoint
+		self.assertEqual(6, int(self.new_repo.issue_command('rev-list',
+															'--count', 'b')))
+		self.assertEqual(6, len(self.new_repo.manifest('b').load().versions))
+		self.check('b', '--fast-import')
+
+
+class TestInterruptedCopy(TestIncremental):
+
+	"Test that re-running after a commit the manifest missed records it instead"
+
+	def runTest(self):
+		record = organize.Manifest.record
+		self.addCleanup(setattr, organize.Manifest, 'record', record)
+		calls = itertools.count(1)
+		def interrupt(*args, **kwargs):
+			if next(calls) == 5:
+				raise KeyboardInterrupt
+			return record(*args, **kwargs)
+		organize.Manifest.record = interrupt
+		with self.assertRaises(KeyboardInterrupt):
+			self.run_main('--force', '--source', self.old_dir.name,
+						  '--repo', self.new_dir.name, '--name', 'thing', 'b')
+		organize.Manifest.record = record
+		# The fifth version was committed but not recorded
+		self.assertEqual(5, int(self.new_repo.issue_command('rev-list',
+															'--count', 'b')))
+		self.assertEqual(4, len(self.new_repo.manifest('b').load().versions))
+		self.check('b', '--force')
+
+
+class TestExternalSort(unittest.TestCase):
+
+	"Test sorting in bounded memory with spilled runs"
+
+	def runTest(self):
+		items = [(str(random.random()), random.randrange(50)) for i in range(5000)]
+		key = lambda item: item[1]
+		for budget in 1, 10 ** 4, 10 ** 9:
+			self.assertEqual(sorted(items, key=key),
+							 list(organize.external_sort(items, key, budget)))
+		self.assertEqual([], list(organize.external_sort([], key, 1)))
+
+
+class TestBatch(OrganizeScenario, unittest.TestCase):
+
+	"Test importing many families of versions onto their own branches"
+
+	def setup_new_repo(self, dir):
+		repo = self.vcs(dir)
+		repo.init()
+		return repo
+
+	def setup_file_names(self):
+		return ['thing v1.txt', 'other.doc', 'thing_v2.txt', 'other (copy).doc',
+				'Thing V3.1.txt', 'my notes version 2.txt', 'thing v4 copy 2.txt']
+
+	def runTest(self):
+		names = [organize.family_name(f) for f in self.old_files]
+		self.assertEqual(names, ['thing.txt', 'other.doc', 'thing.txt',
+			'other.doc', 'Thing.txt', 'my notes.txt', 'thing.txt'])
+		self.assertEqual(b'b/my-notes.txt',
+						 organize.family_branch(b'b', 'my notes.txt'))
+		args = ('--batch', '--source', self.old_dir.name, '--repo',
+				self.new_dir.name, 'b')
+		self.assertEqual(0, self.run_main(*args))
+		refs = self.new_repo.issue_command('for-each-ref', '--format=%(refname)')
+		self.assertEqual(refs.decode().split(), ['refs/heads/b/Thing.txt',
+			'refs/heads/b/my-notes.txt', 'refs/heads/b/other.doc',
+			'refs/heads/b/thing.txt'])
+		log = self.new_repo.issue_command('log', '--format=%s', 'b/thing.txt')
+		self.assertEqual(len(log.splitlines()), 3)
+		with open(self.old_files[-1], 'rb') as f:
+			self.assertEqual(f.read(), self.new_repo.issue_command(
+				'show', 'b/thing.txt:thing.txt'))
+		# A second pass finds nothing new in any family
+		self.assertEqual(0, self.run_main(*args))
+		self.assertEqual(refs, self.new_repo.issue_command(
+			'for-each-ref', '--format=%(refname)'))
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux-only')
+class TestWatch(OrganizeScenario, unittest.TestCase):
+
+	"Test that --watch imports versions as they are written"
+
+	def setup_new_repo(self, dir):
+		repo = self.vcs(dir)
+		repo.init()
+		return repo
+
+	def commits(self):
+		try:
+			log = self.new_repo.issue_command('log', '--format=%s', 'b')
+		except subprocess.CalledProcessError:
+			return 0
+		return len(log.splitlines())
+
+	def wait_for(self, commits, timeout=10):
+		deadline = time.monotonic() + timeout
+		while self.commits() < commits and time.monotonic() < deadline:
+			time.sleep(0.05)
+		self.assertEqual(self.commits(), commits)
+
+	def runTest(self):
+		load = organize.Manifest.load
+		self.addCleanup(setattr, organize.Manifest, 'load', load)
+		loads = itertools.count()
+		def count(manifest):
+			next(loads)
+			return load(manifest)
+		organize.Manifest.load = count
+		args = organize.ArgumentParser().parse_args(['--watch', '--recurse',
+			'--settle', '0.1', '--source', self.old_dir.name, '--repo',
+			self.new_dir.name, '--name', 'thing', 'b'])
+		stop = threading.Event()
+		watcher = threading.Thread(target=organize.watch,
+								   args=(self.new_repo, args, stop))
+		watcher.start()
+		try:
+			self.wait_for(len(self.old_files))
+			# A burst of new versions, one in a new subdirectory
+			sub = os.path.join(self.old_dir.name, 'sub')
+			os.mkdir(sub)
+			for path in [os.path.join(self.old_dir.name, 'new1'),
+						 os.path.join(self.old_dir.name, '.hidden'),
+						 os.path.join(sub, 'new2')]:
+				self._excl_touch(path)
+			self.wait_for(len(self.old_files) + 2)
+		finally:
+			stop.set()
+			watcher.join()
+		# The manifest made by the first import was kept, not read again
+		self.assertEqual(0, next(loads))
+
+
+class TestProfile(OrganizeScenario, unittest.TestCase):
+
+	"Test that --profile reports each phase and git command"
+
+	def setup_new_repo(self, dir):
+		repo = self.vcs(dir)
+		repo.init()
+		return repo
+
+	def runTest(self):
+		path = os.path.join(self.new_dir.name, '.git', 'profile.json')
+		self.assertEqual(0, self.run_main('--profile', path, '--force',
+			'--source', self.old_dir.name, '--repo', self.new_dir.name, 'b'))
+		with open(path) as f:
+			report = json.load(f)
+		phases = report['phases']
+		total = len(self.old_files)
+		for name in 'scan', 'hash', 'copy', 'git add', 'git commit':
+			self.assertEqual(phases[name]['files' if name[:3] != 'git'
+										 else 'calls'], total, name)
+		self.assertEqual(phases['copy']['bytes'],
+						 sum(map(os.path.getsize, self.old_files)))
+		for name, phase in phases.items():
+			if name.startswith('git '):
+				self.assertEqual(phase['calls'],
+								 sum(n for ms, n in phase['latency_ms']))
+		self.assertLessEqual(sum(p['seconds'] for p in phases.values()),
+							 report['wall_seconds'])
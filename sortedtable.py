@@ -4,6 +4,13 @@ You may use `SortedMapping` or `SortedSet` directly for keys or elements
 (respectively) that are totally ordered but not necessarily hashable. These
 data types support the mapping and set interfaces respectively. Immutable
 versions are provided too in `SortedFrozenSet` and `SortedFrozenMapping`.
+`BoundedSortedSet` keeps only the largest or smallest elements added to it.
+`SortedStrMapping` stores `str` or `bytes` keys in a radix tree and answers
+prefix queries. `ExpiringMapping` is a hashable-key cache whose entries expire after a time to
+live or beyond a maximum size.
+
+The functions `asof_join` and `merge_join` join two sorted mappings by walking
+them in lockstep. `SortedMergeView` reads many sorted tables as one.
 
 You may create your own ordered symbol table client interface by subclassing the
 `BinarySearchTree` class and providing public methods that access its public
@@ -14,10 +21,107 @@ The tests for this code have been run successfully on Python 3.3 and 3.2.
 
 __version__ = '0.0.2.dev1'
 
-from collections import (Mapping as _MappingABC,
-						 MutableMapping as _MutableMappingABC,
-						 Set as _SetABC,
-						 MutableSet as _MutableSetABC)
+try:
+	from collections.abc import (Mapping as _MappingABC,
+								 MutableMapping as _MutableMappingABC,
+								 Set as _SetABC,
+								 MutableSet as _MutableSetABC,
+								 ItemsView as _ItemsViewABC,
+								 ValuesView as _ValuesViewABC,
+								 Sized as _SizedABC)
+except ImportError: # Python 3.2
+	from collections import (Mapping as _MappingABC,
+							 MutableMapping as _MutableMappingABC,
+							 Set as _SetABC,
+							 MutableSet as _MutableSetABC,
+							 ItemsView as _ItemsViewABC,
+							 ValuesView as _ValuesViewABC,
+							 Sized as _SizedABC)
+from array import array as _array, typecodes as _array_typecodes
+from copy import deepcopy as _deepcopy
+from bisect import bisect_left as _bisect_left, bisect_right as _bisect_right
+from heapq import heapify as _heapify, heappop as _heappop, heapreplace as _heapreplace
+from itertools import chain as _chain, islice as _islice
+from operator import itemgetter as _itemgetter
+from time import monotonic as _monotonic
+
+
+class _Missing:
+
+	"Sentinel for missing values. It unpickles as the same object."
+
+	def __reduce__(self):
+		return '_MISSING'
+
+	def __repr__(self):
+		return '_MISSING'
+
+_MISSING = _Missing()
+_INF = float('inf')
+
+
+def _check_column(dtype, use_numpy):
+	"""Raise unless `dtype` is a column type for `use_numpy`. See `to_arrays`.
+
+	NumPy is imported only when it is needed.
+	"""
+	if dtype is None:
+		return
+	if use_numpy:
+		import numpy
+		numpy.dtype(dtype)
+	elif not (isinstance(dtype, str) and len(dtype) == 1
+			  and dtype in _array_typecodes):
+		raise ValueError('dtype must be an array type code unless numpy is '
+						 'true, not {!r}'.format(dtype))
+
+
+def _empty_column(n, dtype, use_numpy):
+	"Return a column of `n` rows of type `dtype` to be filled. See `to_arrays`."
+	if dtype is None:
+		return [None] * n
+	if use_numpy:
+		import numpy
+		return numpy.empty(n, dtype=dtype)
+	column = _array(dtype)
+	column.frombytes(bytes(n * column.itemsize))
+	return column
+
+
+def _columns(n, rows, key_dtype, value_dtype, use_numpy):
+	"Fill a column of keys and one of values with the next `n` pairs of `rows`."
+	keys = _empty_column(n, key_dtype, use_numpy)
+	values = _empty_column(n, value_dtype, use_numpy)
+	for i, (key, value) in zip(range(n), rows):
+		keys[i] = key
+		values[i] = value
+	return keys, values
+
+
+def _presorted(iterable, key=None):
+	"""Return `iterable` sorted by key if it is a collection of string keys.
+
+	Sorted keys are appended to a tree rather than searched for. Only a
+	`Sized` collection whose first key is `str` or `bytes` is sorted, as it is
+	already in memory and `sorted` adds just a list of references to it; an
+	iterator streams past in its original order rather than being buffered.
+	The sort is stable, so later duplicates still win.
+
+	No radix sort is used: `sorted` beats pure Python LSD and MSD radix sorts
+	at every size tried, and NumPy's only by a fraction of the tree's build
+	time, so string keys get no sort of their own.
+	"""
+	if isinstance(iterable, _SizedABC):
+		for first in iterable:
+			if type(first if key is None else key(first)) in (str, bytes):
+				return sorted(iterable, key=key)
+			break
+	return iterable
+
+
+def _abs_difference(a, b):
+	"Default distance between keys for `BinarySearchTree.nearest`."
+	return abs(a - b)
 
 
 class _Node:
@@ -46,17 +150,30 @@ class _Node:
 	_BLACK = False
 
 	def __init__(self, key, value):
-		try:
-			key < key
-		except TypeError:
-			raise TypeError("{.__name__!r} can't contain unorderable keys of "
-							"type {.__name__!r}".format(type(self), type(key)))
+		self._reset(key, value)
+
+	def _reset(self, key, value, check=True):
+		"""Make the node a new red leaf holding `key` and `value`.
+
+		Unless `check` is false, first raise TypeError if `key` is unorderable.
+		"""
+		if check:
+			self._check_key(key)
 		self._key = key
 		self._value = value
 		self._color = self._RED
 		self._N = 1
 		self._left = self._right = None
 
+	@classmethod
+	def _check_key(cls, key):
+		"Raise TypeError if `key` is unorderable."
+		try:
+			key < key
+		except TypeError:
+			raise TypeError("{.__name__!r} can't contain unorderable keys of "
+							"type {.__name__!r}".format(cls, type(key)))
+
 	def __str__(self):
 		"Return a Lisp-style list of the keys as a string."
 		return type(self).__name__ + self._str()
@@ -77,15 +194,7 @@ class _Node:
 		keys k such that lo <= k < hi. (The assymetry between the conditionals
 		is meant to parallel the semantics of builtins slice() and range().)
 		"""
-		if (lo is None or lo < self._key) and self._left is not None:
-			for item in self._left.__iter__(lo=lo, hi=hi):
-				yield item
-		if (lo is None and hi is None or lo is None and self._key < hi or
-				hi is None and lo <= self._key or lo <= self._key < hi):
-			yield self._key
-		if (hi is None or hi > self._key) and self._right is not None:
-			for item in self._right.__iter__(lo=lo, hi=hi):
-				yield item
+		return (x._key for x in self._nodes(lo, hi))
 
 	def __reversed__(self, *, lo=None, hi=None):
 		"""Iterate through the keys in reverse order.
@@ -94,22 +203,78 @@ class _Node:
 		keys k such that lo <= k < hi. (The assymetry between the conditionals
 		is meant to parallel the semantics of builtins slice() and range().)
 		"""
-		if (hi is None or hi > self._key) and self._right is not None:
-			for item in self._right.__reversed__(lo=lo, hi=hi):
-				yield item
-		if (lo is None and hi is None or lo is None and self._key < hi or
-				hi is None and lo <= self._key or lo <= self._key < hi):
-			yield self._key
-		if (lo is None or lo < self._key) and self._left is not None:
-			for item in self._left.__reversed__(lo=lo, hi=hi):
-				yield item
+		return (x._key for x in self._nodes(lo, hi, reverse=True))
 
 	def __contains__(self, key):
-		try:
-			self.get(key)
-		except KeyError:
-			return False
-		return True
+		return self._find(key) is not None
+
+	def _neighbors(self, key):
+		"""Return iterators over the keys on either side of `key`.
+
+		The first iterator runs down from the greatest key < `key`, the second
+		up from the least key >= `key`. A single descent from `self` sets up
+		both, after which each step takes amortized constant time.
+		"""
+		below, above = [], []
+		x = self
+		while x is not None:
+			if x._key < key:
+				below.append(x)
+				x = x._right
+			else:
+				above.append(x)
+				x = x._left
+		return self._resume(below, True), self._resume(above, False)
+
+	@staticmethod
+	def _resume(stack, reverse):
+		"Continue an in-order traversal, or a reverse one, of keys from its stack."
+		while stack:
+			x = stack.pop()
+			yield x._key
+			x = x._left if reverse else x._right
+			while x is not None:
+				stack.append(x)
+				x = x._right if reverse else x._left
+
+	def _nodes(self, lo=None, hi=None, reverse=False):
+		"""Iterate through the nodes in key order without recursion.
+
+		Optional arguments `lo` and `hi` limit iteration to keys k such that lo
+		<= k < hi, as for `__iter__`. If `reverse` is true, iterate in reverse.
+		"""
+		stack = []
+		x = self
+		if reverse:
+			while stack or x is not None:
+				if x is None:
+					x = stack.pop()
+					if lo is not None and x._key < lo:
+						return
+					yield x
+					x = x._left
+				elif hi is not None and not x._key < hi:
+					x = x._left
+				else:
+					stack.append(x)
+					x = x._right
+		else:
+			while stack or x is not None:
+				if x is None:
+					x = stack.pop()
+					if hi is not None and not x._key < hi:
+						return
+					yield x
+					x = x._right
+				elif lo is not None and x._key < lo:
+					x = x._right
+				else:
+					stack.append(x)
+					x = x._left
+
+	def _items(self, lo=None, hi=None, reverse=False):
+		"Iterate through the (key, value) pairs with the arguments of `_nodes`."
+		return ((x._key, x._value) for x in self._nodes(lo, hi, reverse))
 
 	def height(self):
 		l = 0 if self._left is None else self._left.height()
@@ -118,10 +283,17 @@ class _Node:
 
 	def get(self, key):
 		"Return value associated with `key`; Raise `KeyError` if key not found."
+		x = self._find(key)
+		if x is None:
+			raise KeyError(key)
+		return x._value
+
+	def _find(self, key):
+		"Return the node whose key equals `key`, or `None` if key not found."
 		x = self
 		while x is not None:
 			if key == x._key:
-				return x._value
+				return x
 			elif key < x._key:
 				x = x._left
 			elif key > x._key:
@@ -129,63 +301,203 @@ class _Node:
 			else:
 				raise TypeError("{.__name__!r} can't contain unorderable keys of "
 								"type {.__name__!r}".format(type(self), type(key)))
-		raise KeyError(key)
+		return None
+
+	def set(self, key, value, new=None, found=None):
+		"""Recursively set the key-value pair in the subtree rooted at `self`.
 
-	def set(self, key, value):
-		"Recursively set the key-value pair in the subtree rooted at `self`."
-		self = self._set(key, value)
+		If `key` is absent, the optional callable `new` is called with `key` and
+		`value` to create the node to link into the tree. It defaults to the
+		node's class. If `key` is present and the optional list `found` is
+		given, the key's value is left alone and its node is appended to `found`
+		instead, which gives `setdefault` semantics in a single descent.
+		"""
+		if new is None:
+			new = self.__class__
+		self = self._set(key, value, new, found)
 		self._color = self._BLACK
 		return self
 
-	def _set(self, key, value):
+	def append(self, key, value, new=None):
+		"""Link `key`, which must exceed every key in the tree, as the maximum.
+
+		No keys are compared. `new` is as for `set`. Return the new root.
+		"""
+		if new is None:
+			new = self.__class__
+		self = self._append(new(key, value))
+		self._color = self._BLACK
+		return self
+
+	def _append(self, node):
+		"""Link `node`, whose key exceeds every key in the tree, as the maximum.
+
+		Walk down the right spine without comparing keys, then fix up the LLRB
+		invariants on the way back up only as far as they were disturbed. Once a
+		subtree's root keeps its old color, nothing above it can change but the
+		lengths, which were already incremented on the way down. Return the new
+		root of the tree.
+		"""
+		spine = []
+		x = self
+		while x is not None:
+			x._N += 1
+			spine.append(x)
+			x = x._right
+		child = node
+		for i in range(len(spine) - 1, -1, -1):
+			h = spine[i]
+			color = h._color
+			h._right = child
+			child = h._fixup()
+			if child._color == color:
+				if i == 0:
+					return child
+				spine[i - 1]._right = child
+				return self
+		return child
+
+	def _set(self, key, value, new, found=None):
 		if key == self._key:
-			self._value = value
+			if found is None:
+				self._value = value
+			else:
+				found.append(self)
 		elif key < self._key:
 			if self._left is None:
-				self._left = self.__class__(key, value)
+				self._left = new(key, value)
 			else:
-				self._left = self._left._set(key, value)
+				self._left = self._left._set(key, value, new, found)
 		elif key > self._key:
 			if self._right is None:
-				self._right = self.__class__(key, value)
+				self._right = new(key, value)
 			else:
-				self._right = self._right._set(key, value)
+				self._right = self._right._set(key, value, new, found)
 		else:
 			raise TypeError("{.__name__!r} can't contain unorderable keys of "
 							"type {.__name__!r}".format(type(self), type(key)))
 		return self._fixup()
 
 	def delete(self, key):
-		"Delete the corresponding with key."
-		self.get(key) # Raise a KeyError if key not in self.
-		self = self._delete(key)
+		"""Delete `key`, if present, in a single descent. Return the new root.
+
+		Absent keys raise no error, as the caller must keep the new root either
+		way. Use `pop` to learn whether `key` was present.
+		"""
+		return self.pop(key)[0]
+
+	def pop(self, key, freed=None):
+		"""Delete `key` in a single descent, if present.
+
+		Return the new root and the removed (key, value) pair, or `None` in
+		place of the pair if `key` was absent. Either way the tree is left
+		balanced, so the caller must keep the returned root. If the list
+		`freed` is given, the node unlinked from the tree is appended to it.
+		"""
+		popped = []
+		self = self._delete(key, popped)
 		if self is not None:
 			self._color = self._BLACK
-		return self
+		if not popped:
+			return self, None
+		if freed is not None:
+			freed.append(popped[1])
+		return self, popped[0]
 
-	def _delete(self, key):
-		assert key in self
+	def _delete(self, key, popped):
 		isred = self._isred
 		if key < self._key:
-			if (not isred(self._left) and self._left is not None and
-					not isred(self._left._left)):
+			if self._left is None:
+				return self
+			if not isred(self._left) and not isred(self._left._left):
 				self = self._move_red_left()
-			self._left = self._left._delete(key)
+			self._left = self._left._delete(key, popped)
 		else:
 			if isred(self._left):
 				self = self._rotate_right()
 			if key == self._key and self._right is None:
+				popped.extend([(self._key, self._value), self])
 				return None
-			if (not isred(self._right) and self._right is not None and
-					not isred(self._right._left)):
+			if self._right is None:
+				return self._fixup()
+			if not isred(self._right) and not isred(self._right._left):
 				self = self._move_red_right()
 			if key == self._key:
-				rightmin = self._right.min()
-				self._value = self._right.get(rightmin)
-				self._key = rightmin
+				popped.append((self._key, self._value))
+				x = self._right
+				while x._left is not None:
+					x = x._left
+				popped.append(x)
+				self._key, self._value = x._key, x._value
 				self._right = self._right._delmin()
 			else:
-				self._right = self._right._delete(key)
+				self._right = self._right._delete(key, popped)
+		return self._fixup()
+
+	def popmin(self, freed=None):
+		"""Delete the minimum key. Return the new root, the key, and its value.
+
+		When the minimum is the red half of a 3-node, as it often is when the
+		tree is consumed from its low end, it is unlinked directly without
+		restructuring the tree. If the list `freed` is given, the unlinked node
+		is appended to it.
+		"""
+		parent, x = None, self
+		while x._left is not None:
+			parent, x = x, x._left
+		if freed is not None:
+			freed.append(x)
+		if not self._isred(x):
+			return self.delmin(), x._key, x._value
+		parent._left = None
+		y = self
+		while y is not parent:
+			y._N -= 1
+			y = y._left
+		parent._N -= 1
+		return self, x._key, x._value
+
+	def popmax(self, freed=None):
+		"""Delete the maximum key. Return the new root, the key, and its value.
+
+		When the maximum is the black half of a 3-node, its red left child takes
+		its place without restructuring the tree. If the list `freed` is given,
+		the unlinked node is appended to it.
+		"""
+		parent, x = None, self
+		while x._right is not None:
+			parent, x = x, x._right
+		if freed is not None:
+			freed.append(x)
+		if not self._isred(x._left):
+			return self.delmax(), x._key, x._value
+		y = x._left
+		y._color = x._color
+		if parent is None:
+			return y, x._key, x._value
+		parent._right = y
+		z = self
+		while z is not parent:
+			z._N -= 1
+			z = z._right
+		parent._N -= 1
+		return self, x._key, x._value
+
+	def delmax(self):
+		"Delete the key-value pair associated with the maximum key."
+		self = self._delmax()
+		if self is not None:
+			self._color = self._BLACK
+		return self
+
+	def _delmax(self):
+		if self._isred(self._left):
+			self = self._rotate_right()
+		if self._right is None: return None
+		isred = self._isred
+		if not isred(self._right) and not isred(self._right._left):
+			self = self._move_red_right()
+		self._right = self._right._delmax()
 		return self._fixup()
 
 	def delmin(self):
@@ -304,6 +616,118 @@ class _Node:
 			lo, hi = hi, lo
 		return self.rank(hi) - self.rank(lo)
 
+	#### Copying ####
+
+	def _clone(self):
+		"Return an unlinked copy of the node, skipping the orderability check."
+		node = object.__new__(self.__class__)
+		node._key = self._key
+		node._value = self._value
+		node._color = self._color
+		node._N = self._N
+		node._left = node._right = None
+		return node
+
+	def copy(self, clone=None):
+		"""Return a copy of the tree rooted at `self` in linear time.
+
+		The copy has the same shape, colors, and lengths. The optional callable
+		`clone` takes a node and returns an unlinked copy of it; it defaults to
+		`_clone`, which shares keys and values. Walk the tree with an explicit
+		stack rather than recursion, so the depth of the tree does not matter.
+		"""
+		if clone is None:
+			clone = self.__class__._clone
+		root = clone(self)
+		stack = [(self, root)]
+		while stack:
+			old, new = stack.pop()
+			if old._left is not None:
+				new._left = clone(old._left)
+				stack.append((old._left, new._left))
+			if old._right is not None:
+				new._right = clone(old._right)
+				stack.append((old._right, new._right))
+		return root
+
+	#### Splitting and joining ####
+
+	def split(self, key):
+		"""Split the tree into the keys less than `key` and the rest.
+
+		Return the roots of the two new trees, either of which may be `None`.
+		The tree rooted at `self` is consumed: its nodes are relinked into the
+		new trees. This takes O(log n) key comparisons and O(log(n)**2) time
+		regardless of how many keys end up on either side.
+		"""
+		if self._key < key:
+			if self._right is None:
+				lo, hi = None, None
+			else:
+				lo, hi = self._right.split(key)
+			return self._join(self._left, self, lo), hi
+		if self._left is None:
+			lo, hi = None, None
+		else:
+			lo, hi = self._left.split(key)
+		return lo, self._join(hi, self, self._right)
+
+	@classmethod
+	def _join(cls, left, node, right):
+		"""Link trees `left` and `right` through `node`. Return the new root.
+
+		Every key in `left` must be less than `node._key`, which must be less
+		than every key in `right`. Either tree may be `None`. The node's old
+		links are discarded. The shorter tree is hung from the spine of the
+		taller one where their black heights match, and the LLRB invariants are
+		restored on the way back up.
+		"""
+		node._left = node._right = None
+		node._color = cls._RED
+		for t in left, right:
+			if t is not None:
+				t._color = cls._BLACK
+		lh, rh = cls._black_height(left), cls._black_height(right)
+		isred = cls._isred
+		spine = []
+		hang_right = lh >= rh
+		if hang_right:
+			# All right links are black, so each step costs one black level.
+			x = left
+			while lh > rh:
+				spine.append(x)
+				x, lh = x._right, lh - 1
+			node._left, node._right = x, right
+		else:
+			x = right
+			while rh > lh or isred(x):
+				spine.append(x)
+				if not isred(x):
+					rh -= 1
+				x = x._left
+			node._left, node._right = left, x
+		node._N = node._recursive_len()
+		child = node
+		for i in range(len(spine) - 1, -1, -1):
+			h = spine[i]
+			if hang_right:
+				h._right = child
+			else:
+				h._left = child
+			child = h._fixup()
+		child._color = cls._BLACK
+		return child
+
+	@classmethod
+	def _black_height(cls, h):
+		"Return the number of black nodes on each path from `h` to a leaf."
+		count = 0
+		while h is not None:
+			if not cls._isred(h):
+				count += 1
+			h = h._left
+		return count
+
 	#### Red-black helper methods ####
 
 	def _move_red_left(self):
@@ -390,6 +814,217 @@ class _Node:
 		return h._color == cls._RED
 
 
+class _Item:
+
+	"A key-value pair standing in for a `_Node` outside of a tree."
+
+	__slots__ = '_key', '_value'
+
+	def __init__(self, key, value):
+		self._key = key
+		self._value = value
+
+	def _clone(self):
+		return _Item(self._key, self._value)
+
+
+class _SortedArray:
+
+	"""A pair of sorted lists standing in for a small `_Node` tree.
+
+	`BinarySearchTree` keeps a few keys this way to save the memory of a node
+	per key and the work of rebalancing. The methods have the semantics of the
+	`_Node` methods of the same names, searching with `bisect`. Nodes are
+	represented by `_Item` objects made on demand, which only copying and
+	conversion to a tree need: reads iterate over the lists themselves. The
+	methods that remove keys return `None` in place of an empty array.
+	"""
+
+	__slots__ = '_keys', '_values'
+
+	def __init__(self, keys, values):
+		self._keys = keys
+		self._values = values
+
+	@classmethod
+	def _from_nodes(cls, nodes):
+		"Return an array of the keys and values of `nodes`, given in order."
+		keys, values = [], []
+		for x in nodes:
+			keys.append(x._key)
+			values.append(x._value)
+		return cls(keys, values)
+
+	@classmethod
+	def _single(cls, key, value):
+		"Return an array of one pair, checking the key like `_Node` does."
+		_Node._check_key(key)
+		return cls([key], [value])
+
+	def _tree(self, new):
+		"Return an LLRB tree of the pairs, whose nodes are made by `new`."
+		keys, values = self._keys, self._values
+		root = new(keys[0], values[0])
+		for i in range(1, len(keys)):
+			root = root._append(new(keys[i], values[i]))
+			root._color = _Node._BLACK
+		root._color = _Node._BLACK
+		return root
+
+	def __len__(self):
+		return len(self._keys)
+
+	def __contains__(self, key):
+		keys = self._keys
+		i = _bisect_left(keys, key)
+		return i < len(keys) and keys[i] == key or self._search(key)[1]
+
+	def _bounds(self, lo, hi):
+		"Return the slice indices of keys k such that lo <= k < hi."
+		keys = self._keys
+		return (0 if lo is None else _bisect_left(keys, lo),
+				len(keys) if hi is None else _bisect_left(keys, hi))
+
+	def _slice(self, column, lo, hi, reverse):
+		"Iterate through the part of `column` for keys k with lo <= k < hi."
+		i, j = self._bounds(lo, hi)
+		if not reverse:
+			return _islice(column, i, j)
+		n = len(column)
+		return _islice(reversed(column), n - j, n - i)
+
+	def __iter__(self, *, lo=None, hi=None):
+		return self._slice(self._keys, lo, hi, False)
+
+	def __reversed__(self, *, lo=None, hi=None):
+		return self._slice(self._keys, lo, hi, True)
+
+	def _nodes(self, lo=None, hi=None, reverse=False):
+		return map(_Item, self._slice(self._keys, lo, hi, reverse),
+				   self._slice(self._values, lo, hi, reverse))
+
+	def _items(self, lo=None, hi=None, reverse=False):
+		return zip(self._slice(self._keys, lo, hi, reverse),
+				   self._slice(self._values, lo, hi, reverse))
+
+	def _neighbors(self, key):
+		keys = self._keys
+		i = _bisect_left(keys, key)
+		return _islice(reversed(keys), len(keys) - i, None), _islice(keys, i, None)
+
+	def _search(self, key):
+		"""Return the index of the least key >= `key` and whether it equals it.
+
+		Raise TypeError if `key` is not ordered with the keys, as `_Node` does.
+		"""
+		keys = self._keys
+		i = _bisect_left(keys, key)
+		if i == len(keys):
+			return i, False
+		if keys[i] == key:
+			return i, True
+		if not key < keys[i]:
+			raise TypeError("{.__name__!r} can't contain unorderable keys of "
+							"type {.__name__!r}".format(type(self), type(key)))
+		return i, False
+
+	def _find(self, key):
+		i, found = self._search(key)
+		return _Item(self._keys[i], self._values[i]) if found else None
+
+	def get(self, key):
+		"Return value associated with `key`; Raise `KeyError` if key not found."
+		value = self.lookup(key, _MISSING)
+		if value is _MISSING:
+			raise KeyError(key)
+		return value
+
+	def lookup(self, key, default):
+		"""Return the value of `key`, or `default` if key is absent.
+
+		A present key is found by bisection alone; `_search` then checks an
+		absent key's order.
+		"""
+		keys = self._keys
+		i = _bisect_left(keys, key)
+		if i < len(keys) and keys[i] == key:
+			return self._values[i]
+		self._search(key)
+		return default
+
+	def set(self, key, value, new=None, found=None):
+		i, present = self._search(key)
+		if not present:
+			self._keys.insert(i, key)
+			self._values.insert(i, value)
+		elif found is None:
+			self._values[i] = value
+		else:
+			found.append(_Item(self._keys[i], self._values[i]))
+		return self
+
+	def append(self, key, value, new=None):
+		self._keys.append(key)
+		self._values.append(value)
+		return self
+
+	def pop(self, key, freed=None):
+		i, present = self._search(key)
+		if not present:
+			return self, None
+		item = self._keys.pop(i), self._values.pop(i)
+		return (self if self._keys else None), item
+
+	def popmin(self, freed=None):
+		key, value = self._keys.pop(0), self._values.pop(0)
+		return (self if self._keys else None), key, value
+
+	def popmax(self, freed=None):
+		key, value = self._keys.pop(), self._values.pop()
+		return (self if self._keys else None), key, value
+
+	def poprange(self, lo=None, hi=None):
+		"Remove the keys k such that lo <= k < hi. Return the root and pairs."
+		i, j = self._bounds(lo, hi)
+		popped = list(zip(self._keys[i:j], self._values[i:j]))
+		del self._keys[i:j], self._values[i:j]
+		return (self if self._keys else None), popped
+
+	def min(self):
+		return self._keys[0]
+
+	def max(self):
+		return self._keys[-1]
+
+	def floor(self, key):
+		i = _bisect_right(self._keys, key)
+		if i == 0:
+			raise KeyError(key)
+		return self._keys[i - 1]
+
+	def ceiling(self, key):
+		i = _bisect_left(self._keys, key)
+		if i == len(self._keys):
+			raise KeyError(key)
+		return self._keys[i]
+
+	def select(self, k):
+		if k < 0 or k >= len(self._keys):
+			raise IndexError('Requested rank %r out of bounds' % k)
+		return self._keys[k]
+
+	def rank(self, key):
+		return _bisect_left(self._keys, key)
+
+	index = _Node.index
+	width = _Node.width
+
+	def copy(self, clone=None):
+		if clone is None:
+			return _SortedArray(self._keys[:], self._values[:])
+		return _SortedArray._from_nodes(map(clone, self._nodes()))
+
+
 class BinarySearchTree:
 
 	"""Abstract binary search tree. Subclass to add a client interface.
@@ -399,15 +1034,137 @@ class BinarySearchTree:
 	method. However, it hides the mutators in private methods `_set` and
 	`_delete`. This is useful for creating immutable subclass, but it means that
 	you can't really use this class as a container without subclassing it.
+
+	If the keyword argument `hash_index` is true, the tree also keeps a `dict`
+	mapping each key to its node, so that `__contains__`, `get`, and replacing
+	an existing key's value take constant time rather than descending the tree.
+	Ordered operations still use the tree. Every key must then be hashable,
+	and its hash must be consistent with its ordering's notion of equality.
+
+	Without a hash index, a tree of at most `_small_size` keys is stored as a
+	pair of sorted lists searched by bisection, which takes far less memory
+	than a node per key. It becomes a tree when it grows past `_small_size`
+	keys and goes back to lists when it shrinks to half that. Subclasses that
+	rely on the root being a `_Node` may set `_small_size` to 0.
+
+	The greatest key is cached once known, so that a key arriving in
+	increasing order is recognized with one comparison and appended along the
+	right spine, while other keys descend as usual. Removing the greatest key
+	forgets it until the next insertion looks it up again.
+
+	If the keyword argument `pool_size` is positive, up to that many nodes
+	unlinked by deletions are kept and reused by later insertions, saving the
+	allocator and garbage collector work under heavy churn. If `check_keys` is
+	false, new nodes skip the check that their keys are orderable; use this
+	only for keys of a single type known to be totally ordered. See
+	`node_stats` for the effect.
 	"""
 
-	def __init__(self):
+	_small_size = 128
+	_pool = None
+	_pool_size = 0
+	_check_keys = True
+	_allocated = _reused = 0
+	_last = _MISSING
+
+	def __init__(self, *, hash_index=False, pool_size=0, check_keys=True):
 		"""Instantiate new empty BST."""
 		self._root = None
+		self._index = {} if hash_index else None
+		if pool_size > 0:
+			self._pool = []
+			self._pool_size = pool_size
+		if not check_keys:
+			self._check_keys = False
+
+	def node_stats(self):
+		"""Return a dict counting the tree's node allocations.
+
+		'allocated' counts nodes created, 'reused' counts nodes taken from the
+		pool instead, and 'pooled' is the number of nodes waiting in the pool.
+		"""
+		return {'allocated': self._allocated, 'reused': self._reused,
+				'pooled': 0 if self._pool is None else len(self._pool)}
+
+	@property
+	def hash_index(self):
+		"Whether the tree keeps a hash index of its keys."
+		return self._index is not None
+
+	def __getstate__(self):
+		"Pickle without any cached hash, which may differ in another process."
+		state = self.__dict__.copy()
+		state.pop('_hashcode', None)
+		if state.get('_pool'):
+			state['_pool'] = []
+		return state
+
+	def copy(self):
+		"""Return a shallow copy in linear time by copying the tree's shape.
+
+		Keys and values are shared with the original.
+		"""
+		return self._copy()
+
+	__copy__ = copy
+
+	def __deepcopy__(self, memo):
+		"""Return a copy of the tree with deep copies of the values.
+
+		Keys are shared, as they must not change while they are in a tree.
+		"""
+		def clone(node):
+			new = node._clone()
+			new._value = _deepcopy(node._value, memo)
+			return new
+		return self._copy(clone, memo)
+
+	def _copy(self, clone=None, memo=None):
+		"""Copy the tree with `_Node.copy` and the other attributes as is.
+
+		If `memo` is given, deep copy the other attributes with it.
+		"""
+		copy = self.__class__.__new__(self.__class__)
+		if memo is not None:
+			memo[id(self)] = copy
+		for name, value in self.__getstate__().items():
+			if name in ('_allocated', '_reused'):
+				continue # The copy starts its own node statistics
+			if name == '_pool':
+				value = []
+			elif memo is not None and name not in ('_root', '_index'):
+				value = _deepcopy(value, memo)
+			setattr(copy, name, value)
+		copy._copy_tree(self, clone)
+		return copy
+
+	def _copy_tree(self, other, clone=None):
+		"""Replace the tree with a copy of `other`'s, re-indexing if need be.
+
+		The copy is resized to this tree's `_small_size`, which may differ.
+		"""
+		self._last = _MISSING
+		if other._root is None:
+			self._root = None
+			if self._index is not None:
+				self._index = {}
+			return
+		self._root = other._root.copy(clone)
+		if self._index is not None:
+			if self._root.__class__ is _SortedArray:
+				self._root = self._root._tree(_Node)
+			self._index = {node._key: node for node in self._nodes()}
+		else:
+			self._resize()
 
 	def clear(self):
 		"Remove every element from the tree in constant time."
-		self.__init__()
+		self._clear()
+
+	def _clear(self):
+		self._root = None
+		if self._index is not None:
+			self._index = {}
 
 	def __len__(self):
 		"Return number of keys present."
@@ -417,6 +1174,8 @@ class BinarySearchTree:
 
 	def __contains__(self, key):
 		"Return whether a given key is present."
+		if self._index is not None:
+			return key in self._index
 		if self._root is None:
 			return False
 		return key in self._root
@@ -443,47 +1202,232 @@ class BinarySearchTree:
 			return iter([])
 		return self._root.__reversed__(lo=lo, hi=hi)
 
+	def _nodes(self, lo=None, hi=None, reverse=False):
+		"Iterate through the nodes in key order without recursion. See `_Node`."
+		if self._root is None:
+			return iter([])
+		return self._root._nodes(lo, hi, reverse)
+
+	def _items(self, lo=None, hi=None, reverse=False):
+		"""Iterate through the (key, value) pairs in key order. See `_nodes`.
+
+		Unlike `_nodes`, this reads small tables' lists without making items.
+		"""
+		if self._root is None:
+			return iter([])
+		return self._root._items(lo, hi, reverse)
+
 	def _set(self, key, value):
 		"Set the key-value pair, replacing if key already present."
+		if self._index is not None:
+			node = self._index.get(key)
+			if node is not None:
+				node._value = value
+				return
 		if self._root is None:
-			self._root = _Node(key, value)
-			self._root._color = _Node._BLACK
+			if self._index is None and self._small_size > 0:
+				if self._check_keys:
+					self._root = _SortedArray._single(key, value)
+				else:
+					self._root = _SortedArray([key], [value])
+			else:
+				self._root = self._new_node(key, value)
+				self._root._color = _Node._BLACK
+			self._last = key
+		else:
+			self._insert(key, value)
+			self._resize()
+
+	def _insert(self, key, value, found=None):
+		"""Set the pair in the non-empty tree, appending if key is the greatest.
+
+		`found` is as for `_Node.set`. The cached greatest key is looked up if
+		it is unknown, so only the first insertion after it is removed walks
+		down the right spine.
+		"""
+		last = self._last
+		if last is _MISSING:
+			last = self._root.max()
+		if key > last:
+			self._root = self._root.append(key, value, self._new_node)
+			self._last = key
+		else:
+			self._root = self._root.set(key, value, self._new_node, found)
+			self._last = last
+
+	def _resize(self):
+		"""Switch between the sorted lists and the tree as the size requires.
+
+		Promote lists of more than `_small_size` keys to a tree. Demote a tree
+		that has shrunk to half of `_small_size` keys to lists.
+		"""
+		root = self._root
+		if root.__class__ is _SortedArray:
+			if len(root._keys) > self._small_size:
+				self._root = root._tree(self._new_node)
+		elif (root.__class__ is _Node and root._N <= self._small_size // 2 and
+				self._index is None):
+			self._root = _SortedArray._from_nodes(root._nodes())
+
+	def _new_node(self, key, value):
+		"Create or reuse the node for a key about to be linked into the tree."
+		if self._pool:
+			node = self._pool.pop()
+			node._reset(key, value, self._check_keys)
+			self._reused += 1
+		elif self._check_keys:
+			node = _Node(key, value)
+			self._allocated += 1
 		else:
-			self._root = self._root.set(key, value)
+			node = object.__new__(_Node)
+			node._reset(key, value, False)
+			self._allocated += 1
+		if self._index is not None:
+			self._index[key] = node
+		return node
+
+	def _setdefault(self, key, default):
+		"Return key's value, first setting it to `default` if key is absent."
+		if self._index is not None:
+			node = self._index.get(key)
+			if node is not None:
+				return node._value
+		elif self._root is not None:
+			found = []
+			self._insert(key, default, found)
+			if found:
+				return found[0]._value
+			self._resize()
+			return default
+		self._set(key, default)
+		return default
 
 	def _delete(self, key):
 		"Remove key from the mapping. Raise a KeyError if key is not in the map."
-		if self._root is None:
+		if self._remove(key) is None:
 			raise KeyError(key)
-		self._root = self._root.delete(key)
+
+	def _remove(self, key):
+		"Remove key in one descent. Return its (key, value) pair or None if absent."
+		if self._index is not None:
+			node = self._index.pop(key, None)
+			if node is None:
+				return None
+		elif self._root is None:
+			return None
+		freed = None if self._pool is None else []
+		self._root, item = self._root.pop(key, freed)
+		last = self._last
+		if item is not None and last is not _MISSING and item[0] == last:
+			self._last = _MISSING
+		# Deleting a key from an interior node moves its successor into that node.
+		if self._index is not None and node._key != key:
+			self._index[node._key] = node
+		elif self._root is not None:
+			self._resize()
+		if freed:
+			self._recycle(freed)
+		return item
+
+	def _recycle(self, nodes):
+		"Keep unlinked `nodes` for reuse while the pool has room."
+		pool = self._pool
+		for node in nodes:
+			if len(pool) >= self._pool_size:
+				break
+			node._key = node._value = node._left = node._right = None
+			pool.append(node)
 
 	def get(self, key, default=None):
 		"Return value of key; Return default or raise KeyError if key not found."
-		if self._root is None:
-			return default
-		try:
-			return self._root.get(key)
-		except KeyError:
+		if self._index is not None:
+			node = self._index.get(key)
+			return default if node is None else node._value
+		root = self._root
+		if root is None:
 			return default
+		if root.__class__ is _SortedArray:
+			return root.lookup(key, default)
+		node = root._find(key)
+		return default if node is None else node._value
 
 	def popmin(self):
 		"Pop the (key, value) tuple corresponding with the minimum key."
+		return self._popmin()
+
+	def _popmin(self):
 		if self._root is None:
 			raise KeyError('Empty %s object' % self.__class__.__name__)
-		key = self.min()
-		value = self.get(key)
-		self._root = self._root.delmin()
+		freed = None if self._pool is None else []
+		self._root, key, value = self._root.popmin(freed)
+		if freed:
+			self._recycle(freed)
+		if self._index is not None:
+			del self._index[key]
+		elif self._root is not None:
+			self._resize()
 		return (key, value)
 
 	def popmax(self):
 		"Pop the (key, value) tuple corresponding with the maximum key."
+		return self._popmax()
+
+	def _popmax(self):
 		if self._root is None:
 			raise KeyError('Empty %s object' % self.__class__.__name__)
-		key = self.max()
-		value = self.get(key)
-		self._root = self._root.delete(key)
+		freed = None if self._pool is None else []
+		self._root, key, value = self._root.popmax(freed)
+		self._last = _MISSING
+		if freed:
+			self._recycle(freed)
+		if self._index is not None:
+			del self._index[key]
+		elif self._root is not None:
+			self._resize()
 		return (key, value)
 
+	def poprange(self, lo=None, hi=None):
+		"""Remove the keys k such that lo <= k < hi. Return the removed pairs.
+
+		Either bound may be `None` to leave that end open. The (key, value)
+		pairs are returned in order. Rather than deleting key by key, the tree
+		is split around the range and the outer parts are joined again, so the
+		restructuring work does not grow with the number of keys removed.
+		"""
+		return self._poprange(lo, hi)
+
+	def _poprange(self, lo=None, hi=None):
+		if (self._root is None or
+				lo is not None and hi is not None and not lo < hi):
+			return []
+		self._last = _MISSING
+		if self._root.__class__ is _SortedArray:
+			self._root, popped = self._root.poprange(lo, hi)
+			return popped
+		head, rest = (None, self._root) if lo is None else self._root.split(lo)
+		if hi is None or rest is None:
+			mid, tail = rest, None
+		else:
+			mid, tail = rest.split(hi)
+		if head is None or tail is None:
+			self._root = tail if head is None else head
+		else:
+			x = tail
+			while x._left is not None:
+				x = x._left
+			self._root = _Node._join(head, x, tail.delmin())
+		if mid is None:
+			return []
+		popped = [(x._key, x._value) for x in mid._nodes()]
+		if self._pool is not None:
+			self._recycle(list(mid._nodes()))
+		if self._index is not None:
+			for key, value in popped:
+				del self._index[key]
+		elif self._root is not None:
+			self._resize()
+		return popped
+
 	def min(self):
 		"Return the least key."
 		if self._root is None:
@@ -508,6 +1452,55 @@ class BinarySearchTree:
 			raise KeyError(key)
 		return self._root.ceiling(key)
 
+	def nearest(self, key, k=1, distance=None):
+		"""Return a list of the `k` keys nearest to the given key, nearest first.
+
+		`distance` is a function of two keys returning a comparable distance; by
+		default it is the absolute value of their difference. Ties go to the
+		lesser key. Fewer than `k` keys are returned only if the tree has fewer.
+		This takes one descent plus O(k) steps outward from `key`.
+		"""
+		if self._root is None or k <= 0:
+			return []
+		if distance is None:
+			distance = _abs_difference
+		below, above = self._root._neighbors(key)
+		b, a = next(below, _MISSING), next(above, _MISSING)
+		result = []
+		while len(result) < k and (a is not _MISSING or b is not _MISSING):
+			if a is _MISSING or b is not _MISSING and not (
+					distance(a, key) < distance(b, key)):
+				result.append(b)
+				b = next(below, _MISSING)
+			else:
+				result.append(a)
+				a = next(above, _MISSING)
+		return result
+
+	def within(self, key, radius, distance=None):
+		"""Return a list, in order, of the keys within `radius` of the given key.
+
+		`distance` is as for `nearest`. It must grow as keys move away from
+		`key` in either direction. This takes one descent plus a step per key
+		returned, and one more in each direction.
+		"""
+		if self._root is None:
+			return []
+		if distance is None:
+			distance = _abs_difference
+		below, above = self._root._neighbors(key)
+		lower = []
+		for x in below:
+			if distance(x, key) > radius:
+				break
+			lower.append(x)
+		lower.reverse()
+		for x in above:
+			if distance(x, key) > radius:
+				break
+			lower.append(x)
+		return lower
+
 	def rank(self, key):
 		"Return number of keys in the tree that are less than the given key."
 		if self._root is None:
@@ -550,44 +1543,152 @@ class BinarySearchTree:
 		return self._root.width(lo, hi)
 
 
+def _frozen(self, *args, **kwargs):
+	"Stand in for a mutator that a frozen table inherits. Raise TypeError."
+	raise TypeError('{.__name__!r} object is frozen'.format(type(self)))
+
+
 class SortedFrozenMapping(BinarySearchTree, _MappingABC):
 
 	"Mapping of totally ordered keys, which need not be hashable."
 
-	def __init__(self, iterable=()):
+	def __init__(self, iterable=(), *, hash_index=False, pool_size=0,
+				 check_keys=True):
 		"""Instantiate a new SortedFrozenMapping optionally with key-value pairs.
 
 		`iterable` is an optional argument that is either a mapping or is an
 		iterable containing two-item iterables: The first item is the key and
 		the second the value. The `SortedFrozenMapping` will contain these key-value
 		pairs. If keys are repeated, later copies replace earlier ones. The keys
-		must be totally ordered but they need not be hashable.
+		must be totally ordered but they need not be hashable, unless the
+		keyword argument `hash_index` is true. See `BinarySearchTree` for it
+		and the other keyword arguments. Another `SortedFrozenMapping` is copied
+		in linear time.
 		"""
-		super().__init__()
-		self._update(iterable)
+		super().__init__(hash_index=hash_index, pool_size=pool_size,
+						 check_keys=check_keys)
+		if isinstance(iterable, SortedFrozenMapping):
+			self._copy_tree(iterable)
+		else:
+			self._update(iterable)
 
 	def _update(self, iterable):
 		"""Update self with new or replacement values from `iterable`.
 
 		The optional argument `iterable` has the same semantics as it does for
-		the `__init__` method.
+		the `__init__` method. String keys of a collection are sorted before
+		they are inserted. See `_presorted`.
 		"""
 		if isinstance(iterable, _MappingABC):
-			for key in iterable:
+			for key in _presorted(iterable):
 				self._set(key, iterable[key])
 		elif hasattr(iterable, "keys"):
-			for key in iterable.keys():
+			for key in _presorted(iterable.keys()):
 				self._set(key, iterable[key])
 		else:
-			for key, value in iterable:
+			for key, value in _presorted(iterable, _itemgetter(0)):
 				self._set(key, value)
 
+	def copy(self, deep_values=False):
+		"""Return a copy in linear time by copying the tree's shape.
+
+		Keys are shared with the original. So are values, unless `deep_values`
+		is true, when they are deep copied as by `copy.deepcopy`.
+		"""
+		if deep_values:
+			return self.__deepcopy__({})
+		return self._copy()
+
+	__copy__ = copy
+
 	def __getitem__(self, key):
 		"Return the value of the key. Raise KeyError if not in self."
+		if self._index is not None:
+			return self._index[key]._value
 		if self._root is None:
 			raise KeyError(key)
 		return self._root.get(key)
 
+	def __eq__(self, other):
+		"""Return whether `other` is a mapping with equal keys and values.
+
+		Another sorted mapping is compared by walking both trees in lockstep
+		after comparing lengths, which takes linear time and no hashing.
+		"""
+		if isinstance(other, SortedFrozenMapping):
+			if len(self) != len(other):
+				return False
+			for (a, x), (b, y) in zip(self._items(), other._items()):
+				if not (a == b and x == y):
+					return False
+			return True
+		if not isinstance(other, _MappingABC):
+			return NotImplemented
+		if len(self) != len(other):
+			return False
+		for key, value in self._items():
+			try:
+				other_value = other[key]
+			except (KeyError, TypeError): # TypeError for unhashable keys
+				return False
+			if not other_value == value:
+				return False
+		return True
+
+	def _rows(self, lo=None, hi=None):
+		"Return the number of keys k such that lo <= k < hi and their items."
+		root = self._root
+		if root is None:
+			return 0, iter(())
+		i = 0 if lo is None else root.rank(lo)
+		j = len(root) if hi is None else root.rank(hi)
+		return max(0, j - i), root._items(lo, hi)
+
+	def to_arrays(self, lo=None, hi=None, key_dtype=None, value_dtype=None,
+				  numpy=False):
+		"""Return the keys k such that lo <= k < hi and their values as columns.
+
+		The rows are counted first, then the tree is walked once, filling a
+		preallocated column of keys and one of values. A column's dtype may be
+		None for a list. Otherwise, if `numpy` is true, it is any NumPy dtype
+		and the column is a NumPy array; if not, it must be a type code of the
+		`array` module, such as 'd' or 'q', and the column is an `array.array`.
+		"""
+		_check_column(key_dtype, numpy)
+		_check_column(value_dtype, numpy)
+		n, rows = self._rows(lo, hi)
+		return _columns(n, rows, key_dtype, value_dtype, numpy)
+
+	def iter_arrays(self, size, lo=None, hi=None, key_dtype=None,
+					value_dtype=None, numpy=False):
+		"""Iterate over the columns of `to_arrays` in blocks of `size` rows.
+
+		Every block but the last has exactly `size` rows; the last has at least
+		one. Only one block is held in memory at a time. The mapping must not
+		be changed while the blocks are being iterated.
+		"""
+		if size < 1:
+			raise ValueError('size must be positive, not {!r}'.format(size))
+		_check_column(key_dtype, numpy)
+		_check_column(value_dtype, numpy)
+		return self._iter_arrays(size, lo, hi, key_dtype, value_dtype, numpy)
+
+	def _iter_arrays(self, size, lo, hi, key_dtype, value_dtype, numpy):
+		"Generator for `iter_arrays`, which validates its arguments eagerly."
+		n, rows = self._rows(lo, hi)
+		for i in range(0, n, size):
+			yield _columns(min(size, n - i), rows, key_dtype, value_dtype, numpy)
+
+	def __hash__(self):
+		"Hash the key-value pairs, which must be hashable, once and cache it."
+		try:
+			return self._hashcode
+		except AttributeError:
+			self._hashcode = hash(frozenset(self._items()))
+			return self._hashcode
+
+	clear = popmin = popmax = poprange = _frozen
+
 	def __repr__(self):
 		"Return dict-like string representation."
 		clsname = self.__class__.__name__
@@ -599,17 +1700,51 @@ class SortedMapping(SortedFrozenMapping, _MutableMappingABC):
 
 	"Mutable sorted mapping. Add insertion and deletion to SortedFrozenMappings."
 
+	__hash__ = None
+
 	def __delitem__(self, key):
 		"Remove key from the mapping. Raise a KeyError if key is not in the map."
 		self._delete(key)
 
 	def clear(self):
 		"Remove every element from the tree in constant time."
-		self.__init__()
+		self._clear()
+
+	def popmin(self):
+		"Pop the (key, value) pair with the smallest key. Raise KeyError if empty."
+		return self._popmin()
+
+	def popmax(self):
+		"Pop the (key, value) pair with the largest key. Raise KeyError if empty."
+		return self._popmax()
 
 	def popitem(self):
 		"Pop (key, value) pair with smallest key. Raise KeyError if empty."
-		return self.popmin()
+		return self._popmin()
+
+	def pop(self, key, default=_MISSING):
+		"""Remove key and return its value in a single descent of the tree.
+
+		If key is absent, return `default` if given, else raise KeyError.
+		"""
+		item = self._remove(key)
+		if item is not None:
+			return item[1]
+		if default is _MISSING:
+			raise KeyError(key)
+		return default
+
+	def setdefault(self, key, default=None):
+		"Return the value of key, first setting it to `default` if key is absent."
+		return self._setdefault(key, default)
+
+	def poprange(self, lo=None, hi=None):
+		"""Remove the keys k such that lo <= k < hi. Return the removed pairs.
+
+		Either bound may be `None` to leave that end open. The (key, value)
+		pairs are returned in order.
+		"""
+		return self._poprange(lo, hi)
 
 	def __setitem__(self, key, value):
 		self._set(key, value)
@@ -627,45 +1762,1120 @@ class SortedFrozenSet(BinarySearchTree, _SetABC):
 
 	"Set of totally ordered values, which need not be hashable."
 
-	def __init__(self, iterable=()):
+	def __init__(self, iterable=(), *, hash_index=False, pool_size=0,
+				 check_keys=True):
 		"""Instantiate a new SortedSet, optionally with values.
 
 		`iterable` is an optional argument containing an iterable of values to
 		fill up the new `SortedFrozenSet`. If values are repeated (in terms of
 		equality but not identity), later values replace earlier ones. The
-		values must be totally ordered but they need not be hashable.
+		values must be totally ordered but they need not be hashable, unless the
+		keyword argument `hash_index` is true. See `BinarySearchTree` for it
+		and the other keyword arguments. String elements of a collection are
+		sorted first as in `SortedFrozenMapping`. Another `SortedFrozenSet` is
+		copied in linear time.
 		"""
-		super().__init__()
-		for element in iterable:
+		super().__init__(hash_index=hash_index, pool_size=pool_size,
+						 check_keys=check_keys)
+		if isinstance(iterable, SortedFrozenSet):
+			self._copy_tree(iterable)
+			return
+		for element in _presorted(iterable):
 			self._set(element, element)
 
-	def __repr__(self):
-		"Return set-like string representation."
-		clsname = self.__class__.__name__
-		return clsname + '({' + ', '.join(map(repr, self)) + '})'
-
+	def __deepcopy__(self, memo):
+		"Return a copy sharing the elements, which must not change in a set."
+		return self._copy(memo=memo)
+
+	def _issubset(self, other):
+		"Return whether every element is in the sorted set `other`."
+		others = iter(other)
+		for key in self:
+			for o in others:
+				if not o < key:
+					break
+			else:
+				return False
+			if key < o:
+				return False
+		return True
+
+	# The comparisons below walk two sorted sets in lockstep in linear time,
+	# after comparing lengths. Other sets fall back to membership tests.
+
+	def __le__(self, other):
+		if isinstance(other, SortedFrozenSet):
+			return len(self) <= len(other) and self._issubset(other)
+		return super().__le__(other)
+
+	def __lt__(self, other):
+		if isinstance(other, SortedFrozenSet):
+			return len(self) < len(other) and self._issubset(other)
+		return super().__lt__(other)
+
+	def __ge__(self, other):
+		if isinstance(other, SortedFrozenSet):
+			return len(self) >= len(other) and other._issubset(self)
+		return super().__ge__(other)
+
+	def __gt__(self, other):
+		if isinstance(other, SortedFrozenSet):
+			return len(self) > len(other) and other._issubset(self)
+		return super().__gt__(other)
+
+	def __eq__(self, other):
+		if isinstance(other, SortedFrozenSet):
+			if len(self) != len(other):
+				return False
+			for a, b in zip(self, other):
+				if not a == b:
+					return False
+			return True
+		return super().__eq__(other)
+
+	def isdisjoint(self, other):
+		"Return whether the set and the iterable `other` share no elements."
+		if not isinstance(other, SortedFrozenSet):
+			return super().isdisjoint(other)
+		mine, others = iter(self), iter(other)
+		a, b = next(mine, _MISSING), next(others, _MISSING)
+		while a is not _MISSING and b is not _MISSING:
+			if a < b:
+				a = next(mine, _MISSING)
+			elif b < a:
+				b = next(others, _MISSING)
+			else:
+				return False
+		return True
+
+	def __hash__(self):
+		"Hash the elements like a frozenset, once, and cache it."
+		try:
+			return self._hashcode
+		except AttributeError:
+			self._hashcode = self._hash()
+			return self._hashcode
+
+	clear = popmin = popmax = poprange = _frozen
+
+	def __repr__(self):
+		"Return set-like string representation."
+		clsname = self.__class__.__name__
+		return clsname + '({' + ', '.join(map(repr, self)) + '})'
+
 
 class SortedSet(SortedFrozenSet, _MutableSetABC):
 
 	"Mutable sorted set. Add insertion and deletion to SortedFrozenSet."
 
+	__hash__ = None
+
 	def add(self, item):
 		"Add an item to the set, replacing older items that are equal."
 		self._set(item, item)
 
 	def discard(self, value):
 		"Remove an element.  Do not raise an exception if absent."
-		try:
-			self._delete(value)
-		except KeyError:
-			pass
+		self._remove(value)
+
+	def remove(self, value):
+		"Remove an element. Raise KeyError if absent."
+		self._delete(value)
+
+	def clear(self):
+		"Remove every element from the tree in constant time."
+		self._clear()
+
+	def popmin(self):
+		"Remove and return smallest element. Raise KeyError if set empty."
+		return self._popmin()[0]
+
+	pop = popmin
+
+	def popmax(self):
+		"Remove and return largest element. Raise KeyError if set empty."
+		return self._popmax()[0]
+
+	def poprange(self, lo=None, hi=None):
+		"Remove and return, in order, the elements e such that lo <= e < hi."
+		return [key for key, value in self._poprange(lo, hi)]
+
+
+class BoundedSortedSet(SortedSet):
+
+	"""Sorted set that keeps only its `maxlen` largest (or smallest) elements.
+
+	Adding an element to a full set evicts the smallest element if `keep` is
+	'largest' (the default) or the largest if `keep` is 'smallest'. Candidates
+	that would be evicted immediately are rejected with a single comparison to
+	a cached boundary element without touching the tree, so tracking the top K
+	elements of a long stream costs O(log K) only for accepted elements.
+	"""
+
+	def __init__(self, iterable=(), *, maxlen, keep='largest', hash_index=False,
+				 pool_size=0, check_keys=True):
+		"""Instantiate a new BoundedSortedSet, optionally with values.
+
+		`iterable` has the same semantics as for `SortedSet`, except that only
+		the `maxlen` elements to keep are retained.
+		"""
+		if maxlen < 1:
+			raise ValueError('maxlen must be positive, not {!r}'.format(maxlen))
+		if keep not in ('largest', 'smallest'):
+			raise ValueError("keep must be 'largest' or 'smallest', not "
+							 "{!r}".format(keep))
+		super().__init__(hash_index=hash_index, pool_size=pool_size,
+						 check_keys=check_keys)
+		self._maxlen = maxlen
+		self._keep = keep
+		self._boundary = _MISSING
+		for element in iterable:
+			self.add(element)
+
+	@property
+	def maxlen(self):
+		"Maximum number of elements kept."
+		return self._maxlen
+
+	@property
+	def keep(self):
+		"Which elements are kept: 'largest' or 'smallest'."
+		return self._keep
+
+	@classmethod
+	def _from_iterable(cls, iterable):
+		"Return the unbounded result of a set operation as a `SortedSet`."
+		return SortedSet(iterable)
+
+	def __repr__(self):
+		"Return set-like string representation."
+		return '{}, maxlen={!r}, keep={!r})'.format(
+			super().__repr__()[:-1], self._maxlen, self._keep)
+
+	def add(self, item):
+		"Add an item, evicting the boundary element if the set overflows."
+		if len(self) < self._maxlen:
+			self._boundary = _MISSING
+			self._set(item, item)
+			return
+		boundary = self._boundary
+		largest = self._keep == 'largest'
+		if boundary is _MISSING:
+			boundary = self._boundary = self.min() if largest else self.max()
+		if not (item > boundary if largest else item < boundary):
+			return
+		# One descent both inserts the item and finds it already present
+		self._setdefault(item, item)
+		if len(self) > self._maxlen:
+			if largest:
+				super().popmin()
+			else:
+				super().popmax()
+			self._boundary = self.min() if largest else self.max()
+
+	def _remove(self, key):
+		"Remove key like `BinarySearchTree._remove`, forgetting the boundary."
+		self._boundary = _MISSING
+		return super()._remove(key)
+
+	def clear(self):
+		"Remove every element from the tree in constant time."
+		self._boundary = _MISSING
+		super().clear()
 
 	def popmin(self):
 		"Remove and return smallest element. Raise KeyError if set empty."
-		return super().popmin()[0]
+		self._boundary = _MISSING
+		return super().popmin()
 
 	pop = popmin
 
 	def popmax(self):
 		"Remove and return largest element. Raise KeyError if set empty."
-		return super().popmax()[0]
+		self._boundary = _MISSING
+		return super().popmax()
+
+	def poprange(self, lo=None, hi=None):
+		"Remove and return, in order, the elements e such that lo <= e < hi."
+		self._boundary = _MISSING
+		return super().poprange(lo, hi)
+
+
+class _RadixNode:
+
+	"""Node of the radix tree behind `SortedStrMapping`.
+
+	`label` is the string on the edge from the parent, `children` maps the
+	first character of each child's label to the child, `value` is `_MISSING`
+	unless a key ends here, and `_N` counts the keys in the subtree. Children
+	are kept in no particular order: walks in key order sort the few first
+	characters of a node's children as they go. Leaves, the majority of nodes,
+	share one empty `children` until they get a child.
+	"""
+
+	__slots__ = 'label', 'children', 'value', '_N'
+
+	_NO_CHILDREN = {} # Never mutated: _add replaces it first.
+
+	def __init__(self, label, value=_MISSING, N=0):
+		self.label = label
+		self.children = self._NO_CHILDREN
+		self.value = value
+		self._N = N
+
+	def _add(self, child):
+		"Link `child` under the first character of its label."
+		if not self.children:
+			self.children = {}
+		self.children[child.label[0]] = child
+
+	def _remove(self, char):
+		"Unlink the child whose label starts with `char`."
+		del self.children[char]
+		if not self.children:
+			self.children = self._NO_CHILDREN
+
+	def _sorted(self, reverse=False):
+		"Return the children in the order of their labels."
+		children = self.children
+		return [children[char] for char in sorted(children, reverse=reverse)]
+
+	def _clone(self, memo=None):
+		"""Return a copy of the node that shares its children.
+
+		If `memo` is given, deep copy the value with it.
+		"""
+		new = _RadixNode.__new__(_RadixNode)
+		new.label, new.children = self.label, self.children
+		new.value, new._N = self.value, self._N
+		if memo is not None and self.value is not _MISSING:
+			new.value = _deepcopy(self.value, memo)
+		return new
+
+	def _copy(self, memo=None):
+		"Return a copy of the subtree, sharing its labels. See `_clone`."
+		root = self._clone(memo)
+		stack = [root]
+		while stack:
+			x = stack.pop()
+			if x.children:
+				x.children = {char: child._clone(memo)
+							  for char, child in x.children.items()}
+				stack.extend(x.children.values())
+		return root
+
+
+class _SortedStrItemsView(_ItemsViewABC):
+
+	def __iter__(self):
+		return self._mapping._items()
+
+	def __reversed__(self):
+		return self._mapping._items(reverse=True)
+
+
+class _SortedStrValuesView(_ValuesViewABC):
+
+	def __iter__(self):
+		return (value for key, value in self._mapping._items())
+
+	def __reversed__(self):
+		return (value for key, value in self._mapping._items(reverse=True))
+
+
+class SortedStrMapping(_MutableMappingABC):
+
+	"""Sorted mapping of `str` or `bytes` keys stored in a radix tree.
+
+	Keys that share a prefix share the nodes that spell it, so the prefix is
+	stored and compared once rather than once per key and per tree level. All
+	keys must have the same type, `str` or `bytes`. The ordered methods match
+	those of `SortedFrozenMapping`, and `prefix_items` and `longest_prefix_of`
+	answer prefix queries. Rank-based methods take time proportional to the
+	key's length times the alphabet's size in the worst case, independent of
+	the number of keys.
+
+	Nodes, labels, and child tables cost a couple of hundred bytes per key, so
+	the tree takes less memory than a `SortedMapping` and its keys only when
+	the keys share prefixes around a hundred characters long or longer, such as
+	paths under deep common directories.
+	"""
+
+	def __init__(self, iterable=()):
+		"""Instantiate a new SortedStrMapping optionally with key-value pairs.
+
+		`iterable` has the same semantics as for `SortedFrozenMapping`.
+		"""
+		self._root = _RadixNode(None)
+		self.update(iterable)
+
+	def _check(self, key):
+		"Raise TypeError unless key has the type of the keys already present."
+		label = self._root.label
+		if label is None:
+			if not isinstance(key, (str, bytes)):
+				raise TypeError("{.__name__!r} keys must be str or bytes, not "
+								"{.__name__!r}".format(type(self), type(key)))
+			self._root.label = key[:0]
+		elif not isinstance(key, type(label)):
+			raise TypeError("{.__name__!r} can't mix {.__name__!r} and "
+							"{.__name__!r} keys".format(type(self), type(label),
+														type(key)))
+
+	def _find(self, key):
+		"Return the node where key ends, or `None` if key is absent."
+		label = self._root.label
+		if label is None:
+			return None
+		if key.__class__ is not label.__class__:
+			self._check(key)
+		node, i, n = self._root, 0, len(key)
+		while i < n:
+			node = node.children.get(key[i])
+			if node is None or not key.startswith(node.label, i):
+				return None
+			i += len(node.label)
+		return None if node.value is _MISSING else node
+
+	def __len__(self):
+		return self._root._N
+
+	def __contains__(self, key):
+		return self._find(key) is not None
+
+	def __getitem__(self, key):
+		node = self._find(key)
+		if node is None:
+			raise KeyError(key)
+		return node.value
+
+	def get(self, key, default=None):
+		node = self._find(key)
+		return default if node is None else node.value
+
+	def __setitem__(self, key, value):
+		self._check(key)
+		node, i, n = self._root, 0, len(key)
+		path = [node]
+		while i < n:
+			char = key[i]
+			child = node.children.get(char)
+			if child is None:
+				node._add(_RadixNode(key[i:], value, 1))
+				break
+			label = child.label
+			if key.startswith(label, i):
+				node = child
+				path.append(node)
+				i += len(label)
+				continue
+			# Split the edge where key and label diverge.
+			j, m = 1, min(len(label), n - i)
+			while j < m and label[j] == key[i + j]:
+				j += 1
+			middle = _RadixNode(label[:j], N=child._N + 1)
+			child.label = label[j:]
+			middle._add(child)
+			node.children[char] = middle
+			if i + j == n:
+				middle.value = value
+			else:
+				middle._add(_RadixNode(key[i + j:], value, 1))
+			break
+		else:
+			if node.value is not _MISSING:
+				node.value = value
+				return
+			node.value = value
+		for x in path:
+			x._N += 1
+
+	def __delitem__(self, key):
+		if self._root.label is None:
+			raise KeyError(key)
+		self._check(key)
+		node, i, n = self._root, 0, len(key)
+		path = []
+		while i < n:
+			child = node.children.get(key[i])
+			if child is None or not key.startswith(child.label, i):
+				raise KeyError(key)
+			path.append(node)
+			node = child
+			i += len(child.label)
+		if node.value is _MISSING:
+			raise KeyError(key)
+		node.value = _MISSING
+		path.append(node)
+		for x in path:
+			x._N -= 1
+		path.pop()
+		# Prune the emptied node and keep every edge compressed.
+		if path and not node.children:
+			parent = path.pop()
+			parent._remove(node.label[0])
+			node = parent
+		if path and node.value is _MISSING and len(node.children) == 1:
+			for child in node.children.values():
+				child.label = node.label + child.label
+				path[-1].children[child.label[0]] = child
+
+	def clear(self):
+		"Remove every key in constant time."
+		self._root = _RadixNode(None)
+
+	def copy(self, deep_values=False):
+		"""Return a copy in linear time by copying the tree's nodes.
+
+		Keys are shared with the original. So are values, unless `deep_values`
+		is true, when they are deep copied as by `copy.deepcopy`.
+		"""
+		copy = self.__class__.__new__(self.__class__)
+		copy.__dict__.update(self.__dict__)
+		copy._root = self._root._copy({} if deep_values else None)
+		return copy
+
+	__copy__ = copy
+
+	def items(self):
+		return _SortedStrItemsView(self)
+
+	def values(self):
+		return _SortedStrValuesView(self)
+
+	def __iter__(self):
+		"Iterate through the keys in order."
+		return (key for key, value in self._items())
+
+	def __reversed__(self):
+		"Iterate through the keys in reverse order."
+		return (key for key, value in self._items(reverse=True))
+
+	def _items(self, lo=None, hi=None, reverse=False, start=None):
+		"""Iterate through (key, value) pairs such that lo <= key < hi.
+
+		Subtrees wholly outside the bounds are skipped. `start` is an optional
+		(node, prefix) pair at which to start instead of the root.
+		"""
+		if self._root.label is None:
+			return
+		node, prefix = start or (self._root, self._root.label)
+		if reverse:
+			stack = [(node, prefix, False)]
+			while stack:
+				node, prefix, expanded = stack.pop()
+				if expanded:
+					if lo is not None and prefix < lo:
+						return
+					if hi is None or prefix < hi:
+						yield prefix, node.value
+					continue
+				if lo is not None and prefix < lo[:len(prefix)]:
+					return
+				if hi is not None and not prefix < hi:
+					continue
+				if node.value is not _MISSING:
+					stack.append((node, prefix, True))
+				for child in node._sorted():
+					stack.append((child, prefix + child.label, False))
+		else:
+			stack = [(node, prefix)]
+			while stack:
+				node, prefix = stack.pop()
+				if hi is not None and not prefix < hi:
+					return
+				if lo is not None and prefix < lo[:len(prefix)]:
+					continue
+				if node.value is not _MISSING and (lo is None or not prefix < lo):
+					yield prefix, node.value
+				for child in node._sorted(reverse=True):
+					stack.append((child, prefix + child.label))
+
+	def range(self, *args):
+		"Return iterator over keys with arguments like builtin.range()."
+		s = slice(*args)
+		if s.step is None or s.step == 1:
+			items = self._items(s.start, s.stop)
+		elif s.step == -1:
+			items = self._items(s.stop, s.start, reverse=True)
+		else:
+			raise ValueError('{.__name__!s} objects only support range steps of '
+							 '1 and -1, not {!r}'.format(type(self), s.step))
+		return (key for key, value in items)
+
+	def prefix_items(self, prefix):
+		"Iterate in order through the (key, value) pairs whose keys start with prefix."
+		if self._root.label is None:
+			return iter([])
+		self._check(prefix)
+		node, i, n = self._root, 0, len(prefix)
+		while i < n:
+			node = node.children.get(prefix[i])
+			if node is None:
+				return iter([])
+			if prefix.startswith(node.label, i):
+				i += len(node.label)
+			elif node.label.startswith(prefix[i:]):
+				return self._items(start=(node, prefix[:i] + node.label))
+			else:
+				return iter([])
+		return self._items(start=(node, prefix))
+
+	def longest_prefix_of(self, key):
+		"Return the longest key that is a prefix of key. Raise KeyError if none."
+		if self._root.label is None:
+			raise KeyError(key)
+		self._check(key)
+		node, i, n = self._root, 0, len(key)
+		best = 0 if node.value is not _MISSING else None
+		while i < n:
+			node = node.children.get(key[i])
+			if node is None or not key.startswith(node.label, i):
+				break
+			i += len(node.label)
+			if node.value is not _MISSING:
+				best = i
+		if best is None:
+			raise KeyError(key)
+		return key[:best]
+
+	def rank(self, key):
+		"Return number of keys in the mapping that are less than the given key."
+		if self._root.label is None:
+			return 0
+		self._check(key)
+		node, i, n = self._root, 0, len(key)
+		count = 0
+		while i < n:
+			if node.value is not _MISSING:
+				count += 1
+			char = key[i]
+			for c, child in node.children.items():
+				if c < char:
+					count += child._N
+			child = node.children.get(char)
+			if child is None:
+				return count
+			label = child.label
+			segment = key[i:i + len(label)]
+			if segment != label:
+				return count + child._N if label < segment else count
+			node = child
+			i += len(label)
+		return count
+
+	def select(self, k):
+		"Return the key with rank k. Raise IndexError if k out of bounds."
+		if k < 0 or k >= len(self):
+			raise IndexError('Requested rank %r out of bounds' % k)
+		node = self._root
+		parts = [node.label]
+		while True:
+			if node.value is not _MISSING:
+				if k == 0:
+					return node.label[:0].join(parts)
+				k -= 1
+			for child in node._sorted():
+				if k < child._N:
+					node = child
+					parts.append(node.label)
+					break
+				k -= child._N
+
+	def index(self, key, start=None, stop=None):
+		"""Index i of key in self, optionally such that start <= i < stop.
+
+		This is essentially the rank method with the same semantics as
+		`list.index`. if `key` is not present, a `KeyError` is raised.
+		"""
+		if key not in self:
+			raise KeyError(key)
+		r = self.rank(key)
+		if start is not None and start > r or stop is not None and r >= stop:
+			raise KeyError(key)
+		return r
+
+	def width(self, lo, hi):
+		"The number of keys k such that lo <= k < hi."
+		if lo > hi:
+			lo, hi = hi, lo
+		return self.rank(hi) - self.rank(lo)
+
+	def min(self):
+		"Return the least key."
+		if not self:
+			raise ValueError('No min of an empty container.')
+		return self.select(0)
+
+	def max(self):
+		"Return the greatest key."
+		if not self:
+			raise ValueError('No max of an empty container.')
+		return self.select(len(self) - 1)
+
+	def floor(self, key):
+		"Return the greatest key <= the given key. Raise a KeyError if none present."
+		if key in self:
+			return key
+		r = self.rank(key)
+		if r == 0:
+			raise KeyError(key)
+		return self.select(r - 1)
+
+	def ceiling(self, key):
+		"Return the least key >= the given key. Raise a KeyError if none present."
+		r = self.rank(key)
+		if r == len(self):
+			raise KeyError(key)
+		return self.select(r)
+
+	def popmin(self):
+		"Pop the (key, value) tuple corresponding with the minimum key."
+		if not self:
+			raise KeyError('Empty %s object' % self.__class__.__name__)
+		key = self.select(0)
+		return key, self.pop(key)
+
+	def popmax(self):
+		"Pop the (key, value) tuple corresponding with the maximum key."
+		if not self:
+			raise KeyError('Empty %s object' % self.__class__.__name__)
+		key = self.select(len(self) - 1)
+		return key, self.pop(key)
+
+	def popitem(self):
+		"Pop (key, value) pair with smallest key. Raise KeyError if empty."
+		return self.popmin()
+
+	def __repr__(self):
+		"Return dict-like string representation."
+		clsname = self.__class__.__name__
+		items = (': '.join([repr(k), repr(v)]) for k, v in self._items())
+		return clsname + '({' + ', '.join(items) + '})'
+
+
+class _Expiry:
+
+	"""Tree key of an `ExpiringMapping` entry.
+
+	It hashes like the mapping's key and compares equal to it, or to another
+	entry with an equal key, so that the key alone finds the entry through the
+	tree's hash index. It is ordered by expiration time and then by a counter
+	of when it was set. Each key has one entry in the tree, so the two notions
+	of equality agree there.
+	"""
+
+	__slots__ = 'key', 'time', 'count'
+
+	def __init__(self, key, time, count):
+		self.key = key
+		self.time = time
+		self.count = count
+
+	def __hash__(self):
+		return hash(self.key)
+
+	def __eq__(self, other):
+		if other.__class__ is _Expiry:
+			other = other.key
+		return self.key == other
+
+	def __lt__(self, other):
+		return (self.time, self.count) < (other.time, other.count)
+
+	def __gt__(self, other):
+		return (self.time, self.count) > (other.time, other.count)
+
+	def __reduce__(self):
+		return _Expiry, (self.key, self.time, self.count)
+
+
+class _ExpiryTree(BinarySearchTree):
+
+	"The entries of an `ExpiringMapping`: `_Expiry` keys with a hash index."
+
+	def __init__(self):
+		super().__init__(hash_index=True)
+
+	def entry(self, key):
+		"Return key's `_Expiry` and value, or `None` if key is absent."
+		node = self._index.get(key)
+		return None if node is None else (node._key, node._value)
+
+	def insert(self, key, value, time, count):
+		"Add an entry for key, which must be absent, expiring at `time`."
+		self._set(_Expiry(key, time, count), value)
+
+	def remove(self, key):
+		"Remove key's entry. Return whether it was present."
+		# The tree is descended by the stored entry's time, which key lacks.
+		node = self._index.get(key)
+		if node is None:
+			return False
+		self._remove(node._key)
+		return True
+
+	def popfirst(self):
+		"Remove the entry that expires first. Return its key."
+		return self._popmin()[0].key
+
+	def expire(self, now):
+		"Remove the entries expiring at or before `now`. Return how many."
+		if self._root is None or self.min().time > now:
+			return 0
+		return len(self._poprange(hi=_Expiry(_MISSING, now, _INF)))
+
+	clear = BinarySearchTree._clear
+
+
+class ExpiringMapping(_MutableMappingABC):
+
+	"""Mapping whose entries expire after a time to live or beyond a maximum size.
+
+	Keys must be hashable. The entries are kept in a single tree with a hash
+	index (see `BinarySearchTree`), which serves point access by key while the
+	tree orders the entries by their expiration time and then by when they
+	were set, so expired entries are evicted from its low end in a single
+	batch using `poprange`. Setting a key again restamps it; reading it does
+	not. Iteration runs from the entry that expires (or was set) first.
+
+	`ttl`, if not `None`, is the default time to live in seconds. `maxlen`, if
+	not `None`, is the maximum number of entries; setting a new key when the
+	mapping is full first evicts the entry that would expire first. `clock` is
+	a function returning the current time in seconds, by default
+	`time.monotonic`.
+	"""
+
+	def __init__(self, iterable=(), *, ttl=None, maxlen=None, clock=_monotonic):
+		"""Instantiate a new ExpiringMapping, optionally with key-value pairs.
+
+		`iterable` has the same semantics as for `dict.update`.
+		"""
+		if ttl is not None and ttl <= 0:
+			raise ValueError('ttl must be positive, not {!r}'.format(ttl))
+		if maxlen is not None and maxlen < 1:
+			raise ValueError('maxlen must be positive, not {!r}'.format(maxlen))
+		self._ttl = ttl
+		self._maxlen = maxlen
+		self._clock = clock
+		self._order = _ExpiryTree()
+		self._count = 0
+		self.update(iterable)
+
+	@property
+	def ttl(self):
+		"Default time to live in seconds, or `None`."
+		return self._ttl
+
+	@property
+	def maxlen(self):
+		"Maximum number of entries, or `None`."
+		return self._maxlen
+
+	def set(self, key, value, ttl=None):
+		"Set key to value, expiring after `ttl` seconds instead of the default."
+		if ttl is not None and ttl <= 0:
+			raise ValueError('ttl must be positive, not {!r}'.format(ttl))
+		now = self._clock()
+		order = self._order
+		order.expire(now)
+		order.remove(key)
+		# Evict before inserting, so that the new entry is never the one to go.
+		if self._maxlen is not None and len(order) >= self._maxlen:
+			order.popfirst()
+		if ttl is None:
+			ttl = self._ttl
+		# The counter keeps entries unique and, for a fixed ttl, increasing, so
+		# they are appended to the tree's right spine.
+		order.insert(key, value, _INF if ttl is None else now + ttl, self._count)
+		self._count += 1
+
+	__setitem__ = set
+
+	def __getitem__(self, key):
+		"Return the value of the key. Raise KeyError if absent or expired."
+		entry = self._order.entry(key)
+		if entry is None:
+			raise KeyError(key)
+		expiry, value = entry
+		if expiry.time != _INF:
+			now = self._clock()
+			if expiry.time <= now:
+				self._order.expire(now)
+				raise KeyError(key)
+		return value
+
+	def __contains__(self, key):
+		"Return whether key is present and unexpired."
+		entry = self._order.entry(key)
+		return entry is not None and (entry[0].time == _INF or
+									  entry[0].time > self._clock())
+
+	def __delitem__(self, key):
+		"Remove key. Raise KeyError if absent or expired."
+		self[key]
+		self._order.remove(key)
+
+	def __len__(self):
+		"Return the number of unexpired entries."
+		self.expire()
+		return len(self._order)
+
+	def __iter__(self):
+		"Iterate through unexpired keys from the first to expire to the last."
+		self.expire()
+		for expiry in self._order:
+			yield expiry.key
+
+	def clear(self):
+		"Remove every entry in constant time."
+		self._order.clear()
+
+	def copy(self, deep_values=False):
+		"""Return a copy with the same entries, expiration times, and settings.
+
+		Keys are shared with the original. So are values, unless `deep_values`
+		is true, when they are deep copied as by `copy.deepcopy`.
+		"""
+		copy = self.__class__.__new__(self.__class__)
+		copy.__dict__.update(self.__dict__)
+		if deep_values:
+			copy._order = _deepcopy(self._order)
+		else:
+			copy._order = self._order.copy()
+		return copy
+
+	__copy__ = copy
+
+	def expire(self):
+		"Evict every expired entry. Return the number of entries evicted."
+		return self._order.expire(self._clock())
+
+	def __repr__(self):
+		"Return dict-like string representation."
+		items = (': '.join([repr(k), repr(v)]) for k, v in self.items())
+		return '{}({{{}}}, ttl={!r}, maxlen={!r})'.format(
+			self.__class__.__name__, ', '.join(items), self._ttl, self._maxlen)
+
+
+class SortedMergeView:
+
+	"""Read-only ordered view of several sorted tables merged together.
+
+	`tables` is an iterable of `BinarySearchTree` instances, such as sharded
+	`SortedMapping`s, ordered from oldest to newest. The view does not copy
+	them: iteration merges their in-order traversals lazily through a heap, so
+	it reflects the tables' current contents and costs O(log k) per key for k
+	tables.
+
+	If `dedupe` is true, a key present in several tables is produced once,
+	with the value from the newest table that has it. Otherwise each table's
+	copy is produced, newest first. Either way, `rank` and `width` sum over
+	the tables and so count every copy.
+	"""
+
+	def __init__(self, tables, *, dedupe=False):
+		self._tables = tuple(tables)
+		self._dedupe = dedupe
+
+	@property
+	def tables(self):
+		"The merged tables, oldest first."
+		return self._tables
+
+	def __iter__(self):
+		"Iterate through the keys in order."
+		return (key for key, value in self._merge(None, None, False))
+
+	def __reversed__(self):
+		"Iterate through the keys in reverse order."
+		return (key for key, value in self._merge(None, None, True))
+
+	def items(self, lo=None, hi=None):
+		"Iterate through (key, value) pairs with lo <= key < hi in key order."
+		return self._merge(lo, hi, False)
+
+	def range(self, *args):
+		"Return iterator over keys with arguments like builtin.range()."
+		s = slice(*args)
+		if s.step is None or s.step == 1:
+			items = self._merge(s.start, s.stop, False)
+		elif s.step == -1:
+			items = self._merge(s.stop, s.start, True)
+		else:
+			raise ValueError('{.__name__!s} objects only support range steps of '
+							 '1 and -1, not {!r}'.format(type(self), s.step))
+		return (key for key, value in items)
+
+	def _merge(self, lo, hi, reverse):
+		"Lazily merge the tables' (key, value) pairs with lo <= key < hi."
+		heap = []
+		for i, table in enumerate(self._tables):
+			items = table._items(lo, hi, reverse)
+			x = next(items, None)
+			if x is not None:
+				heap.append(_MergeEntry(x, -i, items, reverse))
+		_heapify(heap)
+		last = _MISSING
+		while heap:
+			entry = heap[0]
+			x = entry.item
+			if not (self._dedupe and last is not _MISSING and x[0] == last):
+				last = x[0]
+				yield x
+			entry.item = next(entry.items, None)
+			if entry.item is None:
+				_heappop(heap)
+			else:
+				_heapreplace(heap, entry)
+
+	def __contains__(self, key):
+		"Return whether any table contains key."
+		return any(key in table for table in self._tables)
+
+	def get(self, key, default=None):
+		"Return the value of key from the newest table containing it, or default."
+		for table in reversed(self._tables):
+			value = table.get(key, _MISSING)
+			if value is not _MISSING:
+				return value
+		return default
+
+	def min(self):
+		"Return the least key."
+		keys = [table.min() for table in self._tables if table]
+		if not keys:
+			raise ValueError('No min of an empty container.')
+		return min(keys)
+
+	def max(self):
+		"Return the greatest key."
+		keys = [table.max() for table in self._tables if table]
+		if not keys:
+			raise ValueError('No max of an empty container.')
+		return max(keys)
+
+	def floor(self, key):
+		"Return the greatest key <= the given key. Raise a KeyError if none present."
+		best = _MISSING
+		for table in self._tables:
+			try:
+				k = table.floor(key)
+			except KeyError:
+				continue
+			if best is _MISSING or best < k:
+				best = k
+		if best is _MISSING:
+			raise KeyError(key)
+		return best
+
+	def ceiling(self, key):
+		"Return the least key >= the given key. Raise a KeyError if none present."
+		best = _MISSING
+		for table in self._tables:
+			try:
+				k = table.ceiling(key)
+			except KeyError:
+				continue
+			if best is _MISSING or k < best:
+				best = k
+		if best is _MISSING:
+			raise KeyError(key)
+		return best
+
+	def rank(self, key):
+		"Return number of keys in all the tables that are less than the given key."
+		return sum(table.rank(key) for table in self._tables)
+
+	def width(self, lo, hi):
+		"The number of keys k in all the tables such that lo <= k < hi."
+		return sum(table.width(lo, hi) for table in self._tables)
+
+	def __repr__(self):
+		return '{.__name__}({!r}, dedupe={!r})'.format(
+			type(self), list(self._tables), self._dedupe)
+
+
+class _MergeEntry:
+
+	"Heap entry for one table's traversal in `SortedMergeView._merge`."
+
+	__slots__ = 'item', 'rank', 'items', 'reverse'
+
+	def __init__(self, item, rank, items, reverse):
+		self.item = item
+		self.rank = rank
+		self.items = items
+		self.reverse = reverse
+
+	def __lt__(self, other):
+		a, b = self.item[0], other.item[0]
+		if a == b:
+			return self.rank < other.rank
+		return b < a if self.reverse else a < b
+
+
+def asof_join(left, right, direction='backward', tolerance=None):
+	"""Lazily join each key of `left` to the nearby key of `right`.
+
+	Yield a triple `(key, value, match)` for each key-value pair of `left` in
+	order, where `match` is a `(key, value)` pair from `right` or `None` if
+	nothing matched. With `direction` 'backward', the match is the greatest key
+	of `right` <= `key` (its floor); with 'forward', the least key >= `key`
+	(its ceiling); with 'nearest', whichever of those two is closer, preferring
+	the floor on ties. If `tolerance` is not `None`, matches farther than it
+	from `key` are dropped. Measuring distance, for 'nearest' or `tolerance`,
+	requires that keys support subtraction.
+
+	Both arguments are `BinarySearchTree` instances, such as
+	`SortedFrozenMapping`s. They are walked in lockstep, taking O(n + m) time
+	overall rather than a floor or ceiling query per key of `left`.
+	"""
+	if direction not in ('backward', 'forward', 'nearest'):
+		raise ValueError("direction must be 'backward', 'forward', or 'nearest', "
+						 "not {!r}".format(direction))
+	return _asof_join(left, right, direction, tolerance)
+
+
+def _asof_join(left, right, direction, tolerance):
+	"Generator for `asof_join`, which validates its arguments eagerly."
+	items = right._items()
+	floor, after = None, next(items, None)
+	for key, value in left._items():
+		while after is not None and not key < after[0]:
+			floor, after = after, next(items, None)
+		# Now floor[0] <= key < after[0], where either may be missing.
+		if direction == 'backward':
+			match = floor
+		elif floor is not None and floor[0] == key:
+			match = floor
+		elif direction == 'forward':
+			match = after
+		elif floor is None or after is None:
+			match = after if floor is None else floor
+		else:
+			match = floor if key - floor[0] <= after[0] - key else after
+		if match is not None and tolerance is not None and (
+				key - match[0] if match[0] < key else match[0] - key
+				) > tolerance:
+			match = None
+		yield key, value, match
+
+
+def merge_join(left, right):
+	"""Lazily yield `(key, left_value, right_value)` for keys in both mappings.
+
+	Both arguments are `BinarySearchTree` instances, such as
+	`SortedFrozenMapping`s. They are walked in lockstep in O(n + m) time and the
+	triples are yielded in key order.
+	"""
+	litems, ritems = left._items(), right._items()
+	x, y = next(litems, None), next(ritems, None)
+	while x is not None and y is not None:
+		if x[0] < y[0]:
+			x = next(litems, None)
+		elif y[0] < x[0]:
+			y = next(ritems, None)
+		else:
+			yield x[0], x[1], y[1]
+			x, y = next(litems, None), next(ritems, None)
@@ -1,11 +1,16 @@
 #! /usr/bin/env python3
 import unittest
+import functools
 from unittest import TestCase as _TestCase, main
 from pickle import loads as _pickle_loads, dumps as _pickle_dumps
-from random import shuffle as _shuffle
+from random import (shuffle as _shuffle, randrange as _randrange,
+					choice as _choice)
+from heapq import nlargest as _nlargest, nsmallest as _nsmallest
 from sys import getrecursionlimit as _getrecursionlimit
 from math import log as _log
 from os import getenv as _getenv
+from copy import copy as _copy, deepcopy as _deepcopy
+from array import array as _array
 
 import sortedtable
 
@@ -17,6 +22,39 @@ def slow(test):
 	return test
 
 
+class CountingKey:
+
+	"Totally ordered key that counts the comparisons made on its class."
+
+	count = 0
+
+	def __init__(self, key):
+		self.key = key
+
+	def __eq__(self, other):
+		type(self).count += 1
+		return self.key == other.key
+
+	def __lt__(self, other):
+		type(self).count += 1
+		return self.key < other.key
+
+	def __gt__(self, other):
+		type(self).count += 1
+		return self.key > other.key
+
+	def __le__(self, other):
+		type(self).count += 1
+		return self.key <= other.key
+
+	def __ge__(self, other):
+		type(self).count += 1
+		return self.key >= other.key
+
+	def __repr__(self):
+		return '{.__name__}({!r})'.format(type(self), self.key)
+
+
 class NodeChecker:
 
 	"Check integrity of red-black BST data structure."
@@ -27,9 +65,21 @@ class NodeChecker:
 	def assertNode(self, h):
 		"Check integrity of red-black BST data structure."
 		if isinstance(h, sortedtable.BinarySearchTree):
+			if not self._is_index_consistent(h):
+				raise self.NodeError("Hash index inconsistent with tree")
+			small = h._small_size
 			h = h._root
+		else:
+			small = None
 		if h is None:
 			return True
+		if isinstance(h, sortedtable._SortedArray):
+			if small is not None and len(h) > small:
+				raise self.NodeError("Sorted lists past the small size")
+			if not (len(h._keys) == len(h._values) and
+					all(a < b for a, b in zip(h._keys, h._keys[1:]))):
+				raise self.NodeError("Sorted lists not in strict order")
+			return True
 		if not self._is_23_BST(h):
 			raise self.NodeError("Not in symmetric order or not a 2-3 tree")
 		if not self._is_rank_consistent(h):
@@ -75,6 +125,19 @@ class NodeChecker:
 		return ((h._left is None or self._is_23_BST(h._left, min, h._key)) and
 				(h._right is None or self._is_23_BST(h._right, h._key, max)))
 
+	def _is_index_consistent(self, t):
+		"Return whether the tree's hash index, if any, maps each key to its node."
+		if t._index is None:
+			return True
+		nodes = []
+		stack = [] if t._root is None else [t._root]
+		while stack:
+			x = stack.pop()
+			nodes.append(x)
+			stack.extend(c for c in (x._left, x._right) if c is not None)
+		return (len(nodes) == len(t._index) and
+				all(t._index.get(x._key) is x for x in nodes))
+
 	def _is_rank_consistent(self, h):
 		"""Check that ranks are internally consistent.
 
@@ -161,6 +224,7 @@ class TestBinarySearchTree(NodeChecker, _TestCase):
 		size = len(data)
 		_shuffle(data)
 		t = self.cls()
+		t._small_size = 0 # Always a tree
 		self.assertNode(t)
 		for i in data:
 			t._set(i, i)
@@ -172,14 +236,90 @@ class TestBinarySearchTree(NodeChecker, _TestCase):
 		data = list(range(2 * _getrecursionlimit()))
 		size = len(data)
 		t = self.cls()
+		t._small_size = 0 # Always a tree
 		self.assertNode(t)
 		for i in data:
 			t._set(i, i)
 			self.assertNode(t)
 		self.assertLessEqual(t._root.height(), 2.0 * _log(size, 2))
 
+	def test_append_and_popmin_fifo(self):
+		t = self.cls()
+		window = []
+		for i in range(500):
+			t._set(i, chr(i))
+			window.append(i)
+			self.assertNode(t)
+			if i % 3 == 2:
+				j = window.pop(0)
+				self.assertEqual((j, chr(j)), t.popmin())
+				self.assertNode(t)
+			self.assertEqual(window, list(t))
+		while window:
+			j = window.pop(0)
+			self.assertEqual((j, chr(j)), t.popmin())
+			self.assertNode(t)
+		self.assertRaises(KeyError, t.popmin)
+
+	def test_node_pop_absent_keys(self):
+		keys = list(range(0, 400, 2))
+		_shuffle(keys)
+		root = None
+		for k in keys:
+			root = sortedtable._Node(k, chr(k)) if root is None else root.set(k, chr(k))
+		present = set(keys)
+		queries = list(range(-1, 402))
+		_shuffle(queries)
+		for k in queries:
+			root, item = root.pop(k)
+			if k in present:
+				self.assertEqual((k, chr(k)), item)
+				present.remove(k)
+			else:
+				self.assertIsNone(item)
+			if root is None:
+				break
+			self.assertNode(root)
+			self.assertEqual(sorted(present), list(root))
+			root = root.delete(k + 1) # Usually absent
+			present.discard(k + 1)
+			if root is None:
+				break
+			self.assertNode(root)
+			self.assertEqual(sorted(present), list(root))
+		self.assertEqual(set(), present)
+
+	def test_append_compares_once(self):
+		t = self.cls()
+		for i in range(1000):
+			t._set(CountingKey(i), i)
+		CountingKey.count = 0
+		t._set(CountingKey(1000), 1000)
+		self.assertLessEqual(CountingKey.count, 2)
+		self.assertNode(t)
+		CountingKey.count = 0
+		t._set(CountingKey(500.5), 500.5)
+		self.assertGreater(CountingKey.count, 2)
+		self.assertNode(t)
+
+	def test_append_after_removing_max(self):
+		for remove in (lambda t: t.popmax(), lambda t: t._delete(t.max()),
+					   lambda t: t.poprange(t.max())):
+			t = self.cls()
+			for i in range(300):
+				t._set(CountingKey(i), i)
+			remove(t)
+			CountingKey.count = 0
+			t._set(CountingKey(298.5), None)
+			self.assertLessEqual(CountingKey.count, 2)
+			t._set(CountingKey(298.25), None)
+			self.assertNode(t)
+			self.assertEqual([297, 298, 298.25, 298.5],
+							 [k.key for k in list(t)[-4:]])
+
 	def _int_keys(self, data):
 		t = self.cls()
+		t._small_size = 0 # Always a tree
 		self.assertNode(t)
 		self.assertIsNone(t._root)
 		i = len(data)
@@ -236,6 +376,82 @@ class TestBinarySearchTree(NodeChecker, _TestCase):
 			self.assertRaises(TypeError, t.get, k, 'a')
 			self.assertRaises(TypeError, t._set, k, 'a')
 
+	def test_small_size(self):
+		"Small trees are sorted lists that become trees and back as they change size."
+		t = self.cls()
+		small = t._small_size
+		keys = list(range(small + 1))
+		_shuffle(keys)
+		for i, key in enumerate(keys):
+			self.assertIsInstance(t._root, (type(None), sortedtable._SortedArray))
+			t._set(key, str(key))
+		self.assertNode(t)
+		self.assertIsInstance(t._root, sortedtable._Node)
+		self.assertEqual(list(range(small + 1)), list(t))
+		self.assertEqual((0, '0'), t.popmin())
+		t._delete(small)
+		self.assertIsInstance(t._root, sortedtable._Node)
+		self.assertEqual([(1, '1'), (2, '2')], t.poprange(hi=3))
+		while len(t) > small // 2 + 1:
+			t._delete(t.max())
+			self.assertIsInstance(t._root, sortedtable._Node)
+		t._delete(t.min())
+		self.assertIsInstance(t._root, sortedtable._SortedArray)
+		self.assertNode(t)
+		self.assertEqual(list(range(4, small // 2 + 4)), list(t))
+		self.assertEqual([5, 4], t.nearest(4.6, 2))
+		self.assertEqual((small // 2 + 3, str(small // 2 + 3)), t.popmax())
+		self.assertEqual([(k, str(k)) for k in range(4, small // 2 + 3)],
+						 t.poprange())
+		self.assertIsNone(t._root)
+		t = self.cls(hash_index=True)
+		t._set(1, 'a')
+		self.assertIsInstance(t._root, sortedtable._Node)
+
+	def test_node_pool(self):
+		for hash_index in False, True:
+			t = self.cls(hash_index=hash_index, pool_size=5)
+			t._small_size = 0
+			for i in range(50):
+				t._set(i, str(i))
+			self.assertEqual({'allocated': 50, 'reused': 0, 'pooled': 0},
+							 t.node_stats())
+			keys = list(range(50))
+			_shuffle(keys)
+			for i in keys[:20]:
+				t._delete(i)
+				self.assertNode(t)
+			t.popmin()
+			t.popmax()
+			self.assertEqual(5, t.node_stats()['pooled'])
+			self.assertTrue(all(x._key is x._left is None for x in t._pool))
+			for i in keys[:20]:
+				t._set(i, str(i))
+				self.assertNode(t)
+			self.assertEqual({'allocated': 65, 'reused': 5, 'pooled': 0},
+							 t.node_stats())
+			self.assertEqual(t.poprange(10, 20), [(i, str(i)) for i in range(10, 20)])
+			self.assertEqual(5, t.node_stats()['pooled'])
+			self.assertNode(t)
+			self.assertEqual(0, _pickle_loads(_pickle_dumps(t)).node_stats()['pooled'])
+			self.assertEqual({'allocated': 0, 'reused': 0, 'pooled': 0},
+							 t.copy().node_stats())
+		self.assertEqual({'allocated': 0, 'reused': 0, 'pooled': 0},
+						 self.cls().node_stats())
+
+	def test_check_keys(self):
+		for check_keys, count in (True, 1), (False, 0):
+			t = self.cls(check_keys=check_keys)
+			CountingKey.count = 0
+			t._set(CountingKey(1), 'a')
+			self.assertEqual(count, CountingKey.count)
+			t._small_size = 0
+			t.clear()
+			CountingKey.count = 0
+			t._set(CountingKey(1), 'a')
+			self.assertEqual(count, CountingKey.count)
+		self.assertRaises(TypeError, self.cls()._set, 1j, 'a')
+
 	def test_disjoint_keys(self):
 		t = self.cls()
 		self.assertNode(t)
@@ -341,6 +557,23 @@ class TestBinarySearchTree(NodeChecker, _TestCase):
 			self.assertRaises(IndexError, t.select, i + 1)
 		self.assertEqual(0, t.rank(-1))
 
+	def test_nearest_within(self):
+		t = self.cls()
+		self.assertEqual([], t.nearest(5, 3))
+		self.assertEqual([], t.within(5, 3))
+		keys = list(range(0, 60, 3)) + [100, 101]
+		for i in keys:
+			t._set(i, chr(i))
+		for key in -10, 0, 1, 1.5, 13, 30, 58, 59, 60, 99, 100.5, 200:
+			by_distance = sorted(keys, key=lambda k: (abs(k - key), k))
+			for k in 0, 1, 2, 5, len(keys), len(keys) + 3:
+				self.assertEqual(by_distance[:k], t.nearest(key, k))
+			for radius in 0, 1, 1.5, 3, 10, 1000:
+				self.assertEqual([k for k in keys if abs(k - key) <= radius],
+								 t.within(key, radius))
+		self.assertEqual([9, 12, 6], t.nearest(10, 3, lambda a, b: abs(a - b)))
+		self.assertEqual([12, 9, 15], t.nearest(11, 3, lambda a, b: abs(a - b - 0.5)))
+
 	def test_index(self):
 		t = self.cls()
 		self.assertNode(t)
@@ -384,6 +617,21 @@ class TestBinarySearchTree(NodeChecker, _TestCase):
 			self.assertEqual([], list(t.range(lo, hi)))
 			self.assertEqual([], list(t.range(hi, lo, -1)))
 
+	def test_nodes(self):
+		t = self.cls()
+		self.assertEqual([], list(t._nodes()))
+		for i in range(0, 100, 2):
+			t._set(i, chr(i))
+		for lo in None, -1, 0, 1, 50, 98, 99, 100:
+			for hi in None, -1, 0, 1, 50, 98, 99, 100:
+				expected = [i for i in range(0, 100, 2) if
+							(lo is None or lo <= i) and (hi is None or i < hi)]
+				self.assertEqual(expected, [x._key for x in t._nodes(lo, hi)])
+				self.assertEqual(expected[::-1],
+								 [x._key for x in t._nodes(lo, hi, True)])
+				self.assertEqual(expected, list(t.range(lo, hi)))
+				self.assertEqual(expected[::-1], list(t.range(hi, lo, -1)))
+
 class TestSortedMapping(NodeChecker, _TestCase):
 
 	def setUp(self):
@@ -473,6 +721,159 @@ class TestSortedMapping(NodeChecker, _TestCase):
 		data_start.update(data_update)
 		self.assert_contents(m, data_start)
 
+	def test_eq(self):
+		m = self.cls(self.data)
+		self.assertEqual(m, self.cls(reversed(self.data)))
+		self.assertEqual(m, dict(self.data))
+		self.assertNotEqual(m, self.cls(self.data[1:]))
+		self.assertNotEqual(m, self.cls(self.data[:-1] + [(-1, 'x')]))
+		self.assertNotEqual(m, self.cls(self.data[:-1] + [(self.data[-1][0], 'x')]))
+		self.assertNotEqual(m, list(self.data))
+		unhashable = sortedtable.SortedMapping([([1], 'a'), ([0, 2], 'b')])
+		self.assertEqual(unhashable, sortedtable.SortedFrozenMapping(
+			[([0, 2], 'b'), ([1], 'a')]))
+		self.assertNotEqual(unhashable, sortedtable.SortedMapping(
+			[([0, 2], 'b'), ([1], 'c')]))
+		self.assertNotEqual(unhashable, {1: 'a', 2: 'b'})
+
+	def test_hash(self):
+		with self.assertRaises(TypeError): hash(self.cls())
+		frozen = sortedtable.SortedFrozenMapping(self.data)
+		self.assertEqual(hash(frozen), hash(frozenset(self.data)))
+		self.assertEqual(hash(frozen), frozen._hashcode)
+		self.assertEqual({frozen: 1}[sortedtable.SortedFrozenMapping(self.data)], 1)
+		self.assertNotIn('_hashcode', _pickle_loads(_pickle_dumps(frozen)).__dict__)
+		for mutate in frozen.clear, frozen.popmin, frozen.popmax, frozen.poprange:
+			self.assertRaises(TypeError, mutate)
+		self.assertEqual(hash(frozen), hash(frozenset(self.data)))
+
+	def assert_same_shape(self, a, b):
+		"Assert the trees `a` and `b` have the same shape, colors, and lengths."
+		stack = [(a, b)]
+		while stack:
+			a, b = stack.pop()
+			if a is None or b is None:
+				self.assertIs(a, b)
+				continue
+			self.assertIsNot(a, b)
+			self.assertEqual((a._key, a._color, a._N), (b._key, b._color, b._N))
+			stack.extend([(a._left, b._left), (a._right, b._right)])
+
+	def test_copy(self):
+		m = self.cls((k, [v]) for k, v in self.data)
+		for c in m.copy(), _copy(m), self.cls(m), _deepcopy(m):
+			self.assertIs(type(m), type(c))
+			self.assertEqual(m.hash_index, c.hash_index)
+			self.assertNode(c)
+			self.assert_same_shape(m._root, c._root)
+			self.assertEqual(m, c)
+			del c[self.data[0][0]]
+			self.assertIn(self.data[0][0], m)
+		self.assertIs(m[1], m.copy()[1])
+		for c in _deepcopy(m), m.copy(deep_values=True):
+			self.assertEqual(m, c)
+			self.assertIsNot(m[1], c[1])
+			self.assertIs(m.min(), c.min())
+		self.assertEqual(0, len(self.cls().copy()))
+
+	def test_copy_resizes(self):
+		cls = type(self.cls())
+		class Tree(cls):
+			_small_size = 0
+		small = cls(self.data[:10])
+		for c in Tree(small), _copy(Tree(small)):
+			self.assertIsInstance(c._root, sortedtable._Node)
+			self.assertNode(c)
+			self.assertEqual(small, c)
+		small._small_size = 0
+		c = small.copy()
+		self.assertIsInstance(c._root, sortedtable._Node)
+		self.assertNode(c)
+		big = Tree(self.data)
+		c = cls(big)
+		self.assertEqual(big, c)
+		self.assertNode(c)
+
+	def test_small_reads_make_no_items(self):
+		m = self.cls((i, str(i)) for i in range(10))
+		if not isinstance(m._root, sortedtable._SortedArray):
+			self.skipTest('Hash-indexed tables are always trees')
+		other = sortedtable.SortedMapping((i, str(i)) for i in range(0, 20, 2))
+		item = sortedtable._Item
+		sortedtable._Item = None
+		try:
+			self.assertEqual('3', m.get(3))
+			self.assertIsNone(m.get(3.5))
+			self.assertIn(4, m)
+			self.assertEqual([(8, '8'), (9, '9')], list(m.items())[-2:])
+			self.assertEqual([5, 6], m.nearest(5.4, 2))
+			self.assertEqual([4, 5, 6], m.within(5, 1))
+			self.assertEqual(m, m.copy())
+			self.assertNotEqual(m, other)
+			self.assertEqual(5, len(list(sortedtable.merge_join(m, other))))
+			self.assertEqual((9, '9', (8, '8')),
+							 list(sortedtable.asof_join(m, other))[-1])
+			self.assertEqual([9, 8, 8, 7], list(sortedtable.SortedMergeView(
+				[m, other]).range(10, 7, -1)))
+			self.assertEqual(([2], ['2']), tuple(map(list, m.to_arrays(2, 3))))
+		finally:
+			sortedtable._Item = item
+
+	def test_to_arrays(self):
+		for m in self.cls(self.data), self.cls(self.data[:10]), self.cls():
+			keys = [k for k, v in self.data if k in m]
+			values = [m[k] for k in keys]
+			self.assertEqual((keys, values), m.to_arrays())
+			k, v = m.to_arrays(3, 7, 'q')
+			self.assertEqual(_array('q', keys[3:7]), k)
+			self.assertEqual(values[3:7], v)
+			for size in 1, 4, 1000:
+				blocks = list(m.iter_arrays(size, key_dtype='q'))
+				self.assertTrue(all(len(k) == len(v) == size for k, v in blocks[:-1]))
+				self.assertEqual(_array('q', keys), sum((k for k, v in blocks), _array('q')))
+				self.assertEqual(values, sum((v for k, v in blocks), []))
+			self.assertEqual([], list(m.iter_arrays(3, 5, 5)))
+		self.assertRaises(ValueError, m.iter_arrays, 0)
+		self.assertRaises(ValueError, m.iter_arrays, 1, key_dtype='i8')
+		self.assertRaises(ValueError, m.to_arrays, value_dtype='f8')
+
+	def test_to_arrays_numpy(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest('NumPy is not installed')
+		m = self.cls((k, float(k)) for k, v in self.data)
+		k, v = m.to_arrays(10, 20, 'i8', numpy.float64, numpy=True)
+		self.assertEqual(numpy.dtype('i8'), k.dtype)
+		self.assertEqual(list(range(10, 20)), k.tolist())
+		self.assertEqual(list(map(float, range(10, 20))), v.tolist())
+		k, v = m.to_arrays(10, 20, 'q', 'd', numpy=True)
+		self.assertIsInstance(k, numpy.ndarray)
+		self.assertEqual(numpy.dtype('d'), v.dtype)
+		blocks = list(m.iter_arrays(4, 10, 20, value_dtype='d', numpy=True))
+		self.assertEqual([4, 4, 2], [len(v) for k, v in blocks])
+		self.assertEqual(list(range(10, 20)), sum((k for k, v in blocks), []))
+		self.assertEqual(v.tolist(), numpy.concatenate([v for k, v in blocks]).tolist())
+
+	def test_init_with_str_keys(self):
+		data = [(v * (k % 5 + 1), k) for k, v in self.data]
+		data += [(k, -v) for k, v in data[::3]]
+		m = self.cls(data)
+		self.assert_contents(m, dict(data))
+		m = self.cls([(b'b', 1), (b'a', 2), (b'b', 3)])
+		self.assert_contents(m, {b'a': 2, b'b': 3})
+		self.assertRaises(TypeError, self.cls, [('a', 1), (b'a', 2)])
+
+	def test_update_streams_iterators(self):
+		for key in int, str, bytes:
+			m = self.cls()
+			def items():
+				for k in range(10):
+					self.assertEqual(k, len(m))
+					yield key(k) if key is not bytes else bytes([k]), k
+			m.update(items())
+			self.assertEqual(10, len(m))
+
 	def test_bad_data(self):
 		self.assertRaises(TypeError, self.cls, [1, 2, 3])
 		m = self.cls()
@@ -491,6 +892,116 @@ class TestSortedMapping(NodeChecker, _TestCase):
 		self.assertIsNone(m.get(2))
 		with self.assertRaises(KeyError): m[2]
 
+	def test_pop_setdefault(self):
+		data = list(self.data[:200])
+		_shuffle(data)
+		m = self.cls(data[::2])
+		contents = dict(data[::2])
+		for k, v in data:
+			self.assertEqual(contents.setdefault(k, v + 'x'), m.setdefault(k, v + 'x'))
+			self.assert_contents(m, contents)
+		_shuffle(data)
+		for k, v in data:
+			self.assertEqual(contents.pop(k), m.pop(k))
+			self.assert_contents(m, contents)
+			self.assertEqual('absent', m.pop(k, 'absent'))
+			self.assertRaises(KeyError, m.pop, k)
+			self.assert_contents(m, contents)
+		self.assertIsNone(m.setdefault(1))
+		self.assertIsNone(m[1])
+
+	def test_delete_absent_keys(self):
+		m = self.cls((2 * i, chr(i)) for i in range(200))
+		contents = {2 * i: chr(i) for i in range(200)}
+		keys = list(range(-1, 401))
+		_shuffle(keys)
+		for k in keys:
+			if k in contents:
+				del contents[k]
+				del m[k]
+			else:
+				with self.assertRaises(KeyError): del m[k]
+			self.assert_contents(m, contents)
+
+	def test_poprange(self):
+		for lo in None, -5, 0, 37, 150, 199, 200, 400:
+			for hi in None, -5, 0, 1, 38, 150, 199, 200, 400:
+				m = self.cls(self.data[:200])
+				contents = dict(self.data[:200])
+				expected = []
+				for k, v in self.data[:200]:
+					if (lo is None or lo <= k) and (hi is None or k < hi):
+						expected.append((k, v))
+						del contents[k]
+				self.assertEqual(expected, m.poprange(lo, hi))
+				self.assert_contents(m, contents)
+		self.assertEqual([], self.cls().poprange(0, 10))
+
+	def test_popmin_popmax(self):
+		m = self.cls()
+		self.assertRaises(KeyError, m.popmin)
+		self.assertRaises(KeyError, m.popmax)
+		data = list(self.data[:200])
+		_shuffle(data)
+		m.update(data)
+		data.sort()
+		while data:
+			self.assertEqual(data.pop(), m.popmax())
+			self.assertNode(m)
+			if data:
+				self.assertEqual(data.pop(0), m.popmin())
+				self.assertNode(m)
+		self.assertEqual(0, len(m))
+
+
+class TestHashIndexedSortedMapping(TestSortedMapping):
+
+	def setUp(self):
+		super().setUp()
+		self.cls = functools.partial(sortedtable.SortedMapping, hash_index=True)
+
+	def test_hash_index_flag(self):
+		self.assertTrue(self.cls().hash_index)
+		self.assertFalse(sortedtable.SortedMapping().hash_index)
+		m = self.cls(self.data[:10])
+		m.clear()
+		self.assertNode(m)
+		self.assertTrue(m.hash_index)
+		m[1] = 'a'
+		self.assertNode(m)
+		self.assertEqual(m[1], 'a')
+
+	def test_delete_keeps_index(self):
+		data = list(self.data[:200])
+		_shuffle(data)
+		m = self.cls(data)
+		contents = dict(data)
+		self.assert_contents(m, contents)
+		_shuffle(data)
+		for k, v in data:
+			del m[k]
+			del contents[k]
+			self.assert_contents(m, contents)
+			self.assertNotIn(k, m)
+			self.assertIsNone(m.get(k))
+			with self.assertRaises(KeyError): m[k]
+			with self.assertRaises(KeyError): del m[k]
+
+	def test_pop_keeps_index(self):
+		m = self.cls(self.data[:50])
+		contents = dict(self.data[:50])
+		while m:
+			k, v = m.popmin() if len(m) % 2 else m.popmax()
+			self.assertEqual(contents.pop(k), v)
+			self.assert_contents(m, contents)
+
+	def test_unhashable_keys(self):
+		m = self.cls()
+		self.assertRaises(TypeError, m.__setitem__, [1], 'a')
+		self.assertRaises(TypeError, m.__setitem__, None, 'a')
+		self.assertNode(m)
+		self.assertEqual(0, len(m))
+
 
 class TestSortedSet(NodeChecker, _TestCase):
 
@@ -538,6 +1049,50 @@ class TestSortedSet(NodeChecker, _TestCase):
 		s = self.cls(self.data)
 		self.assert_contents(s, self.data)
 
+	def test_comparisons(self):
+		s = self.cls(self.data)
+		half = self.cls(self.data[::2])
+		other = self.cls(self.data[1::2])
+		self.assertTrue(s == self.cls(reversed(self.data)) == set(self.data))
+		self.assertTrue(half < s and half <= s and s > half and s >= half)
+		self.assertTrue(s <= s and s >= s and not s < s and not s > s)
+		self.assertFalse(half <= other or half >= other or half == other)
+		self.assertFalse(s <= self.cls(self.data[:-1] + [-1]))
+		self.assertTrue(half < set(self.data) and set(self.data) > half)
+		self.assertTrue(half.isdisjoint(other))
+		self.assertFalse(half.isdisjoint(s))
+		self.assertTrue(half.isdisjoint(self.data[1::2]))
+		unhashable = self.cls([[1], [0, 2]])
+		self.assertTrue(unhashable < self.cls([[1], [0, 2], [3]]))
+
+	def test_hash(self):
+		with self.assertRaises(TypeError): hash(self.cls())
+		frozen = sortedtable.SortedFrozenSet(self.data)
+		self.assertEqual(hash(frozen), hash(frozenset(self.data)))
+		self.assertEqual({frozen: 1}[sortedtable.SortedFrozenSet(self.data)], 1)
+		for mutate in frozen.clear, frozen.popmin, frozen.popmax, frozen.poprange:
+			self.assertRaises(TypeError, mutate)
+		self.assertEqual(len(self.data), len(frozen))
+
+	def test_copy(self):
+		s = self.cls(self.data)
+		for c in s.copy(), _copy(s), self.cls(s), _deepcopy(s):
+			self.assertNode(c)
+			self.assertEqual(s, c)
+			c.discard(self.data[0])
+			self.assertIn(self.data[0], s)
+		s = self.cls([(1,), (2,)])
+		self.assertIs(s.min(), _deepcopy(s).min())
+		s = sortedtable.BoundedSortedSet(self.data, maxlen=5)
+		c = _deepcopy(s)
+		self.assertEqual((s, 5, 'largest'), (c, c.maxlen, c.keep))
+
+	def test_init_with_str_list(self):
+		data = [str(i) for i in self.data] * 2
+		s = self.cls(data)
+		self.assert_contents(s, set(data))
+		self.assertEqual(sorted(set(data)), list(s))
+
 	def test_create_empty_update_list(self):
 		s = self.cls()
 		self.assert_contents(s, [])
@@ -566,11 +1121,457 @@ class TestSortedSet(NodeChecker, _TestCase):
 		self.assertEqual(data, list(self.cls(rnddata)))
 		self.assertEqual(list(reversed(data)), list(reversed(self.cls(rnddata))))
 
+	def test_discard_remove(self):
+		s = self.cls(self.data[:300:3])
+		contents = set(self.data[:300:3])
+		data = list(self.data[:300])
+		_shuffle(data)
+		for i in data:
+			if i in contents:
+				contents.remove(i)
+				s.remove(i)
+			else:
+				self.assertRaises(KeyError, s.remove, i)
+			s.discard(i)
+			self.assert_contents(s, contents)
+
+	def test_poprange(self):
+		s = self.cls(self.data[:100])
+		self.assertEqual(list(range(10, 20)), s.poprange(10, 20))
+		self.assertEqual(list(range(90, 100)), s.poprange(90))
+		self.assertEqual(list(range(10)), s.poprange(hi=10))
+		self.assert_contents(s, self.data[20:90])
+
 	def test_deduplication(self):
 		data = [i % 10  for i in range(100)]
 		self.assertEqual([i for i in range(10)], list(self.cls(data)))
 
 
+class TestBoundedSortedSet(NodeChecker, _TestCase):
+
+	def setUp(self):
+		self.cls = sortedtable.BoundedSortedSet
+		self.data = [_randrange(1000) for i in range(2000)]
+
+	def test_bad_args(self):
+		self.assertRaises(TypeError, self.cls)
+		self.assertRaises(ValueError, self.cls, maxlen=0)
+		self.assertRaises(ValueError, self.cls, maxlen=1, keep='middle')
+
+	def test_keep_largest(self):
+		s = self.cls(maxlen=10)
+		seen = set()
+		for i in self.data:
+			s.add(i)
+			seen.add(i)
+			self.assertNode(s)
+			self.assertEqual(sorted(_nlargest(10, seen)), list(s))
+
+	def test_keep_smallest(self):
+		s = self.cls(self.data, maxlen=10, keep='smallest')
+		self.assertNode(s)
+		self.assertEqual(_nsmallest(10, set(self.data)), list(s))
+		self.assertEqual(10, s.maxlen)
+		self.assertEqual('smallest', s.keep)
+
+	def test_mutation_resets_boundary(self):
+		s = self.cls(range(10), maxlen=5)
+		self.assertEqual([5, 6, 7, 8, 9], list(s))
+		s.discard(5)
+		s.add(0)
+		self.assertEqual([0, 6, 7, 8, 9], list(s))
+		s.add(1)
+		self.assertEqual([1, 6, 7, 8, 9], list(s))
+		self.assertEqual(1, s.popmin())
+		self.assertEqual(9, s.popmax())
+		s.add(-1)
+		s.add(-2)
+		s.add(-3)
+		self.assertEqual([-2, -1, 6, 7, 8], list(s))
+		s.clear()
+		s |= range(3)
+		self.assertEqual([0, 1, 2], list(s))
+		self.assertNode(s)
+
+	def test_rejection_compares_once(self):
+		s = self.cls((CountingKey(i) for i in range(100, 200)), maxlen=50)
+		CountingKey.count = 0
+		for i in range(100):
+			s.add(CountingKey(i))
+		self.assertEqual(100, CountingKey.count)
+		self.assertEqual(list(range(150, 200)), [k.key for k in s])
+
+	def test_accepting_present_element_evicts_nothing(self):
+		s = self.cls(range(10), maxlen=5)
+		s.add(7)
+		self.assertEqual([5, 6, 7, 8, 9], list(s))
+		s.add(10)
+		self.assertEqual([6, 7, 8, 9, 10], list(s))
+		self.assertNode(s)
+
+	def test_set_operations_unbounded(self):
+		s = self.cls(range(10), maxlen=3)
+		u = s | range(5)
+		self.assertIsInstance(u, sortedtable.SortedSet)
+		self.assertEqual([0, 1, 2, 3, 4, 7, 8, 9], list(u))
+		self.assertEqual('BoundedSortedSet({7, 8, 9}, maxlen=3, keep=\'largest\')',
+						 repr(s))
+
+
+class TestSortedStrMapping(_TestCase):
+
+	def setUp(self):
+		self.cls = sortedtable.SortedStrMapping
+		self.data = {}
+		for i in range(300):
+			key = ''.join(_choice('abc') for j in range(_randrange(7)))
+			self.data[key] = i
+
+	def assert_structure(self, m):
+		"Check subtree counts and that every edge is compressed."
+		def count(node, is_root):
+			if not is_root:
+				self.assertTrue(node.value is not sortedtable._MISSING or
+								len(node.children) >= 2)
+			n = node.value is not sortedtable._MISSING
+			for char, child in node.children.items():
+				self.assertEqual(char, child.label[0])
+				n += count(child, False)
+			self.assertEqual(n, node._N)
+			return n
+		if m._root.label is not None:
+			count(m._root, True)
+
+	def test_mapping(self):
+		m = self.cls()
+		contents = {}
+		items = list(self.data.items())
+		for k, v in items:
+			m[k] = v
+			contents[k] = v
+		self.assert_structure(m)
+		self.assertEqual(sorted(contents.items()), list(m.items()))
+		self.assertEqual(sorted(contents, reverse=True), list(reversed(m)))
+		_shuffle(items)
+		for k, v in items[::2]:
+			del m[k]
+			del contents[k]
+			self.assert_structure(m)
+			self.assertNotIn(k, m)
+			with self.assertRaises(KeyError): del m[k]
+		self.assertEqual(sorted(contents.items()), list(m.items()))
+		self.assertEqual(contents, dict(m))
+		self.assertEqual([v for k, v in sorted(contents.items())], list(m.values()))
+		m.clear()
+		self.assertEqual(0, len(m))
+		self.assertEqual([], list(m))
+
+	def test_order_statistics(self):
+		m = self.cls(self.data)
+		keys = sorted(self.data)
+		for i, k in enumerate(keys):
+			self.assertEqual(k, m.select(i))
+			self.assertEqual(i, m.rank(k))
+			self.assertEqual(i, m.index(k))
+		self.assertRaises(IndexError, m.select, len(keys))
+		self.assertEqual(keys[0], m.min())
+		self.assertEqual(keys[-1], m.max())
+		for q in '', 'a', 'abca', 'bb', 'c', 'cccccccc', 'd':
+			below = [k for k in keys if k < q]
+			self.assertEqual(len(below), m.rank(q))
+			floor = [k for k in keys if k <= q]
+			if floor:
+				self.assertEqual(floor[-1], m.floor(q))
+			else:
+				self.assertRaises(KeyError, m.floor, q)
+			ceiling = [k for k in keys if k >= q]
+			if ceiling:
+				self.assertEqual(ceiling[0], m.ceiling(q))
+			else:
+				self.assertRaises(KeyError, m.ceiling, q)
+			for hi in None, '', 'ab', 'b', 'cab', 'd':
+				expected = [k for k in keys if q <= k and (hi is None or k < hi)]
+				self.assertEqual(expected, list(m.range(q, hi)))
+				self.assertEqual(expected[::-1], list(m.range(hi, q, -1)))
+		self.assertEqual(len(keys), m.width('', 'd'))
+
+	def test_prefix_queries(self):
+		m = self.cls(self.data)
+		for p in '', 'a', 'ab', 'abc', 'cab', 'cccccc', 'd':
+			self.assertEqual(sorted((k, v) for k, v in self.data.items()
+									if k.startswith(p)),
+							 list(m.prefix_items(p)))
+		m = self.cls({'/': 0, '/usr': 1, '/usr/lib': 2, '/var': 3})
+		self.assertEqual('/usr/lib', m.longest_prefix_of('/usr/lib/python'))
+		self.assertEqual('/usr', m.longest_prefix_of('/usr/local'))
+		self.assertEqual('/', m.longest_prefix_of('/home'))
+		self.assertRaises(KeyError, m.longest_prefix_of, 'home')
+		self.assertEqual([('/usr', 1), ('/usr/lib', 2)], list(m.prefix_items('/us')))
+
+	def test_key_types(self):
+		m = self.cls()
+		self.assertIsNone(m.get(1))
+		self.assertRaises(TypeError, m.__setitem__, 1, 'a')
+		m[b'ab'] = 1
+		m[b'a'] = 2
+		self.assertEqual([b'a', b'ab'], list(m))
+		self.assertEqual(b'a', m.longest_prefix_of(b'ac'))
+		self.assertRaises(TypeError, m.__setitem__, 'a', 3)
+		self.assertRaises(TypeError, m.get, 'a')
+
+	def test_pop(self):
+		m = self.cls(self.data)
+		keys = sorted(self.data)
+		self.assertEqual((keys[0], self.data[keys[0]]), m.popmin())
+		self.assertEqual((keys[-1], self.data[keys[-1]]), m.popmax())
+		self.assertEqual((keys[1], self.data[keys[1]]), m.popitem())
+		self.assert_structure(m)
+		self.assertRaises(KeyError, self.cls().popmin)
+
+	def test_pickle(self):
+		m = self.cls(self.data)
+		pickled = _pickle_loads(_pickle_dumps(m))
+		self.assertEqual(list(m.items()), list(pickled.items()))
+		self.assert_structure(pickled)
+
+	def test_copy(self):
+		m = self.cls(self.data)
+		for c in m.copy(), _copy(m):
+			self.assert_structure(c)
+			self.assertEqual(list(m.items()), list(c.items()))
+			key = min(self.data)
+			del c[key]
+			c['abcabcabc'] = -1
+			self.assert_structure(c)
+			self.assertEqual(self.data[key], m[key])
+			self.assertNotIn('abcabcabc', m)
+			self.assertEqual(sorted(self.data.items()), list(m.items()))
+		m = self.cls((k, [v]) for k, v in self.data.items())
+		key = min(self.data)
+		self.assertIs(m[key], m.copy()[key])
+		c = m.copy(deep_values=True)
+		self.assertEqual(dict(m), dict(c))
+		self.assertIsNot(m[key], c[key])
+
+
+class TestExpiringMapping(_TestCase):
+
+	def setUp(self):
+		self.now = 0.0
+		self.cls = functools.partial(sortedtable.ExpiringMapping,
+									 clock=lambda: self.now)
+
+	def test_bad_args(self):
+		self.assertRaises(ValueError, self.cls, ttl=0)
+		self.assertRaises(ValueError, self.cls, maxlen=0)
+		m = self.cls({'a': 1})
+		self.assertRaises(ValueError, m.set, 'a', 2, ttl=0)
+		self.assertRaises(ValueError, m.set, 'b', 2, ttl=-1)
+		self.assertEqual({'a': 1}, dict(m))
+
+	def test_ttl(self):
+		m = self.cls(ttl=10)
+		for i in range(100):
+			m[i] = chr(i)
+			self.now += 1
+		self.assertEqual(list(range(91, 100)), list(m))
+		self.assertNotIn(90, m)
+		self.assertIn(91, m)
+		self.assertEqual(chr(99), m[99])
+		with self.assertRaises(KeyError): m[50]
+		self.assertEqual(9, len(m))
+		self.assertEqual(9, len(m._order))
+		m[91] = 'x'
+		self.assertEqual([92, 93, 94, 95, 96, 97, 98, 99, 91], list(m))
+		self.now += 5
+		self.assertEqual([96, 97, 98, 99, 91], list(m))
+		del m[98]
+		with self.assertRaises(KeyError): del m[98]
+		self.assertEqual({96: chr(96), 97: chr(97), 99: chr(99), 91: 'x'}, dict(m))
+		self.now += 100
+		self.assertEqual(0, len(m))
+		self.assertEqual(0, len(m._order))
+
+	def test_per_entry_ttl(self):
+		m = self.cls()
+		m.set('a', 1, ttl=5)
+		m.set('b', 2)
+		m.set('c', 3, ttl=1)
+		self.assertEqual(['c', 'a', 'b'], list(m))
+		self.now = 1
+		self.assertEqual(['a', 'b'], list(m))
+		self.now = 100
+		self.assertEqual({'b': 2}, dict(m))
+
+	def test_maxlen(self):
+		m = self.cls(((i, i) for i in range(10)), maxlen=3)
+		self.assertEqual([7, 8, 9], list(m))
+		m[7] = 'x'
+		m[10] = 10
+		self.assertEqual([9, 7, 10], list(m))
+		self.assertEqual({9: 9, 7: 'x', 10: 10}, dict(m))
+		m.clear()
+		self.assertEqual(0, len(m))
+		m[1] = 1
+		self.assertEqual([1], list(m))
+
+	def test_maxlen_keeps_new_entry(self):
+		m = self.cls(maxlen=2, ttl=10)
+		m['a'] = 1
+		m[None] = 2
+		m.set('c', 3, ttl=1)
+		self.assertEqual({None: 2, 'c': 3}, dict(m))
+		self.assertEqual(['c', None], list(m))
+		m.set(None, 4, ttl=0.5)
+		self.assertEqual([None, 'c'], list(m))
+		self.assertEqual(2, len(m._order))
+
+	def test_copy(self):
+		m = self.cls(ttl=10)
+		m['a'] = [1]
+		self.now = 5
+		m['b'] = [2]
+		for c in m.copy(), _copy(m), m.copy(deep_values=True):
+			self.assertEqual(dict(m), dict(c))
+			self.assertEqual(10, c.ttl)
+			c['c'] = 3
+			del c['b']
+			self.assertEqual(['a', 'b'], list(m))
+			self.assertEqual(['a', 'c'], list(c))
+		self.assertIs(m['a'], m.copy()['a'])
+		self.assertIsNot(m['a'], m.copy(deep_values=True)['a'])
+		c = m.copy()
+		self.now = 12
+		self.assertEqual(['b'], list(c))
+		self.assertEqual(['b'], list(m))
+
+	def test_batch_eviction(self):
+		m = self.cls(ttl=1)
+		for i in range(1000):
+			m[i] = i
+		self.now = 0.5
+		m['later'] = 'x'
+		self.now = 1
+		self.assertEqual(1000, m.expire())
+		self.assertEqual(['later'], list(m))
+		self.assertEqual(0, m.expire())
+
+
+class TestSortedMergeView(_TestCase):
+
+	def setUp(self):
+		self.shards = [sortedtable.SortedMapping((i, (s, i)) for i in range(s, 60, s))
+					   for s in (2, 3, 5)]
+		self.view = sortedtable.SortedMergeView(self.shards)
+		self.unique = sortedtable.SortedMergeView(self.shards, dedupe=True)
+		self.keys = sorted(k for shard in self.shards for k in shard)
+
+	def test_iteration(self):
+		self.assertEqual(self.keys, list(self.view))
+		self.assertEqual(self.keys[::-1], list(reversed(self.view)))
+		self.assertEqual(sorted(set(self.keys)), list(self.unique))
+		self.assertEqual(sorted(set(self.keys), reverse=True),
+						 list(reversed(self.unique)))
+		self.assertEqual([], list(sortedtable.SortedMergeView([])))
+
+	def test_newest_value_wins(self):
+		items = list(self.unique.items())
+		self.assertEqual(sorted(set(self.keys)), [k for k, v in items])
+		for k, v in items:
+			newest = [s for s in (2, 3, 5) if k % s == 0][-1]
+			self.assertEqual((newest, k), v)
+			self.assertEqual(v, self.unique.get(k))
+		self.assertEqual([(6, (3, 6)), (6, (2, 6))], list(self.view.items(6, 7)))
+		self.assertIsNone(self.view.get(7))
+
+	def test_range(self):
+		for lo, hi in (None, None), (10, 30), (None, 11), (31, None), (7, 7):
+			expected = [k for k in self.keys if (lo is None or lo <= k) and
+						(hi is None or k < hi)]
+			self.assertEqual(expected, list(self.view.range(lo, hi)))
+			self.assertEqual(expected[::-1], list(self.view.range(hi, lo, -1)))
+			self.assertEqual(len(expected), self.view.width(
+				-1 if lo is None else lo, 100 if hi is None else hi))
+		self.assertRaises(ValueError, self.view.range, 0, 10, 2)
+
+	def test_order_statistics(self):
+		self.assertEqual(2, self.view.min())
+		self.assertEqual(58, self.view.max())
+		self.assertEqual(10, self.view.floor(11))
+		self.assertEqual(12, self.view.ceiling(11))
+		self.assertRaises(KeyError, self.view.floor, 1)
+		self.assertRaises(KeyError, self.view.ceiling, 59)
+		self.assertEqual(len([k for k in self.keys if k < 20]), self.view.rank(20))
+		self.assertIn(9, self.view)
+		self.assertNotIn(7, self.view)
+		empty = sortedtable.SortedMergeView([sortedtable.SortedMapping()])
+		self.assertRaises(ValueError, empty.min)
+		self.assertRaises(ValueError, empty.max)
+
+	def test_reflects_shards(self):
+		self.shards[0][7] = 'new'
+		self.assertIn(7, self.view)
+		self.assertEqual('new', self.unique.get(7))
+
+
+class TestJoins(_TestCase):
+
+	def setUp(self):
+		self.left = sortedtable.SortedFrozenMapping(
+			(i, 'l%d' % i) for i in range(-5, 60, 3))
+		self.right = sortedtable.SortedFrozenMapping(
+			(i, 'r%d' % i) for i in range(0, 50, 7))
+
+	def expected_asof(self, direction, tolerance=None):
+		result = []
+		for k, v in self.left.items():
+			candidates = []
+			if direction in ('backward', 'nearest'):
+				try:
+					candidates.append(self.right.floor(k))
+				except KeyError:
+					pass
+			if direction in ('forward', 'nearest'):
+				try:
+					candidates.append(self.right.ceiling(k))
+				except KeyError:
+					pass
+			candidates.sort(key=lambda c: (abs(k - c), c > k))
+			if candidates and (tolerance is None or
+							   abs(k - candidates[0]) <= tolerance):
+				c = candidates[0]
+				result.append((k, v, (c, self.right[c])))
+			else:
+				result.append((k, v, None))
+		return result
+
+	def test_asof_join(self):
+		for direction in 'backward', 'forward', 'nearest':
+			for tolerance in None, 0, 2, 100:
+				self.assertEqual(
+					self.expected_asof(direction, tolerance),
+					list(sortedtable.asof_join(self.left, self.right, direction,
+											   tolerance)))
+
+	def test_asof_join_empty(self):
+		empty = sortedtable.SortedFrozenMapping()
+		self.assertEqual([], list(sortedtable.asof_join(empty, self.right)))
+		self.assertEqual([(k, v, None) for k, v in self.left.items()],
+						 list(sortedtable.asof_join(self.left, empty, 'nearest')))
+		self.assertRaises(ValueError, sortedtable.asof_join, self.left,
+						  self.right, 'sideways')
+
+	def test_merge_join(self):
+		expected = [(k, v, self.right[k]) for k, v in self.left.items()
+					if k in self.right]
+		self.assertEqual([(7, 'l7', 'r7'), (28, 'l28', 'r28'), (49, 'l49', 'r49')],
+						 expected)
+		self.assertEqual(expected,
+						 list(sortedtable.merge_join(self.left, self.right)))
+		self.assertEqual([], list(sortedtable.merge_join(
+			self.left, sortedtable.SortedFrozenMapping())))
+
+
 try:
 	from test.mapping_tests import BasicTestMappingProtocol
 except ImportError: